@@ -0,0 +1,178 @@
+"""
+Конфигурация сервиса из переменных окружения
+"""
+
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    """Читает целочисленную переменную окружения"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    """Читает вещественную переменную окружения"""
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Читает логическую переменную окружения (1/true/yes/on)"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Запуск сервиса (python main.py и gunicorn.conf.py)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = _env_int("WEB_PORT", 8000)
+WEB_WORKERS = _env_int("WEB_WORKERS", 1)  # число процессов
+WEB_RELOAD = _env_bool("WEB_RELOAD", False)  # перезапуск при изменении кода, только для разработки
+
+# Контроль event loop и профилирование
+LOOP_MONITOR_ENABLED = _env_bool("LOOP_MONITOR_ENABLED", True)
+LOOP_MONITOR_INTERVAL = _env_float("LOOP_MONITOR_INTERVAL", 0.1)  # период замера задержки, сек
+LOOP_BLOCK_THRESHOLD = _env_float("LOOP_BLOCK_THRESHOLD", 0.25)  # блокировка, после которой в лог пишется стек
+# Токен административных ручек (заголовок X-Admin-Token); пусто - ручки выключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILER_MAX_DURATION = _env_float("PROFILER_MAX_DURATION", 60.0)
+
+# Общее состояние процессов: local (память процесса), sqlite (один хост) или redis
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "receipt-state.db")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+
+# Подключение к Ollama
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama:11434")
+# Несколько бэкендов через запятую; по умолчанию один OLLAMA_BASE_URL
+OLLAMA_BASE_URLS = [
+    url.strip() for url in os.getenv("OLLAMA_BASE_URLS", OLLAMA_BASE_URL).split(",") if url.strip()
+]
+OLLAMA_ROUTING = os.getenv("OLLAMA_ROUTING", "least_outstanding")  # least_outstanding или ewma
+OLLAMA_PROBE_INTERVAL = _env_float("OLLAMA_PROBE_INTERVAL", 10.0)
+
+# Автоматические выключатели по бэкендам и моделям
+CIRCUIT_FAILURE_THRESHOLD = _env_float("CIRCUIT_FAILURE_THRESHOLD", 0.5)  # доля ошибок в окне
+CIRCUIT_MIN_CALLS = _env_int("CIRCUIT_MIN_CALLS", 5)
+CIRCUIT_WINDOW = _env_float("CIRCUIT_WINDOW", 60.0)
+CIRCUIT_SLOW_CALL = _env_float("CIRCUIT_SLOW_CALL", 180.0)  # более долгий вызов считается ошибкой
+CIRCUIT_OPEN_DURATION = _env_float("CIRCUIT_OPEN_DURATION", 30.0)
+CIRCUIT_HALF_OPEN_CALLS = _env_int("CIRCUIT_HALF_OPEN_CALLS", 1)
+# Модели с отдельным выключателем сверх моделей сервиса и /api/tags бэкендов
+CIRCUIT_MODELS = [m.strip() for m in os.getenv("CIRCUIT_MODELS", "").split(",") if m.strip()]
+
+# Пул HTTP соединений к Ollama
+OLLAMA_MAX_CONNECTIONS = _env_int("OLLAMA_MAX_CONNECTIONS", 20)
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = _env_int("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", 10)
+OLLAMA_KEEPALIVE_EXPIRY = _env_float("OLLAMA_KEEPALIVE_EXPIRY", 60.0)
+
+# Таймауты (секунды)
+OLLAMA_CONNECT_TIMEOUT = _env_float("OLLAMA_CONNECT_TIMEOUT", 5.0)
+OLLAMA_POOL_TIMEOUT = _env_float("OLLAMA_POOL_TIMEOUT", 10.0)
+OLLAMA_VISION_TIMEOUT = _env_float("OLLAMA_VISION_TIMEOUT", 300.0)
+OLLAMA_TEXT_TIMEOUT = _env_float("OLLAMA_TEXT_TIMEOUT", 120.0)
+OLLAMA_HEALTH_TIMEOUT = _env_float("OLLAMA_HEALTH_TIMEOUT", 5.0)
+# Дедлайн на весь запрос с учетом повторов
+OLLAMA_VISION_DEADLINE = _env_float("OLLAMA_VISION_DEADLINE", 360.0)
+OLLAMA_TEXT_DEADLINE = _env_float("OLLAMA_TEXT_DEADLINE", 180.0)
+
+# Передавать JSON схему ReceiptData в format (structured outputs, Ollama 0.5+); иначе "json"
+OLLAMA_STRUCTURED_OUTPUT = _env_bool("OLLAMA_STRUCTURED_OUTPUT", True)
+
+# Повторные попытки
+RETRY_MAX_ATTEMPTS = _env_int("RETRY_MAX_ATTEMPTS", 3)
+RETRY_BASE_DELAY = _env_float("RETRY_BASE_DELAY", 0.5)
+RETRY_MAX_DELAY = _env_float("RETRY_MAX_DELAY", 8.0)
+RETRY_BUDGET_RATIO = _env_float("RETRY_BUDGET_RATIO", 0.2)  # доля повторов от числа запросов
+RETRY_BUDGET_REFILL = _env_float("RETRY_BUDGET_REFILL", 0.1)  # повторов в секунду сверх доли
+RETRY_BUDGET_MAX = _env_float("RETRY_BUDGET_MAX", 10.0)
+
+# Кэш результатов анализа чеков
+RECEIPT_CACHE_SIZE = _env_int("RECEIPT_CACHE_SIZE", 1024)
+RECEIPT_CACHE_TTL = _env_float("RECEIPT_CACHE_TTL", 86400.0)
+RECEIPT_CACHE_PATH = os.getenv("RECEIPT_CACHE_PATH", "")  # пусто - без дискового уровня
+
+# Быстрый путь по фискальному QR коду: сумма из кода, у модели - только название магазина
+FISCAL_QR_ENABLED = _env_bool("FISCAL_QR_ENABLED", True)
+FISCAL_QR_STORE_NAME = _env_bool("FISCAL_QR_STORE_NAME", True)  # по умолчанию для параметра store_name
+FISCAL_QR_MAX_EDGE = _env_int("FISCAL_QR_MAX_EDGE", 1600)  # большие фото уменьшаются перед поиском кода
+FISCAL_QR_CACHE_SIZE = _env_int("FISCAL_QR_CACHE_SIZE", 1024)  # результатов распознавания по хэшу изображения
+
+# Поиск почти дубликатов чеков по перцептивному хэшу (dHash)
+NEAR_DUPLICATE_ENABLED = _env_bool("NEAR_DUPLICATE_ENABLED", True)
+NEAR_DUPLICATE_THRESHOLD = _env_float("NEAR_DUPLICATE_THRESHOLD", 0.95)  # минимальное сходство
+# Отдавать результат похожего чека без инференса. Выключено: разные чеки одного магазина
+# с одинаковым числом строк могут иметь почти одинаковый хэш
+NEAR_DUPLICATE_REUSE = _env_bool("NEAR_DUPLICATE_REUSE", False)
+NEAR_DUPLICATE_HASH_SIZE = _env_int("NEAR_DUPLICATE_HASH_SIZE", 16)  # хэш из HASH_SIZE^2 бит
+NEAR_DUPLICATE_MAX_ENTRIES = _env_int("NEAR_DUPLICATE_MAX_ENTRIES", 10000)
+NEAR_DUPLICATE_TTL = _env_float("NEAR_DUPLICATE_TTL", RECEIPT_CACHE_TTL)
+
+# Семантический кэш ответов /query по эмбеддингам вопросов
+SEMANTIC_CACHE_ENABLED = _env_bool("SEMANTIC_CACHE_ENABLED", False)
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "nomic-embed-text")  # модель эмбеддингов Ollama
+SEMANTIC_CACHE_THRESHOLD = _env_float("SEMANTIC_CACHE_THRESHOLD", 0.92)  # минимальное косинусное сходство
+SEMANTIC_CACHE_MAX_ENTRIES = _env_int("SEMANTIC_CACHE_MAX_ENTRIES", 5000)
+SEMANTIC_CACHE_TTL = _env_float("SEMANTIC_CACHE_TTL", 86400.0)
+SEMANTIC_CACHE_TEMPERATURE_STEP = _env_float("SEMANTIC_CACHE_TEMPERATURE_STEP", 0.25)  # ширина диапазона температуры
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "")  # .npz файл; пусто - без сохранения
+OLLAMA_EMBED_TIMEOUT = _env_float("OLLAMA_EMBED_TIMEOUT", 10.0)
+
+# Предобработка изображений перед отправкой в модель
+IMAGE_PREPROCESS_ENABLED = _env_bool("IMAGE_PREPROCESS_ENABLED", True)
+IMAGE_MAX_EDGE = _env_int("IMAGE_MAX_EDGE", 1024)
+IMAGE_GRAYSCALE = _env_bool("IMAGE_GRAYSCALE", True)
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG")  # JPEG или WEBP
+IMAGE_QUALITY = _env_int("IMAGE_QUALITY", 85)
+
+# Пул для CPU-нагруженных этапов: проверка и пережатие изображений, хэши, QR коды
+CPU_POOL_KIND = os.getenv("CPU_POOL_KIND", "thread")  # thread или process
+CPU_POOL_WORKERS = _env_int("CPU_POOL_WORKERS", min(4, os.cpu_count() or 1))
+
+# Загрузка изображений
+UPLOAD_MAX_BODY_SIZE = _env_int("UPLOAD_MAX_BODY_SIZE", 11 * 1024 * 1024)  # тело запроса с одним изображением
+BATCH_MAX_BODY_SIZE = _env_int("BATCH_MAX_BODY_SIZE", 200 * 1024 * 1024)  # тело пакетного запроса
+IMAGE_MAX_PIXELS = _env_int("IMAGE_MAX_PIXELS", 40_000_000)  # защита от decompression bomb
+
+# Пакетный анализ чеков
+OLLAMA_NUM_PARALLEL = _env_int("OLLAMA_NUM_PARALLEL", 1)  # должно совпадать с настройкой Ollama
+# Суммарная параллельность всех бэкендов
+OLLAMA_TOTAL_PARALLEL = OLLAMA_NUM_PARALLEL * len(OLLAMA_BASE_URLS)
+BATCH_MAX_ITEMS = _env_int("BATCH_MAX_ITEMS", 500)
+# Суммарный размер файлов ZIP архива после распаковки (защита от zip bomb)
+BATCH_MAX_UNCOMPRESSED_SIZE = _env_int("BATCH_MAX_UNCOMPRESSED_SIZE", 200 * 1024 * 1024)
+
+# Диалоги с моделью
+SESSION_TTL = _env_float("SESSION_TTL", 1800.0)  # сек без обращений до удаления диалога
+SESSION_MAX = _env_int("SESSION_MAX", 1000)
+SESSION_TOKEN_BUDGET = _env_int("SESSION_TOKEN_BUDGET", 1536)  # меньше контекста модели (2048 у moondream)
+
+# Очередь задач анализа чеков
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "")  # пусто - очередь в памяти
+JOB_WORKERS = _env_int("JOB_WORKERS", OLLAMA_TOTAL_PARALLEL)
+JOB_RESULT_TTL = _env_float("JOB_RESULT_TTL", 86400.0)
+JOB_MAX_WAIT = _env_float("JOB_MAX_WAIT", 60.0)  # максимальное время long-poll, сек
+# Хосты, на которые разрешены webhook; пусто - любые хосты с публичными адресами
+JOB_WEBHOOK_ALLOWED_HOSTS = [h.strip() for h in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()]
+
+# Контроль допуска запросов к Ollama
+ADMISSION_MAX_IN_FLIGHT = _env_int("ADMISSION_MAX_IN_FLIGHT", OLLAMA_TOTAL_PARALLEL)
+ADMISSION_MAX_QUEUE = _env_int("ADMISSION_MAX_QUEUE", 16)
+ADMISSION_QUEUE_TIMEOUT = _env_float("ADMISSION_QUEUE_TIMEOUT", 30.0)
+# Арендаторы: JSON с API ключами, весами в очереди и лимитами; пусто - один арендатор default
+TENANTS_PATH = os.getenv("TENANTS_PATH", "")
+API_KEY_REQUIRED = _env_bool("API_KEY_REQUIRED", False)  # отклонять запросы без X-API-Key
+# Срок аренды глобального слота и захвата задачи в общем состоянии: после него
+# слот и задача упавшего процесса освобождаются. Должен превышать дедлайн запроса
+STATE_LEASE_TTL = _env_float("STATE_LEASE_TTL", OLLAMA_VISION_DEADLINE + 60.0)
+
+# Прогрев и удержание моделей в памяти Ollama
+MODEL_PRELOAD = [m.strip() for m in os.getenv("MODEL_PRELOAD", "moondream:1.8b").split(",") if m.strip()]
+MODEL_KEEP_ALIVE = os.getenv("MODEL_KEEP_ALIVE", "30m")
+OTHER_MODEL_KEEP_ALIVE = os.getenv("OTHER_MODEL_KEEP_ALIVE", "1m")
+MODEL_WARM_INTERVAL = _env_float("MODEL_WARM_INTERVAL", 60.0)  # 0 - без keep-warm
+MODEL_WARM_HOURS = os.getenv("MODEL_WARM_HOURS", "8-20")  # пусто - круглосуточно
+OLLAMA_MAX_LOADED_MODELS = _env_int("OLLAMA_MAX_LOADED_MODELS", 1)  # должно совпадать с настройкой Ollama
+MODEL_SWAP_MAX_WAIT = _env_float("MODEL_SWAP_MAX_WAIT", 10.0)
@@ -4,11 +4,22 @@
 
 import logging
 import io
+import secrets
 from typing import Optional
-from fastapi import UploadFile, HTTPException
+from fastapi import UploadFile, HTTPException, Header
 from PIL import Image
 
+from app import config
+from app.services.conversation_store import ConversationStore
+from app.services.cpu_pool import CpuPool
+from app.services.fiscal_qr import FiscalQRDecoder
+from app.services.image_preprocessor import ImagePreprocessor
+from app.services.job_queue import JobQueue, MemoryJobStore, RedisJobStore, SQLiteJobStore
+from app.services.loop_monitor import LoopLagMonitor
 from app.services.ollama_service import OllamaService
+from app.services.profiler import SamplingProfiler
+from app.services.shared_state import STATE_REDIS, STATE_SQLITE, create_shared_state
+from app.services.tenants import Tenant, TenantRegistry
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,15 +31,77 @@ logger = logging.getLogger(__name__)
 # Глобальные константы
 SUPPORTED_IMAGE_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp"}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-# Инициализация сервисов
-ollama_service = OllamaService()
+# Pillow отказывается декодировать изображения больше лимита (decompression bomb)
+Image.MAX_IMAGE_PIXELS = config.IMAGE_MAX_PIXELS
+
+
+def _create_job_store():
+    """Хранилище задач: общее при STATE_BACKEND sqlite/redis, иначе JOB_QUEUE_PATH или память"""
+    if config.STATE_BACKEND == STATE_REDIS:
+        return RedisJobStore(config.STATE_REDIS_URL)
+    if config.STATE_BACKEND == STATE_SQLITE:
+        return SQLiteJobStore(config.STATE_SQLITE_PATH)
+    return SQLiteJobStore(config.JOB_QUEUE_PATH) if config.JOB_QUEUE_PATH else MemoryJobStore()
+
+
+# Инициализация сервисов (в каждом процессе воркера)
+shared_state = create_shared_state(config.STATE_BACKEND, config.STATE_SQLITE_PATH, config.STATE_REDIS_URL)
+if shared_state is None and config.WEB_WORKERS > 1:
+    logger.warning(
+        f"WEB_WORKERS={config.WEB_WORKERS} без общего состояния: кэш, очередь задач "
+        f"и лимит запросов к Ollama действуют в каждом процессе отдельно"
+    )
+tenant_registry = (
+    TenantRegistry.from_file(config.TENANTS_PATH, require_key=config.API_KEY_REQUIRED)
+    if config.TENANTS_PATH else TenantRegistry([], {}, require_key=config.API_KEY_REQUIRED)
+)
+cpu_pool = CpuPool(kind=config.CPU_POOL_KIND, workers=config.CPU_POOL_WORKERS)
+ollama_service = OllamaService(cpu_pool=cpu_pool, shared_state=shared_state)
+image_preprocessor = ImagePreprocessor(
+    enabled=config.IMAGE_PREPROCESS_ENABLED,
+    max_edge=config.IMAGE_MAX_EDGE,
+    grayscale=config.IMAGE_GRAYSCALE,
+    output_format=config.IMAGE_OUTPUT_FORMAT,
+    quality=config.IMAGE_QUALITY,
+    hash_size=config.NEAR_DUPLICATE_HASH_SIZE if config.NEAR_DUPLICATE_ENABLED else 0,
+    cpu_pool=cpu_pool
+)
+qr_decoder = FiscalQRDecoder(
+    enabled=config.FISCAL_QR_ENABLED,
+    max_edge=config.FISCAL_QR_MAX_EDGE,
+    cpu_pool=cpu_pool,
+    cache_size=config.FISCAL_QR_CACHE_SIZE
+)
+conversation_store = ConversationStore(
+    ttl=config.SESSION_TTL,
+    max_sessions=config.SESSION_MAX,
+    token_budget=config.SESSION_TOKEN_BUDGET
+)
+job_queue = JobQueue(
+    ollama_service,
+    store=_create_job_store(),
+    workers=config.JOB_WORKERS,
+    result_ttl=config.JOB_RESULT_TTL,
+    stale_after=config.STATE_LEASE_TTL if shared_state is not None else None,
+    tenants=tenant_registry,
+    webhook_allowed_hosts=config.JOB_WEBHOOK_ALLOWED_HOSTS
+)
+loop_monitor = LoopLagMonitor(
+    interval=config.LOOP_MONITOR_INTERVAL,
+    block_threshold=config.LOOP_BLOCK_THRESHOLD
+)
+profiler = SamplingProfiler(max_duration=config.PROFILER_MAX_DURATION)
 
 
 async def validate_image(file: UploadFile) -> bytes:
     """
     Валидация загружаемого изображения
     
+    Файл читается частями с проверкой размера по мере чтения, формат
+    определяется по сигнатуре, а не по заголовку Content-Type клиента.
+    
     Args:
         file: Загружаемый файл
         
@@ -38,16 +111,70 @@ async def validate_image(file: UploadFile) -> bytes:
     Raises:
         HTTPException: При ошибке валидации
     """
-    # Проверка типа файла
-    if file.content_type not in SUPPORTED_IMAGE_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Неподдерживаемый формат файла. Поддерживаются: {', '.join(SUPPORTED_IMAGE_TYPES)}"
-        )
+    content = await read_upload(file)
+    return await check_image_content(content)
+
+
+async def read_upload(file: UploadFile, limit: int = MAX_FILE_SIZE) -> bytes:
+    """
+    Читает загруженный файл частями, прерывая чтение при превышении лимита
     
-    # Чтение файла
-    content = await file.read()
+    Args:
+        file: Загружаемый файл
+        limit: Максимальный размер, байт
+        
+    Returns:
+        bytes: Содержимое файла
+        
+    Raises:
+        HTTPException: Файл больше лимита
+    """
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > limit:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Файл слишком большой. Максимальный размер: {limit // (1024*1024)}MB"
+            )
+    return bytes(buffer)
+
+
+def sniff_image_type(content: bytes) -> Optional[str]:
+    """
+    Определяет формат изображения по сигнатуре (magic bytes)
     
+    Returns:
+        MIME тип из SUPPORTED_IMAGE_TYPES или None
+    """
+    if content.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if content.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def verify_image(content: bytes) -> None:
+    """Проверяет целостность изображения полным разбором (выполняется в пуле CPU задач)"""
+    image = Image.open(io.BytesIO(content))
+    image.verify()
+
+
+async def check_image_content(content: bytes) -> bytes:
+    """
+    Проверка размера, формата, разрешения и целостности изображения
+    
+    Args:
+        content: Байты изображения
+        
+    Returns:
+        bytes: Байты изображения
+        
+    Raises:
+        HTTPException: При ошибке валидации
+    """
     # Проверка размера файла
     if len(content) > MAX_FILE_SIZE:
         raise HTTPException(
@@ -55,10 +182,32 @@ async def validate_image(file: UploadFile) -> bytes:
             detail=f"Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE // (1024*1024)}MB"
         )
     
-    # Проверка, что файл действительно является изображением
+    # Формат по сигнатуре, а не по Content-Type от клиента
+    if sniff_image_type(content) is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый формат файла. Поддерживаются: {', '.join(SUPPORTED_IMAGE_TYPES)}"
+        )
+    
+    # Разрешение из заголовка, до декодирования пикселей
     try:
-        image = Image.open(io.BytesIO(content))
-        image.verify()
+        width, height = Image.open(io.BytesIO(content)).size
+    except Exception as e:
+        logger.error(f"Ошибка при чтении заголовка изображения: {e}")
+        raise HTTPException(
+            status_code=400,
+            detail="Поврежденное изображение или неподдерживаемый формат"
+        )
+    if width * height > config.IMAGE_MAX_PIXELS:
+        logger.warning(f"Изображение отклонено: {width}x{height} больше {config.IMAGE_MAX_PIXELS} пикселей")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком большое разрешение изображения: {width}x{height}"
+        )
+    
+    # Проверка, что файл действительно является изображением (вне event loop)
+    try:
+        await cpu_pool.run("verify", verify_image, content)
     except Exception as e:
         logger.error(f"Ошибка при проверке изображения: {e}")
         raise HTTPException(
@@ -69,6 +218,16 @@ async def validate_image(file: UploadFile) -> bytes:
     return content
 
 
+def get_cpu_pool() -> CpuPool:
+    """
+    Зависимость для получения пула CPU задач
+    
+    Returns:
+        CpuPool: Экземпляр пула
+    """
+    return cpu_pool
+
+
 def get_ollama_service() -> OllamaService:
     """
     Зависимость для получения сервиса Ollama
@@ -76,4 +235,102 @@ def get_ollama_service() -> OllamaService:
     Returns:
         OllamaService: Экземпляр сервиса
     """
-    return ollama_service 
\ No newline at end of file
+    return ollama_service 
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    """
+    Зависимость для получения предобработчика изображений
+    
+    Returns:
+        ImagePreprocessor: Экземпляр предобработчика
+    """
+    return image_preprocessor
+
+
+def get_qr_decoder() -> FiscalQRDecoder:
+    """
+    Зависимость для получения декодера фискальных QR кодов
+    
+    Returns:
+        FiscalQRDecoder: Экземпляр декодера
+    """
+    return qr_decoder
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    Зависимость для получения хранилища диалогов
+    
+    Returns:
+        ConversationStore: Экземпляр хранилища
+    """
+    return conversation_store
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Зависимость для получения очереди задач
+    
+    Returns:
+        JobQueue: Экземпляр очереди задач
+    """
+    return job_queue
+
+
+def get_loop_monitor() -> LoopLagMonitor:
+    """
+    Зависимость для получения монитора event loop
+    
+    Returns:
+        LoopLagMonitor: Экземпляр монитора
+    """
+    return loop_monitor
+
+
+def get_profiler() -> SamplingProfiler:
+    """
+    Зависимость для получения профилировщика
+    
+    Returns:
+        SamplingProfiler: Экземпляр профилировщика
+    """
+    return profiler
+
+
+def get_tenant_registry() -> TenantRegistry:
+    """
+    Зависимость для получения реестра арендаторов
+    
+    Returns:
+        TenantRegistry: Экземпляр реестра
+    """
+    return tenant_registry
+
+
+def get_tenant(x_api_key: Optional[str] = Header(None)) -> Tenant:
+    """
+    Арендатор запроса по заголовку X-API-Key с учетом его лимита запросов
+    
+    Returns:
+        Tenant: Арендатор
+        
+    Raises:
+        HTTPException: 401 при неизвестном или отсутствующем обязательном ключе, 429 при превышении лимита
+    """
+    tenant = tenant_registry.authenticate(x_api_key)
+    tenant_registry.check_rate(tenant)
+    return tenant
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """
+    Проверка токена административных ручек (заголовок X-Admin-Token)
+    
+    Raises:
+        HTTPException: 404, если ADMIN_TOKEN не задан; 403 при неверном токене
+    """
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token.encode(), config.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Неверный токен администратора")
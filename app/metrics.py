@@ -0,0 +1,228 @@
+"""
+Метрики Prometheus для сервиса
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Бакеты под длительность инференса: от миллисекунд кэша до минут холодной загрузки модели
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# load_duration выше порога означает загрузку модели с диска, а не из памяти
+COLD_START_THRESHOLD = 1.0
+
+HTTP_REQUESTS = Counter(
+    "receipt_http_requests_total",
+    "Число HTTP запросов",
+    ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "receipt_http_request_duration_seconds",
+    "Время обработки HTTP запроса",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge(
+    "receipt_http_requests_in_flight",
+    "Число HTTP запросов в обработке",
+    multiprocess_mode="livesum"
+)
+
+ANALYSIS_STAGE_LATENCY = Histogram(
+    "receipt_analysis_stage_duration_seconds",
+    "Время этапов анализа чека",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+
+OLLAMA_IN_FLIGHT = Gauge(
+    "ollama_requests_in_flight",
+    "Число запросов к Ollama в обработке",
+    ["operation"],
+    multiprocess_mode="livesum"
+)
+OLLAMA_LATENCY = Histogram(
+    "ollama_request_duration_seconds",
+    "Время запроса к Ollama",
+    ["operation"],
+    buckets=LATENCY_BUCKETS
+)
+OLLAMA_RETRIES = Counter(
+    "ollama_retries_total",
+    "Число повторных попыток запросов к Ollama по причине",
+    ["operation", "reason"]
+)
+OLLAMA_RETRIES_DENIED = Counter(
+    "ollama_retries_denied_total",
+    "Число неудачных попыток без повтора: terminal, attempts, deadline, budget",
+    ["operation", "reason"]
+)
+RECEIPT_PARSE = Counter(
+    "receipt_parse_total",
+    "Исходы разбора ответа vision модели: strict, repaired (исправлен без повтора), failed (нужен повтор)",
+    ["outcome"]
+)
+OLLAMA_EVAL_TOKENS = Counter(
+    "ollama_eval_tokens_total",
+    "Число сгенерированных токенов (eval_count)",
+    ["model"]
+)
+OLLAMA_PROMPT_TOKENS = Counter(
+    "ollama_prompt_eval_tokens_total",
+    "Число токенов промпта (prompt_eval_count)",
+    ["model"]
+)
+OLLAMA_EVAL_DURATION = Histogram(
+    "ollama_eval_duration_seconds",
+    "Время генерации ответа по данным Ollama (eval_duration)",
+    ["model"],
+    buckets=LATENCY_BUCKETS
+)
+OLLAMA_PROMPT_EVAL_DURATION = Histogram(
+    "ollama_prompt_eval_duration_seconds",
+    "Время обработки промпта по данным Ollama (prompt_eval_duration)",
+    ["model"],
+    buckets=LATENCY_BUCKETS
+)
+OLLAMA_LOAD_DURATION = Histogram(
+    "ollama_load_duration_seconds",
+    "Время загрузки модели по данным Ollama (load_duration)",
+    ["model"],
+    buckets=LATENCY_BUCKETS
+)
+OLLAMA_COLD_STARTS = Counter(
+    "ollama_cold_starts_total",
+    "Число запросов, при которых Ollama загружала модель (load_duration > 1с)",
+    ["model"]
+)
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight",
+    "Число запросов к Ollama, допущенных к выполнению",
+    multiprocess_mode="livesum"
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth",
+    "Число запросов, ожидающих допуска к Ollama",
+    multiprocess_mode="livesum"
+)
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds",
+    "Время ожидания допуска к Ollama",
+    buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total",
+    "Число отклоненных запросов по причине",
+    ["reason"]
+)
+TENANT_QUEUE_DEPTH = Gauge(
+    "admission_tenant_queue_depth",
+    "Число запросов арендатора в очереди к Ollama",
+    ["tenant"],
+    multiprocess_mode="livesum"
+)
+TENANT_WAIT = Histogram(
+    "admission_tenant_wait_seconds",
+    "Время ожидания допуска к Ollama по арендаторам и классам приоритета",
+    ["tenant", "priority"],
+    buckets=LATENCY_BUCKETS
+)
+TENANT_RATE_LIMITED = Counter(
+    "tenant_rate_limited_total",
+    "Число запросов, отклоненных лимитом частоты арендатора",
+    ["tenant"]
+)
+
+# Пул CPU задач
+CPU_POOL_QUEUE_TIME = Histogram(
+    "cpu_pool_queue_seconds",
+    "Время ожидания задачи в очереди пула CPU",
+    ["task"],
+    buckets=LATENCY_BUCKETS
+)
+CPU_POOL_RUN_TIME = Histogram(
+    "cpu_pool_run_seconds",
+    "Время выполнения задачи в пуле CPU",
+    ["task"],
+    buckets=LATENCY_BUCKETS
+)
+
+# Автоматические выключатели
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state",
+    "Состояние выключателя: 0 - closed, 1 - open, 2 - half_open",
+    ["name"],
+    multiprocess_mode="liveall"
+)
+CIRCUIT_REJECTED = Counter(
+    "circuit_breaker_rejected_total",
+    "Число запросов, отклоненных разомкнутым выключателем",
+    ["name"]
+)
+
+# Почти дубликаты чеков
+NEAR_DUPLICATES = Counter(
+    "receipt_near_duplicates_total",
+    "Число найденных почти дубликатов: reused - результат взят из индекса, flagged - только отмечен",
+    ["outcome"]
+)
+
+# Фискальные QR коды
+FISCAL_QR = Counter(
+    "receipt_fiscal_qr_total",
+    "Результат распознавания фискального QR кода: decoded, not_found, error",
+    ["outcome"]
+)
+
+
+# Семантический кэш ответов /query
+SEMANTIC_CACHE = Counter(
+    "semantic_cache_total",
+    "Поиск в семантическом кэше: hit, miss, embed_error (эмбеддинг не получен)",
+    ["outcome"]
+)
+
+# Event loop
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Задержка пробуждения задачи в event loop сверх запланированного времени",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EVENT_LOOP_BLOCKED = Counter(
+    "event_loop_blocked_total",
+    "Число блокировок event loop дольше LOOP_BLOCK_THRESHOLD (стек записывается в лог)"
+)
+
+
+@contextmanager
+def observe_stage(stage: str) -> Iterator[None]:
+    """Замеряет длительность этапа анализа чека"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ANALYSIS_STAGE_LATENCY.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+def record_generation_stats(model: str, result: Dict[str, Any]) -> None:
+    """
+    Записывает статистику генерации из ответа /api/generate
+
+    Длительности Ollama отдает в наносекундах.
+    """
+    if "eval_count" in result:
+        OLLAMA_EVAL_TOKENS.labels(model=model).inc(result["eval_count"])
+    if "prompt_eval_count" in result:
+        OLLAMA_PROMPT_TOKENS.labels(model=model).inc(result["prompt_eval_count"])
+    if "eval_duration" in result:
+        OLLAMA_EVAL_DURATION.labels(model=model).observe(result["eval_duration"] / 1e9)
+    if "prompt_eval_duration" in result:
+        OLLAMA_PROMPT_EVAL_DURATION.labels(model=model).observe(result["prompt_eval_duration"] / 1e9)
+    if "load_duration" in result:
+        load_duration = result["load_duration"] / 1e9
+        OLLAMA_LOAD_DURATION.labels(model=model).observe(load_duration)
+        if load_duration > COLD_START_THRESHOLD:
+            OLLAMA_COLD_STARTS.labels(model=model).inc()
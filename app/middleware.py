@@ -0,0 +1,75 @@
+"""
+ASGI middleware приложения
+"""
+
+import json
+import logging
+from typing import Dict
+
+from fastapi import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBodyTooLarge(HTTPException):
+    """Тело запроса превышает допустимый размер"""
+
+    def __init__(self, limit: int):
+        super().__init__(
+            status_code=413,
+            detail=f"Запрос слишком большой. Максимальный размер: {limit // (1024 * 1024)}MB"
+        )
+
+
+class BodySizeLimitMiddleware:
+    """
+    Ограничивает размер тела запроса до его разбора
+
+    Запрос с Content-Length больше лимита отклоняется с 413 сразу, без
+    чтения тела. Для запросов без Content-Length (chunked) байты считаются
+    по мере поступления, и чтение прерывается, как только лимит превышен,
+    поэтому multipart парсер не успевает сохранить больше лимита.
+    """
+
+    def __init__(self, app: ASGIApp, default_limit: int, path_limits: Dict[str, int]):
+        self.app = app
+        self.default_limit = default_limit
+        self.path_limits = path_limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"], self.default_limit)
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            logger.warning(f"Запрос к {scope['path']} отклонен: Content-Length {int(content_length)} > {limit}")
+            await self._reject(send, limit)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    logger.warning(f"Запрос к {scope['path']} прерван: тело больше {limit} байт")
+                    raise RequestBodyTooLarge(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @staticmethod
+    async def _reject(send: Send, limit: int) -> None:
+        error = RequestBodyTooLarge(limit)
+        body = json.dumps({"detail": error.detail}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": error.status_code,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class ReceiptData(BaseModel):
@@ -14,11 +14,47 @@ class ReceiptAnalysisRequest(BaseModel):
     pass  # Изображение передается через multipart/form-data
 
 
+class DuplicateMatch(BaseModel):
+    """Ранее проанализированный чек, похожий на загруженный"""
+    duplicate_of: str = Field(..., description="SHA-256 изображения ранее проанализированного чека")
+    similarity: float = Field(..., ge=0.0, le=1.0, description="Сходство по перцептивному хэшу (1.0 - совпадает)")
+    distance: int = Field(..., ge=0, description="Расстояние Хэмминга между хэшами")
+
+
+class FiscalData(BaseModel):
+    """Реквизиты фискального QR кода ФНС"""
+    total_amount: float = Field(..., gt=0, description="Сумма чека (параметр s)")
+    fn: str = Field(..., description="Номер фискального накопителя")
+    fd: str = Field(..., description="Номер фискального документа (параметр i)")
+    fp: str = Field(..., description="Фискальный признак документа")
+    timestamp: Optional[str] = Field(None, description="Дата и время чека (параметр t)")
+    operation: Optional[int] = Field(None, description="Тип операции: 1 - приход, 2 - возврат прихода")
+
+
 class ReceiptAnalysisResponse(BaseModel):
     """Модель ответа анализа чека"""
     success: bool = Field(..., description="Успешность анализа")
     data: Optional[ReceiptData] = None
     error: Optional[str] = None
+    cached: bool = Field(False, description="Результат получен из кэша")
+    duplicate: Optional[DuplicateMatch] = Field(None, description="Похожий ранее загруженный чек (возможная повторная отправка)")
+    sources: Optional[Dict[str, str]] = Field(
+        None, description="Источник каждого поля data: qr - фискальный QR код, model - модель, none - не определено"
+    )
+    fiscal: Optional[FiscalData] = Field(None, description="Реквизиты фискального QR кода, если он распознан")
+
+
+class BatchReceiptItem(ReceiptAnalysisResponse):
+    """Результат анализа одного чека в пакете (строка NDJSON)"""
+    index: int = Field(..., description="Порядковый номер изображения в пакете")
+    filename: Optional[str] = Field(None, description="Имя файла")
+
+
+class JobResponse(BaseModel):
+    """Модель ответа с состоянием асинхронной задачи анализа чека"""
+    job_id: str = Field(..., description="Идентификатор задачи")
+    status: str = Field(..., description="Статус задачи: queued, running, completed")
+    result: Optional[ReceiptAnalysisResponse] = Field(None, description="Результат анализа после завершения")
 
 
 class TextQueryRequest(BaseModel):
@@ -34,6 +70,47 @@ class TextQueryResponse(BaseModel):
     response: Optional[str] = Field(None, description="Ответ модели")
     model_used: Optional[str] = Field(None, description="Использованная модель")
     error: Optional[str] = Field(None, description="Сообщение об ошибке")
+    cached: bool = Field(False, description="Ответ на похожий вопрос взят из семантического кэша")
+
+
+class SessionCreateRequest(BaseModel):
+    """Модель запроса создания диалога"""
+    model: Optional[str] = Field("moondream:1.8b", description="Название модели Ollama для использования")
+    system: Optional[str] = Field(None, max_length=4000, description="Системное сообщение диалога")
+
+
+class SessionMessageRequest(BaseModel):
+    """Модель сообщения в диалоге"""
+    message: str = Field(..., min_length=1, max_length=4000, description="Текстовое сообщение для модели")
+    temperature: Optional[float] = Field(0.7, ge=0.0, le=2.0, description="Температура генерации")
+
+
+class SessionTurn(BaseModel):
+    """Ход диалога с числом токенов"""
+    message: str = Field(..., description="Сообщение пользователя")
+    reply: str = Field(..., description="Ответ модели")
+    message_tokens: int = Field(..., description="Токенов в сообщении (оценка)")
+    reply_tokens: int = Field(..., description="Токенов в ответе")
+    prompt_eval_count: int = Field(0, description="Токенов промпта, вычисленных моделью на этом ходе")
+
+
+class SessionResponse(BaseModel):
+    """Модель состояния диалога"""
+    session_id: str = Field(..., description="Идентификатор диалога")
+    model: str = Field(..., description="Модель диалога")
+    context_tokens: int = Field(0, description="Токенов в сохраненной истории")
+    dropped_turns: int = Field(0, description="Ходов, отброшенных из-за бюджета токенов")
+    turns: List[SessionTurn] = Field(default_factory=list, description="История диалога")
+
+
+class SessionMessageResponse(BaseModel):
+    """Модель ответа на сообщение в диалоге"""
+    success: bool = Field(..., description="Успешность обработки запроса")
+    session_id: str = Field(..., description="Идентификатор диалога")
+    response: Optional[str] = Field(None, description="Ответ модели")
+    turn: Optional[SessionTurn] = Field(None, description="Ход диалога с числом токенов")
+    context_tokens: int = Field(0, description="Токенов в сохраненной истории")
+    error: Optional[str] = Field(None, description="Сообщение об ошибке")
 
 
 class ErrorResponse(BaseModel):
@@ -0,0 +1,78 @@
+"""
+Роутер административных ручек диагностики (требуют X-Admin-Token)
+"""
+
+import asyncio
+import logging
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import PlainTextResponse
+
+from app.models.receipt import ErrorResponse
+from app.dependencies import get_loop_monitor, get_profiler, require_admin
+from app.services.loop_monitor import LoopLagMonitor
+from app.services.profiler import ProfilerBusy, SamplingProfiler
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(require_admin)],
+    responses={
+        403: {"model": ErrorResponse, "description": "Неверный токен администратора"},
+        404: {"model": ErrorResponse, "description": "ADMIN_TOKEN не задан, ручки выключены"}
+    }
+)
+
+
+@router.get(
+    "/profile",
+    response_class=PlainTextResponse,
+    responses={409: {"model": ErrorResponse, "description": "Профилирование уже выполняется"}},
+    summary="Профилирование процесса",
+    description="Снимает стеки всех потоков процесса в течение duration секунд и возвращает collapsed stacks "
+                "для flamegraph.pl или speedscope. При нескольких воркерах профилируется процесс, принявший запрос"
+)
+async def profile(
+    duration: float = Query(10.0, gt=0, description="Длительность замера, сек (не больше PROFILER_MAX_DURATION)"),
+    interval: float = Query(0.01, gt=0, le=1.0, description="Период снятия стеков, сек"),
+    idle: bool = Query(False, description="Учитывать потоки, ожидающие в select/wait/sleep"),
+    profiler: SamplingProfiler = Depends(get_profiler)
+):
+    """
+    Статистическое профилирование работающего процесса
+
+    Args:
+        duration: Длительность замера
+        interval: Период снятия стеков
+        idle: Учитывать ожидающие потоки
+        profiler: Профилировщик
+
+    Returns:
+        PlainTextResponse: Строки "кадр;кадр;кадр число"
+
+    Raises:
+        HTTPException: Если замер уже выполняется
+    """
+    logger.info(f"Профилирование процесса: {duration}с, период {interval}с")
+    try:
+        # Замер идет в отдельном потоке: event loop продолжает обслуживать запросы
+        counts = await asyncio.to_thread(profiler.profile, duration, interval, idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(profiler.format_collapsed(counts))
+
+
+@router.get(
+    "/event-loop",
+    summary="Задержка event loop",
+    description="Задержка планирования event loop и стек последней блокировки дольше LOOP_BLOCK_THRESHOLD"
+)
+async def event_loop(loop_monitor: LoopLagMonitor = Depends(get_loop_monitor)):
+    """
+    Состояние монитора event loop с полным стеком последней блокировки
+
+    Returns:
+        dict: Задержки, число блокировок и последняя блокировка
+    """
+    return {**loop_monitor.stats(), "last_block": loop_monitor.last_block}
@@ -2,12 +2,16 @@
 Роутер для текстовых запросов к модели
 """
 
+import json
 import logging
-from fastapi import APIRouter, HTTPException, Depends
+from typing import AsyncIterator
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse
 
 from app.models.receipt import TextQueryRequest, TextQueryResponse, ErrorResponse
-from app.dependencies import get_ollama_service
+from app.dependencies import get_ollama_service, get_tenant
 from app.services.ollama_service import OllamaService
+from app.services.tenants import Tenant
 
 logger = logging.getLogger(__name__)
 
@@ -23,14 +27,17 @@ router = APIRouter(
     responses={
         400: {"model": ErrorResponse, "description": "Ошибка в запросе"},
         422: {"model": ErrorResponse, "description": "Ошибка валидации данных"},
-        500: {"model": ErrorResponse, "description": "Внутренняя ошибка сервера"}
+        429: {"model": ErrorResponse, "description": "Очередь запросов к модели заполнена"},
+        500: {"model": ErrorResponse, "description": "Внутренняя ошибка сервера"},
+        503: {"model": ErrorResponse, "description": "Превышено время ожидания в очереди к модели"}
     },
     summary="Текстовый запрос к модели",
     description="Отправляет текстовое сообщение к языковой модели Ollama и возвращает ответ"
 )
 async def query_model(
     request: TextQueryRequest,
-    ollama_service: OllamaService = Depends(get_ollama_service)
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """
     Отправка текстового запроса к языковой модели
@@ -38,6 +45,7 @@ async def query_model(
     Args:
         request: Запрос с текстовым сообщением и параметрами
         ollama_service: Сервис для работы с Ollama
+        tenant: Арендатор по API ключу
         
     Returns:
         TextQueryResponse: Ответ модели с результатом обработки
@@ -49,10 +57,11 @@ async def query_model(
         logger.info(f"Получен текстовый запрос к модели {request.model}: {request.message[:100]}...")
         
         # Отправляем запрос к модели
-        model_response = await ollama_service.query_text(
+        model_response, cached = await ollama_service.query_text_cached(
             message=request.message,
             model=request.model,
-            temperature=request.temperature
+            temperature=request.temperature,
+            tenant=tenant
         )
         
         if model_response is None:
@@ -69,7 +78,8 @@ async def query_model(
             success=True,
             response=model_response,
             model_used=request.model,
-            error=None
+            error=None,
+            cached=cached
         )
         
     except HTTPException:
@@ -81,4 +91,74 @@ async def query_model(
         raise HTTPException(
             status_code=500,
             detail="Внутренняя ошибка сервера при обработке запроса"
-        ) 
\ No newline at end of file
+        ) 
+
+
+def _sse_event(data: dict, event: str = None) -> str:
+    """Форматирует событие Server-Sent Events"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post(
+    "/query/stream",
+    responses={
+        200: {"content": {"text/event-stream": {}}, "description": "Поток токенов в формате SSE"},
+        422: {"model": ErrorResponse, "description": "Ошибка валидации данных"},
+        429: {"model": ErrorResponse, "description": "Очередь запросов к модели заполнена"}
+    },
+    summary="Потоковый текстовый запрос к модели",
+    description="Отправляет текстовое сообщение к модели и возвращает ответ по мере генерации через Server-Sent Events"
+)
+async def query_model_stream(
+    request: TextQueryRequest,
+    http_request: Request,
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Потоковая отправка текстового запроса к языковой модели
+    
+    События: `data: {"token": ...}` для каждого фрагмента, `event: done`
+    по завершении и `event: error` при ошибке. При отключении клиента
+    запрос к Ollama отменяется.
+    
+    Args:
+        request: Запрос с текстовым сообщением и параметрами
+        http_request: HTTP запрос (для отслеживания отключения клиента)
+        ollama_service: Сервис для работы с Ollama
+        tenant: Арендатор по API ключу
+        
+    Returns:
+        StreamingResponse: Поток событий text/event-stream
+    """
+    logger.info(f"Получен потоковый запрос к модели {request.model}: {request.message[:100]}...")
+    
+    # Отказ при переполненной очереди или разомкнутом выключателе нужно вернуть до отправки заголовков потока
+    ollama_service.pool.check(request.model or ollama_service.model)
+    ollama_service.admission.check(tenant)
+    
+    async def event_stream() -> AsyncIterator[str]:
+        tokens = 0
+        try:
+            async for token in ollama_service.stream_text(
+                message=request.message,
+                model=request.model,
+                temperature=request.temperature,
+                tenant=tenant
+            ):
+                if await http_request.is_disconnected():
+                    logger.info("Клиент отключился, потоковый запрос к модели отменен")
+                    return
+                tokens += 1
+                yield _sse_event({"token": token})
+            yield _sse_event({"model_used": request.model, "chunks": tokens}, event="done")
+        except Exception as e:
+            logger.error(f"Ошибка потокового запроса к модели {request.model}: {e}")
+            yield _sse_event({"error": "Не удалось получить ответ от модели"}, event="error")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
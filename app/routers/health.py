@@ -3,10 +3,20 @@
 """
 
 import logging
-from fastapi import APIRouter, Depends
+import os
+from fastapi import APIRouter, Depends, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 
-from app.dependencies import get_ollama_service
+from app.dependencies import (
+    get_ollama_service, get_job_queue, get_conversation_store, get_qr_decoder, get_loop_monitor,
+    get_tenant_registry
+)
+from app.services.conversation_store import ConversationStore
+from app.services.fiscal_qr import FiscalQRDecoder
+from app.services.job_queue import JobQueue
+from app.services.loop_monitor import LoopLagMonitor
 from app.services.ollama_service import OllamaService
+from app.services.tenants import TenantRegistry
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +39,12 @@ async def root():
 
 @router.get("/health")
 async def health_check(
-    ollama_service: OllamaService = Depends(get_ollama_service)
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    job_queue: JobQueue = Depends(get_job_queue),
+    conversation_store: ConversationStore = Depends(get_conversation_store),
+    qr_decoder: FiscalQRDecoder = Depends(get_qr_decoder),
+    loop_monitor: LoopLagMonitor = Depends(get_loop_monitor),
+    tenant_registry: TenantRegistry = Depends(get_tenant_registry)
 ):
     """
     Проверка состояния сервиса и его компонентов
@@ -39,10 +54,11 @@ async def health_check(
     """
     logger.info("Проверка состояния сервиса")
     
-    # Проверка доступности Ollama
+    # Доступность Ollama по фоновым проверкам бэкендов и выключателям
     ollama_status = await ollama_service.health_check()
+    circuits = ollama_service.pool.breakers.stats()
     
-    overall_status = "healthy" if ollama_status else "degraded"
+    overall_status = "healthy" if ollama_status and not ollama_service.pool.breakers.any_open() else "degraded"
     
     return {
         "status": overall_status,
@@ -50,6 +66,33 @@ async def health_check(
             "ollama": "available" if ollama_status else "unavailable",
             "api": "running"
         },
+        "backends": ollama_service.pool.stats(),
+        "circuits": circuits,
+        "models": ollama_service.residency.stats(),
+        "cache": ollama_service.cache.stats(),
+        "near_duplicates": ollama_service.near_duplicates.stats() if ollama_service.near_duplicates else None,
+        "semantic_cache": ollama_service.semantic_cache.stats() if ollama_service.semantic_cache else None,
+        "coalescing": ollama_service.single_flight.stats(),
+        "fiscal_qr": qr_decoder.stats(),
+        "jobs": job_queue.stats(),
+        "sessions": conversation_store.stats(),
+        "admission": ollama_service.admission.stats(),
+        "tenants": tenant_registry.stats(),
+        "retries": ollama_service.vision_retry.stats(),
+        "parsing": ollama_service.parser.stats(),
+        "cpu_pool": ollama_service.cpu_pool.stats(),
+        "event_loop": loop_monitor.stats(),
         "version": "1.0.0",
         "timestamp": "2024-01-01T00:00:00Z"  # В реальном приложении используйте datetime.now()
-    } 
\ No newline at end of file
+    } 
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики в формате Prometheus"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Несколько воркеров: метрики собираются из файлов всех процессов
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,103 @@
+"""
+Роутер для асинхронных задач анализа чеков
+"""
+
+import logging
+from typing import Optional
+from fastapi import APIRouter, File, Form, UploadFile, HTTPException, Depends, Query
+
+from app import config
+from app.models.receipt import JobResponse, ErrorResponse
+from app.dependencies import validate_image, get_image_preprocessor, get_job_queue, get_tenant
+from app.services.image_preprocessor import ImagePreprocessor
+from app.services.job_queue import JobQueue, JOB_QUEUED
+from app.services.tenants import Tenant
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"]
+)
+
+
+@router.post(
+    "/analyze-receipt",
+    response_model=JobResponse,
+    status_code=202,
+    responses={
+        400: {"model": ErrorResponse, "description": "Ошибка в запросе или недопустимый webhook_url"}
+    },
+    summary="Постановка чека в очередь на анализ",
+    description="Принимает изображение чека и сразу возвращает идентификатор задачи; результат доступен через GET /jobs/{job_id}"
+)
+async def submit_receipt_job(
+    image: UploadFile = File(..., description="Изображение чека для анализа"),
+    webhook_url: Optional[str] = Form(None, description="URL для POST уведомления с результатом"),
+    job_queue: JobQueue = Depends(get_job_queue),
+    preprocessor: ImagePreprocessor = Depends(get_image_preprocessor),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Постановка задачи анализа чека в очередь
+    
+    Args:
+        image: Файл изображения чека (JPEG, PNG, WebP)
+        webhook_url: URL, на который будет отправлен результат
+        job_queue: Очередь задач
+        preprocessor: Предобработчик изображений
+        tenant: Арендатор по API ключу
+        
+    Returns:
+        JobResponse: Идентификатор задачи со статусом queued
+        
+    Raises:
+        HTTPException: При ошибке валидации изображения или недопустимом webhook_url
+    """
+    logger.info(f"Получена задача на анализ чека: {image.filename}")
+    
+    if webhook_url:
+        await job_queue.check_webhook(webhook_url)
+    image_bytes = await validate_image(image)
+    prepared = await preprocessor.process_async(image_bytes)
+    job_id = await job_queue.submit(prepared.data, webhook_url, tenant=tenant.name)
+    
+    return JobResponse(job_id=job_id, status=JOB_QUEUED)
+
+
+@router.get(
+    "/{job_id}",
+    response_model=JobResponse,
+    responses={
+        404: {"model": ErrorResponse, "description": "Задача не найдена"}
+    },
+    summary="Состояние задачи анализа чека",
+    description="Возвращает статус задачи и результат анализа после завершения. Параметр wait включает long-poll"
+)
+async def get_receipt_job(
+    job_id: str,
+    wait: float = Query(0.0, ge=0.0, description="Сколько секунд ждать завершения задачи (long-poll)"),
+    job_queue: JobQueue = Depends(get_job_queue),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Получение состояния задачи
+    
+    Args:
+        job_id: Идентификатор задачи
+        wait: Время ожидания завершения в секундах
+        job_queue: Очередь задач
+        tenant: Арендатор по API ключу
+        
+    Returns:
+        JobResponse: Статус задачи и результат, если он готов
+        
+    Raises:
+        HTTPException: Если задача не найдена
+    """
+    job = await job_queue.get(job_id, wait=min(wait, config.JOB_MAX_WAIT), tenant=tenant.name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    
+    status, result = job
+    return JobResponse(job_id=job_id, status=status, result=result)
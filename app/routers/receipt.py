@@ -2,13 +2,26 @@
 Роутер для анализа чеков
 """
 
+import asyncio
 import logging
-from typing import Optional
-from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
+import zipfile
+from typing import AsyncIterator, BinaryIO, List, Optional, Tuple
+from fastapi import APIRouter, File, UploadFile, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
 
-from app.models.receipt import ReceiptAnalysisResponse, ErrorResponse
-from app.dependencies import validate_image, get_ollama_service
+from app import config
+from app.metrics import observe_stage
+from app.models.receipt import ReceiptAnalysisResponse, BatchReceiptItem, ErrorResponse, FiscalData, ReceiptData
+from app.dependencies import (
+    validate_image, read_upload, check_image_content, get_ollama_service, get_image_preprocessor,
+    get_qr_decoder, get_tenant, MAX_FILE_SIZE
+)
+from app.services.admission import AdmissionRejected
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.fiscal_qr import FiscalQRDecoder
+from app.services.image_preprocessor import ImagePreprocessor, PreprocessedImage
 from app.services.ollama_service import OllamaService
+from app.services.tenants import Tenant
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +30,12 @@ router = APIRouter(
     tags=["receipt"]
 )
 
+# Источники полей ответа
+SOURCE_QR = "qr"
+SOURCE_MODEL = "model"
+SOURCE_NONE = "none"
+MODEL_SOURCES = {"store_name": SOURCE_MODEL, "total_amount": SOURCE_MODEL, "currency": SOURCE_MODEL}
+
 
 @router.post(
     "/analyze-receipt", 
@@ -24,21 +43,38 @@ router = APIRouter(
     responses={
         400: {"model": ErrorResponse, "description": "Ошибка в запросе"},
         422: {"model": ErrorResponse, "description": "Не удалось распознать данные"},
-        500: {"model": ErrorResponse, "description": "Внутренняя ошибка сервера"}
+        429: {"model": ErrorResponse, "description": "Очередь запросов к модели заполнена"},
+        500: {"model": ErrorResponse, "description": "Внутренняя ошибка сервера"},
+        503: {"model": ErrorResponse, "description": "Превышено время ожидания в очереди к модели"}
     },
     summary="Анализ чека",
-    description="Анализирует изображение чека и извлекает название магазина, сумму покупки и валюту"
+    description=(
+        "Анализирует изображение чека и извлекает название магазина, сумму покупки и валюту. "
+        "Если на чеке распознан фискальный QR код ФНС, сумма берется из него, "
+        "а у модели запрашивается только название магазина"
+    )
 )
 async def analyze_receipt(
     image: UploadFile = File(..., description="Изображение чека для анализа"),
-    ollama_service: OllamaService = Depends(get_ollama_service)
+    store_name: bool = Query(
+        config.FISCAL_QR_STORE_NAME,
+        description="Для чека с фискальным QR кодом запрашивать у модели название магазина"
+    ),
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    preprocessor: ImagePreprocessor = Depends(get_image_preprocessor),
+    qr_decoder: FiscalQRDecoder = Depends(get_qr_decoder),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """
     Анализ чека и извлечение данных
     
     Args:
         image: Файл изображения чека (JPEG, PNG, WebP)
+        store_name: Запрашивать название магазина, если сумма взята из QR кода
         ollama_service: Сервис для работы с Ollama
+        preprocessor: Предобработчик изображений
+        qr_decoder: Декодер фискальных QR кодов
+        tenant: Арендатор по API ключу
         
     Returns:
         ReceiptAnalysisResponse: Результат анализа с извлеченными данными
@@ -50,25 +86,45 @@ async def analyze_receipt(
         logger.info(f"Получен запрос на анализ чека: {image.filename}")
         
         # Валидация изображения
-        image_bytes = await validate_image(image)
+        with observe_stage("validation"):
+            image_bytes = await validate_image(image)
         logger.info(f"Изображение прошло валидацию, размер: {len(image_bytes)} байт")
         
+        # Фискальный QR код ищется на исходном изображении: после уменьшения модули сливаются
+        with observe_stage("qr_decode"):
+            fiscal = await qr_decoder.decode(image_bytes)
+        if fiscal is not None:
+            return await _analyze_fiscal_receipt(
+                image_bytes, fiscal, store_name, ollama_service, preprocessor, tenant
+            )
+        
+        # Уменьшение изображения перед отправкой в модель
+        with observe_stage("image_decode"):
+            prepared = await preprocessor.process_async(image_bytes)
+        image_bytes = prepared.data
+        
         # Анализ с помощью Ollama
-        receipt_data = await ollama_service.analyze_receipt(image_bytes)
+        receipt_data, cached, duplicate = await ollama_service.analyze_receipt_cached(
+            image_bytes, phash=prepared.phash, tenant=tenant
+        )
         
         if receipt_data is None:
             logger.warning("Ollama не смог проанализировать чек")
             return ReceiptAnalysisResponse(
                 success=False,
                 data=None,
-                error="Не удалось распознать данные чека. Попробуйте загрузить более четкое изображение."
+                error="Не удалось распознать данные чека. Попробуйте загрузить более четкое изображение.",
+                duplicate=duplicate
             )
         
         logger.info(f"Анализ завершен успешно: {receipt_data}")
         return ReceiptAnalysisResponse(
             success=True,
             data=receipt_data,
-            error=None
+            error=None,
+            cached=cached,
+            duplicate=duplicate,
+            sources=MODEL_SOURCES
         )
         
     except HTTPException:
@@ -82,4 +138,185 @@ async def analyze_receipt(
             detail="Внутренняя ошибка сервера при обработке запроса"
         )
 
- 
\ No newline at end of file
+
+async def _analyze_fiscal_receipt(
+    image_bytes: bytes,
+    fiscal: FiscalData,
+    with_store_name: bool,
+    ollama_service: OllamaService,
+    preprocessor: ImagePreprocessor,
+    tenant: Optional[Tenant] = None
+) -> ReceiptAnalysisResponse:
+    """
+    Ответ для чека с фискальным QR кодом: сумма и валюта из кода
+    
+    Название магазина запрашивается у модели, только если оно нужно. Если
+    модель недоступна или не ответила, возвращается сумма из кода без названия.
+    """
+    sources = {"store_name": SOURCE_NONE, "total_amount": SOURCE_QR, "currency": SOURCE_QR}
+    receipt_data, cached = None, False
+    if with_store_name:
+        with observe_stage("image_decode"):
+            prepared = await preprocessor.process_async(image_bytes)
+        try:
+            receipt_data, cached = await ollama_service.analyze_fiscal_receipt(prepared.data, fiscal, tenant=tenant)
+        except (AdmissionRejected, CircuitOpenError) as e:
+            logger.warning(f"Название магазина не запрошено, модель недоступна: {e.detail}")
+    
+    if receipt_data is not None:
+        sources["store_name"] = SOURCE_MODEL
+    else:
+        receipt_data = ReceiptData(store_name="", total_amount=fiscal.total_amount, currency="RUB")
+    
+    logger.info(f"Чек распознан по фискальному QR коду: {receipt_data}")
+    return ReceiptAnalysisResponse(
+        success=True,
+        data=receipt_data,
+        error=None,
+        cached=cached,
+        sources=sources,
+        fiscal=fiscal
+    )
+
+
+# Элемент пакета: (имя файла, байты или None, ошибка или None)
+BatchEntry = Tuple[Optional[str], Optional[bytes], Optional[str]]
+
+
+def _read_zip_entries(archive: BinaryIO, max_items: int) -> List[BatchEntry]:
+    """
+    Извлекает изображения из ZIP архива (выполняется в пуле потоков)
+    
+    Число файлов и их размер после распаковки проверяются по оглавлению
+    архива до распаковки: маленький архив может содержать тысячи файлов.
+    
+    Args:
+        archive: Файл ZIP архива
+        max_items: Сколько файлов еще помещается в пакет
+        
+    Raises:
+        HTTPException: Архив поврежден, в нем слишком много файлов или они слишком велики
+    """
+    entries = []
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            infos = [info for info in zf.infolist() if not info.is_dir()]
+            if len(infos) > max_items:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Слишком много изображений в пакете. Максимум: {config.BATCH_MAX_ITEMS}"
+                )
+            # Файлы больше MAX_FILE_SIZE не распаковываются и в сумму не входят
+            total_size = sum(info.file_size for info in infos if info.file_size <= MAX_FILE_SIZE)
+            if total_size > config.BATCH_MAX_UNCOMPRESSED_SIZE:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Слишком большой архив после распаковки. Максимум: "
+                           f"{config.BATCH_MAX_UNCOMPRESSED_SIZE // (1024*1024)}MB"
+                )
+            for info in infos:
+                if info.file_size > MAX_FILE_SIZE:
+                    entries.append((info.filename, None, "Файл слишком большой"))
+                    continue
+                entries.append((info.filename, zf.read(info), None))
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Поврежденный ZIP архив")
+    return entries
+
+
+@router.post(
+    "/analyze-receipts/batch",
+    responses={
+        200: {"content": {"application/x-ndjson": {}}, "description": "Поток результатов BatchReceiptItem в формате NDJSON"},
+        400: {"model": ErrorResponse, "description": "Ошибка в запросе"}
+    },
+    summary="Пакетный анализ чеков",
+    description="Анализирует несколько изображений чеков (multipart или ZIP архив) и возвращает результаты построчно в формате NDJSON"
+)
+async def analyze_receipts_batch(
+    images: List[UploadFile] = File([], description="Изображения чеков"),
+    archive: Optional[UploadFile] = File(None, description="ZIP архив с изображениями чеков"),
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    preprocessor: ImagePreprocessor = Depends(get_image_preprocessor),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Пакетный анализ чеков
+    
+    Изображения валидируются и предобрабатываются параллельно, затем
+    передаются в Ollama с ограничением параллелизма. Каждая строка ответа -
+    BatchReceiptItem; строки идут в порядке загрузки по мере готовности.
+    
+    Args:
+        images: Файлы изображений чеков
+        archive: ZIP архив с изображениями
+        ollama_service: Сервис для работы с Ollama
+        preprocessor: Предобработчик изображений
+        tenant: Арендатор по API ключу
+        
+    Returns:
+        StreamingResponse: Поток результатов application/x-ndjson
+        
+    Raises:
+        HTTPException: Если пакет пуст, слишком велик или архив поврежден
+    """
+    entries: List[BatchEntry] = []
+    for image in images:
+        try:
+            entries.append((image.filename, await read_upload(image), None))
+        except HTTPException as e:
+            entries.append((image.filename, None, e.detail))
+    if archive is not None:
+        entries.extend(
+            await asyncio.to_thread(_read_zip_entries, archive.file, config.BATCH_MAX_ITEMS - len(entries))
+        )
+    
+    if not entries:
+        raise HTTPException(status_code=400, detail="Не передано ни одного изображения")
+    if len(entries) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много изображений в пакете. Максимум: {config.BATCH_MAX_ITEMS}"
+        )
+    
+    logger.info(f"Получен пакет из {len(entries)} изображений")
+    
+    async def prepare(entry: BatchEntry) -> Tuple[Optional[PreprocessedImage], Optional[str]]:
+        filename, content, error = entry
+        if error is not None:
+            return None, error
+        try:
+            await check_image_content(content)
+        except HTTPException as e:
+            return None, e.detail
+        return await preprocessor.process_async(content), None
+    
+    prepared = await asyncio.gather(*(prepare(entry) for entry in entries))
+    
+    async def item_stream() -> AsyncIterator[str]:
+        valid_images = [image for image, error in prepared if error is None]
+        results = ollama_service.analyze_receipts(
+            [image.data for image in valid_images],
+            phashes=[image.phash for image in valid_images],
+            tenant=tenant
+        )
+        try:
+            for index, ((filename, _, _), (_, error)) in enumerate(zip(entries, prepared)):
+                if error is not None:
+                    item = BatchReceiptItem(index=index, filename=filename, success=False, error=error)
+                else:
+                    _, receipt_data, cached, duplicate = await anext(results)
+                    item = BatchReceiptItem(
+                        index=index,
+                        filename=filename,
+                        success=receipt_data is not None,
+                        data=receipt_data,
+                        error=None if receipt_data is not None else "Не удалось распознать данные чека",
+                        cached=cached,
+                        duplicate=duplicate
+                    )
+                yield item.model_dump_json() + "\n"
+        finally:
+            await results.aclose()
+    
+    return StreamingResponse(item_stream(), media_type="application/x-ndjson")
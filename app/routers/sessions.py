@@ -0,0 +1,189 @@
+"""
+Роутер для диалогов с моделью с хранением истории на сервере
+"""
+
+import logging
+from dataclasses import asdict
+from fastapi import APIRouter, HTTPException, Depends
+
+from app.models.receipt import (
+    SessionCreateRequest, SessionMessageRequest, SessionMessageResponse, SessionResponse, SessionTurn, ErrorResponse
+)
+from app.dependencies import get_ollama_service, get_conversation_store, get_tenant
+from app.services.conversation_store import Conversation, ConversationStore, Turn
+from app.services.ollama_service import OllamaService
+from app.services.tenants import Tenant
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/sessions",
+    tags=["Chat"]
+)
+
+
+def _turn_model(turn: Turn) -> SessionTurn:
+    data = asdict(turn)
+    data.pop("created")
+    return SessionTurn(**data)
+
+
+def _session_response(conversation: Conversation) -> SessionResponse:
+    return SessionResponse(
+        session_id=conversation.session_id,
+        model=conversation.model,
+        context_tokens=conversation.context_tokens,
+        dropped_turns=conversation.dropped_turns,
+        turns=[_turn_model(turn) for turn in conversation.turns]
+    )
+
+
+def _get_or_404(store: ConversationStore, session_id: str, tenant: Tenant) -> Conversation:
+    # Диалог другого арендатора неотличим от несуществующего
+    conversation = store.get(session_id, tenant=tenant.name)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Диалог не найден или истек")
+    return conversation
+
+
+@router.post(
+    "",
+    response_model=SessionResponse,
+    status_code=201,
+    summary="Создание диалога",
+    description="Создает диалог; история хранится на сервере и удаляется после SESSION_TTL без обращений"
+)
+async def create_session(
+    request: SessionCreateRequest,
+    store: ConversationStore = Depends(get_conversation_store),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Создание диалога с моделью
+
+    Args:
+        request: Модель и системное сообщение
+        store: Хранилище диалогов
+        tenant: Арендатор по API ключу, владелец диалога
+
+    Returns:
+        SessionResponse: Идентификатор нового диалога
+    """
+    conversation = store.create(model=request.model, system=request.system, tenant=tenant.name)
+    logger.info(f"Создан диалог {conversation.session_id} с моделью {conversation.model}")
+    return _session_response(conversation)
+
+
+@router.post(
+    "/{session_id}/messages",
+    response_model=SessionMessageResponse,
+    responses={
+        404: {"model": ErrorResponse, "description": "Диалог не найден или истек"},
+        429: {"model": ErrorResponse, "description": "Очередь запросов к модели заполнена"},
+        503: {"model": ErrorResponse, "description": "Превышено время ожидания в очереди к модели"}
+    },
+    summary="Сообщение в диалоге",
+    description="Отправляет сообщение с историей диалога через /api/chat; префикс истории переиспользуется из KV кэша Ollama"
+)
+async def send_message(
+    session_id: str,
+    request: SessionMessageRequest,
+    ollama_service: OllamaService = Depends(get_ollama_service),
+    store: ConversationStore = Depends(get_conversation_store),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Очередной ход диалога
+
+    Args:
+        session_id: Идентификатор диалога
+        request: Сообщение и температура
+        ollama_service: Сервис для работы с Ollama
+        store: Хранилище диалогов
+        tenant: Арендатор по API ключу
+
+    Returns:
+        SessionMessageResponse: Ответ модели и число токенов хода
+
+    Raises:
+        HTTPException: Если диалог не найден
+    """
+    conversation = _get_or_404(store, session_id, tenant)
+    turn = await ollama_service.chat(
+        conversation,
+        request.message,
+        temperature=request.temperature,
+        token_budget=store.token_budget,
+        tenant=tenant
+    )
+
+    if turn is None:
+        logger.warning(f"Модель {conversation.model} не смогла ответить в диалоге {session_id}")
+        return SessionMessageResponse(
+            success=False,
+            session_id=session_id,
+            context_tokens=conversation.context_tokens,
+            error="Не удалось получить ответ от модели. Проверьте доступность модели или попробуйте позже."
+        )
+
+    return SessionMessageResponse(
+        success=True,
+        session_id=session_id,
+        response=turn.reply,
+        turn=_turn_model(turn),
+        context_tokens=conversation.context_tokens
+    )
+
+
+@router.get(
+    "/{session_id}",
+    response_model=SessionResponse,
+    responses={404: {"model": ErrorResponse, "description": "Диалог не найден или истек"}},
+    summary="История диалога"
+)
+async def get_session(
+    session_id: str,
+    store: ConversationStore = Depends(get_conversation_store),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    История диалога с числом токенов по ходам
+
+    Args:
+        session_id: Идентификатор диалога
+        store: Хранилище диалогов
+        tenant: Арендатор по API ключу
+
+    Returns:
+        SessionResponse: Состояние диалога
+
+    Raises:
+        HTTPException: Если диалог не найден
+    """
+    return _session_response(_get_or_404(store, session_id, tenant))
+
+
+@router.delete(
+    "/{session_id}",
+    status_code=204,
+    responses={404: {"model": ErrorResponse, "description": "Диалог не найден или истек"}},
+    summary="Удаление диалога"
+)
+async def delete_session(
+    session_id: str,
+    store: ConversationStore = Depends(get_conversation_store),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Удаление диалога
+
+    Args:
+        session_id: Идентификатор диалога
+        store: Хранилище диалогов
+        tenant: Арендатор по API ключу
+
+    Raises:
+        HTTPException: Если диалог не найден
+    """
+    if not store.delete(session_id, tenant=tenant.name):
+        raise HTTPException(status_code=404, detail="Диалог не найден или истек")
@@ -0,0 +1,309 @@
+"""
+Контроль допуска запросов к Ollama (admission control)
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app import metrics
+from app.services.tenants import DEFAULT_TENANT, PRIORITY_BULK, PRIORITY_INTERACTIVE, Tenant
+
+logger = logging.getLogger(__name__)
+
+# Имя глобального пула слотов к Ollama в общем состоянии
+GLOBAL_SLOTS = "ollama"
+
+
+class AdmissionRejected(HTTPException):
+    """Запрос отклонен из-за перегрузки; клиенту сообщается Retry-After"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)}
+        )
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    """Запрос в очереди допуска"""
+    future: asyncio.Future
+    tenant: str
+    priority: str
+    queued: bool = True  # False после выхода из очереди; запись в куче удаляется лениво
+
+
+@dataclass
+class TenantQueueStats:
+    """Очередь и ожидание одного арендатора"""
+    weight: float = 1.0
+    queued: int = 0
+    in_flight: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    wait_avg: float = 0.0  # EWMA ожидания допуска, сек
+    wait_max: float = 0.0
+
+
+# Арендатор вызовов без API ключа и внутренних вызовов
+_DEFAULT = Tenant(DEFAULT_TENANT)
+
+
+class AdmissionController:
+    """
+    Ограничивает число одновременных запросов к Ollama
+
+    Не больше max_in_flight запросов выполняются одновременно, остальные
+    ждут в очереди не дольше queue_timeout. Очередь у каждого арендатора
+    своя, длиной до max_queue (или max_queue арендатора). При
+    переполнении очереди запрос сразу отклоняется с 429, по истечении
+    времени ожидания - с 503. Фоновые (bulk) вызовы ждут без ограничений:
+    они уже ограничены своими воркерами и не должны получать отказ.
+
+    Освободившийся слот получает интерактивный запрос, а фоновый - только
+    если интерактивных нет. Внутри класса приоритета слоты делятся между
+    арендаторами пропорционально весу (weighted fair queuing): запрос
+    получает метку завершения max(V, метка прошлого запроса арендатора)
+    + 1 / вес, и первым обслуживается запрос с наименьшей меткой, а V -
+    метка последнего допущенного запроса. Арендатор с весом 3 получает
+    втрое больше слотов, чем с весом 1, пока оба ждут, а простаивавший
+    арендатор не накапливает запас.
+
+    С общим состоянием (shared) лимит max_in_flight действует на все
+    процессы сервиса: получив локальный слот, запрос дополнительно
+    арендует глобальный слот и ждет его в пределах того же дедлайна.
+    Аренда истекает через lease_ttl, если процесс упал, не вернув слот.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 1,
+        max_queue: int = 16,
+        queue_timeout: float = 30.0,
+        shared=None,
+        lease_ttl: float = 600.0
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.shared = shared
+        self.lease_ttl = lease_ttl
+        self.global_waiting = 0
+        self.in_flight = 0
+        self.queue_depth = 0
+        # Кучи (метка завершения, порядковый номер, ожидающий) по классам приоритета
+        self._queues: Dict[str, List[Tuple[float, int, _Waiter]]] = {PRIORITY_INTERACTIVE: [], PRIORITY_BULK: []}
+        self._virtual_time = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BULK: 0.0}
+        self._last_finish: Dict[Tuple[str, str], float] = {}
+        self._sequence = itertools.count()
+        self.tenants: Dict[str, TenantQueueStats] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self._service_time = 5.0  # EWMA времени выполнения запроса, сек
+
+    @asynccontextmanager
+    async def slot(self, bulk: bool = False, tenant: Optional[Tenant] = None) -> AsyncIterator[None]:
+        """
+        Занимает слот на время выполнения запроса к Ollama
+
+        Args:
+            bulk: Фоновый вызов - ждать без лимита очереди и дедлайна
+            tenant: Арендатор запроса; без него - default
+
+        Raises:
+            AdmissionRejected: Очередь переполнена или истек дедлайн ожидания
+        """
+        tenant = tenant or _DEFAULT
+        priority = PRIORITY_BULK if bulk or tenant.priority == PRIORITY_BULK else PRIORITY_INTERACTIVE
+        self._tenant(tenant.name).weight = tenant.weight
+        start = time.monotonic()
+        await self._acquire(bulk, tenant, priority)
+        lease, started = None, None
+        try:
+            if self.shared is not None:
+                lease = await self._acquire_global(bulk, start + self.queue_timeout, tenant)
+            started = time.monotonic()
+            yield
+        finally:
+            if started is not None:
+                elapsed = time.monotonic() - started
+                self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+            self._tenant(tenant.name).in_flight -= 1
+            try:
+                if lease is not None:
+                    await asyncio.to_thread(self.shared.release_lease, GLOBAL_SLOTS, lease)
+            finally:
+                self._release()
+
+    def check(self, tenant: Optional[Tenant] = None) -> None:
+        """
+        Быстрая проверка без занятия слота: отклоняет запрос, если очередь арендатора заполнена
+
+        Raises:
+            AdmissionRejected: Очередь переполнена
+        """
+        tenant = tenant or _DEFAULT
+        limit = tenant.max_queue if tenant.max_queue is not None else self.max_queue
+        if self._tenant(tenant.name).queued >= limit and self.in_flight >= self.max_in_flight:
+            self._reject("queue_full", tenant.name)
+            raise AdmissionRejected(
+                429,
+                "Сервис перегружен: очередь запросов к модели заполнена. Повторите позже.",
+                self.retry_after(tenant)
+            )
+
+    async def _acquire(self, bulk: bool, tenant: Tenant, priority: str) -> None:
+        if self.in_flight < self.max_in_flight and not self.queue_depth:
+            self.in_flight += 1
+            self._admit(tenant.name, priority, 0.0)
+            return
+
+        if not bulk:
+            self.check(tenant)
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tenant.name, priority)
+        heapq.heappush(self._queues[priority], (self._finish_tag(tenant, priority), next(self._sequence), waiter))
+        self._enqueued(waiter, 1)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, timeout=None if bulk else self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject("queue_timeout", tenant.name)
+            raise AdmissionRejected(
+                503,
+                "Сервис перегружен: превышено время ожидания в очереди к модели. Повторите позже.",
+                self.retry_after(tenant)
+            )
+        except BaseException:
+            # Слот мог быть передан в момент отмены - возвращаем его
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()
+            raise
+        finally:
+            if waiter.queued:
+                self._enqueued(waiter, -1)
+        self._admit(tenant.name, priority, time.monotonic() - start)
+
+    def _finish_tag(self, tenant: Tenant, priority: str) -> float:
+        """Метка завершения запроса арендатора в виртуальном времени класса"""
+        key = (priority, tenant.name)
+        finish = max(self._virtual_time[priority], self._last_finish.get(key, 0.0)) + 1.0 / tenant.weight
+        self._last_finish[key] = finish
+        return finish
+
+    def _enqueued(self, waiter: _Waiter, delta: int) -> None:
+        waiter.queued = delta > 0
+        self.queue_depth += delta
+        stats = self._tenant(waiter.tenant)
+        stats.queued += delta
+        metrics.ADMISSION_QUEUE_DEPTH.set(self.queue_depth)
+        metrics.TENANT_QUEUE_DEPTH.labels(tenant=waiter.tenant).set(stats.queued)
+
+    def _tenant(self, name: str) -> TenantQueueStats:
+        stats = self.tenants.get(name)
+        if stats is None:
+            stats = self.tenants[name] = TenantQueueStats()
+        return stats
+
+    async def _acquire_global(self, bulk: bool, deadline: float, tenant: Tenant) -> str:
+        # Другие процессы не будят ожидающих, поэтому слот опрашивается с растущей паузой
+        delay = 0.02
+        self.global_waiting += 1
+        try:
+            while True:
+                lease = await asyncio.to_thread(
+                    self.shared.acquire_lease, GLOBAL_SLOTS, self.max_in_flight, self.lease_ttl
+                )
+                if lease is not None:
+                    return lease
+                if not bulk and time.monotonic() + delay > deadline:
+                    self._reject("global_timeout", tenant.name)
+                    raise AdmissionRejected(
+                        503,
+                        "Сервис перегружен: превышено время ожидания в очереди к модели. Повторите позже.",
+                        self.retry_after(tenant)
+                    )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        finally:
+            self.global_waiting -= 1
+
+    def _release(self) -> None:
+        # Слот передается ожидающему с наименьшей меткой без уменьшения in_flight:
+        # сначала интерактивным запросам, затем фоновым
+        for priority, queue in self._queues.items():
+            while queue:
+                finish, _, waiter = heapq.heappop(queue)
+                if not waiter.queued:
+                    continue
+                self._enqueued(waiter, -1)
+                if waiter.future.done():
+                    continue
+                self._virtual_time[priority] = finish
+                waiter.future.set_result(None)
+                return
+        self.in_flight -= 1
+        metrics.ADMISSION_IN_FLIGHT.set(self.in_flight)
+
+    def _admit(self, tenant: str, priority: str, waited: float) -> None:
+        self.admitted += 1
+        stats = self._tenant(tenant)
+        stats.admitted += 1
+        stats.in_flight += 1
+        stats.wait_avg = 0.8 * stats.wait_avg + 0.2 * waited
+        stats.wait_max = max(stats.wait_max, waited)
+        metrics.ADMISSION_IN_FLIGHT.set(self.in_flight)
+        metrics.ADMISSION_WAIT.observe(waited)
+        metrics.TENANT_WAIT.labels(tenant=tenant, priority=priority).observe(waited)
+
+    def _reject(self, reason: str, tenant: str) -> None:
+        self.rejected += 1
+        self._tenant(tenant).rejected += 1
+        metrics.ADMISSION_REJECTED.labels(reason=reason).inc()
+        logger.warning(
+            f"Запрос к модели отклонен ({reason}), арендатор {tenant}, в очереди: {self.queue_depth}"
+        )
+
+    def retry_after(self, tenant: Optional[Tenant] = None) -> int:
+        """Оценка, через сколько секунд очередь арендатора успеет продвинуться"""
+        tenant = tenant or _DEFAULT
+        backlog = self._tenant(tenant.name).queued + 1
+        # Доля слотов арендатора среди тех, у кого есть очередь
+        others = sum(stats.weight for name, stats in self.tenants.items() if stats.queued and name != tenant.name)
+        share = tenant.weight / (tenant.weight + others)
+        return max(1, math.ceil(self._service_time * backlog / (self.max_in_flight * share)))
+
+    def stats(self) -> Dict[str, float]:
+        """Состояние очереди допуска"""
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "global_waiting": self.global_waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "tenants": {
+                name: {
+                    "weight": stats.weight,
+                    "queued": stats.queued,
+                    "in_flight": stats.in_flight,
+                    "admitted": stats.admitted,
+                    "rejected": stats.rejected,
+                    "wait_avg": round(stats.wait_avg, 4),
+                    "wait_max": round(stats.wait_max, 4)
+                }
+                for name, stats in self.tenants.items()
+            }
+        }
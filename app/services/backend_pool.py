@@ -0,0 +1,295 @@
+"""
+Пул бэкендов Ollama с маршрутизацией по нагрузке и проверкой здоровья
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Set
+
+import httpx
+
+from app import metrics
+from app.services.circuit_breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError, STATE_OPEN
+
+logger = logging.getLogger(__name__)
+
+ROUTING_LEAST_OUTSTANDING = "least_outstanding"
+ROUTING_EWMA = "ewma"
+
+# Общий выключатель для моделей, которых нет ни в настройках, ни на бэкендах
+UNKNOWN_MODEL = "model:*"
+
+
+def _model_names(models: List[Dict[str, Any]]) -> Set[str]:
+    """Имена моделей из /api/tags; модель с тегом latest доступна и по имени без тега"""
+    names = set()
+    for model in models:
+        name = model.get("name") or model.get("model")
+        if name:
+            names.add(name)
+            if name.endswith(":latest"):
+                names.add(name[:-len(":latest")])
+    return names
+
+
+class OllamaBackend:
+    """Один экземпляр Ollama: HTTP клиент, нагрузка, задержка и загруженные модели"""
+
+    def __init__(self, base_url: str, limits: httpx.Limits, timeout: httpx.Timeout):
+        self.base_url = base_url
+        self.limits = limits
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.loaded_models: Set[str] = set()
+        self.installed_models: Set[str] = set()  # модели из /api/tags
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """HTTP клиент бэкенда; создается лениво"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def record_success(self, model: Optional[str], elapsed: float) -> None:
+        self.latency_ewma = elapsed if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * elapsed
+        if model:
+            # Ollama оставляет модель в памяти после запроса
+            self.loaded_models.add(model)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "loaded_models": sorted(self.loaded_models)
+        }
+
+
+class BackendPool:
+    """
+    Маршрутизирует запросы между несколькими бэкендами Ollama
+
+    Выбор бэкенда: сначала те, где нужная модель уже загружена (по /api/ps),
+    затем по наименьшему числу запросов в работе или по EWMA задержки.
+    Фоновая проверка исключает неотвечающие бэкенды и возвращает
+    восстановившиеся. Ошибки и медленные ответы реальных запросов считают
+    выключатели каждого бэкенда и каждой модели: разомкнутый выключатель
+    бэкенда убирает его из маршрутизации, разомкнутый выключатель модели
+    (или всех бэкендов) сразу отклоняет запрос с 503.
+
+    Выключатель модели заводится только для моделей из настроек сервиса
+    и из /api/tags бэкендов: имя модели приходит от клиента, и выключатели
+    (и серии метрики circuit_breaker_state) для произвольных имен росли бы
+    без ограничения. Остальные имена делят один выключатель UNKNOWN_MODEL.
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        limits: httpx.Limits,
+        timeout: httpx.Timeout,
+        routing: str = ROUTING_LEAST_OUTSTANDING,
+        probe_interval: float = 10.0,
+        probe_timeout: float = 5.0,
+        breakers: Optional[CircuitBreakers] = None,
+        models: Sequence[str] = ()
+    ):
+        self.backends = [OllamaBackend(url, limits, timeout) for url in base_urls]
+        self.breakers = breakers or CircuitBreakers()
+        self.models = set(models)
+        self.routing = routing
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._probe_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Запускает фоновую проверку бэкендов"""
+        await self.probe_all()
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+        logger.info(f"Пул Ollama: {', '.join(b.base_url for b in self.backends)} (маршрутизация: {self.routing})")
+
+    async def stop(self) -> None:
+        """Останавливает проверки и закрывает соединения"""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+        for backend in self.backends:
+            await backend.close()
+
+    def backend_breaker(self, backend: OllamaBackend) -> CircuitBreaker:
+        return self.breakers.get(f"backend:{backend.base_url}")
+
+    def known_model(self, model: str) -> bool:
+        """Модель из настроек или установленная хотя бы на одном бэкенде"""
+        return model in self.models or any(
+            model in backend.installed_models or model in backend.loaded_models for backend in self.backends
+        )
+
+    def model_breaker(self, model: str) -> CircuitBreaker:
+        return self.breakers.get(f"model:{model}" if self.known_model(model) else UNKNOWN_MODEL)
+
+    def check(self, model: Optional[str] = None) -> None:
+        """
+        Быстрая проверка до постановки в очередь: не занимает пробных разрешений
+
+        Raises:
+            CircuitOpenError: Выключатель модели или всех бэкендов разомкнут
+        """
+        if model:
+            breaker = self.model_breaker(model)
+            if breaker.state == STATE_OPEN:
+                metrics.CIRCUIT_REJECTED.labels(name=breaker.name).inc()
+                raise CircuitOpenError(model, breaker.retry_after())
+        breakers = [self.backend_breaker(b) for b in self.backends]
+        if all(b.state == STATE_OPEN for b in breakers):
+            metrics.CIRCUIT_REJECTED.labels(name="backends").inc()
+            raise CircuitOpenError("все бэкенды Ollama", min(b.retry_after() for b in breakers))
+
+    def select(self, model: Optional[str] = None, prefer: Optional[str] = None) -> OllamaBackend:
+        """
+        Выбирает бэкенд для запроса и занимает разрешение его выключателя
+
+        Args:
+            model: Требуемая модель
+            prefer: Адрес предпочтительного бэкенда (например, где лежит KV кэш диалога)
+
+        Returns:
+            OllamaBackend: Выбранный бэкенд; если здоровых по проверке нет - любой
+            с замкнутым выключателем (fail open)
+
+        Raises:
+            CircuitOpenError: Выключатели всех бэкендов разомкнуты
+        """
+        healthy = [b for b in self.backends if b.healthy] or self.backends
+
+        def score(backend: OllamaBackend):
+            cold = model is not None and model not in backend.loaded_models
+            if self.routing == ROUTING_EWMA:
+                # Бэкенды без замеров пробуются первыми
+                load = (backend.latency_ewma or 0.0) * (backend.outstanding + 1)
+            else:
+                load = backend.outstanding
+            return backend.base_url != prefer, cold, load
+
+        for backend in sorted(healthy, key=score):
+            if self.backend_breaker(backend).acquire():
+                return backend
+
+        breakers = [self.backend_breaker(b) for b in healthy]
+        metrics.CIRCUIT_REJECTED.labels(name="backends").inc()
+        raise CircuitOpenError("все бэкенды Ollama", min(b.retry_after() for b in breakers))
+
+    @asynccontextmanager
+    async def request(self, model: Optional[str] = None, prefer: Optional[str] = None) -> AsyncIterator[OllamaBackend]:
+        """
+        Выполняет запрос через пул: выключатели, выбор бэкенда, учет нагрузки и ошибок
+
+        Args:
+            model: Требуемая модель
+            prefer: Адрес предпочтительного бэкенда
+
+        Yields:
+            OllamaBackend: Бэкенд, к которому нужно отправить запрос
+
+        Raises:
+            CircuitOpenError: Выключатель модели или всех бэкендов разомкнут
+        """
+        model_breaker = self.model_breaker(model) if model else None
+        if model_breaker is not None and not model_breaker.acquire():
+            metrics.CIRCUIT_REJECTED.labels(name=model_breaker.name).inc()
+            raise CircuitOpenError(model, model_breaker.retry_after())
+        try:
+            backend = self.select(model, prefer)
+        except CircuitOpenError:
+            if model_breaker is not None:
+                model_breaker.release()
+            raise
+
+        breakers = [self.backend_breaker(backend)] + ([model_breaker] if model_breaker is not None else [])
+        backend.outstanding += 1
+        start = time.monotonic()
+        succeeded = failed = False
+        try:
+            yield backend
+        except httpx.HTTPStatusError as e:
+            # 4xx - ошибка запроса, а не бэкенда
+            failed = e.response.status_code >= 500
+            raise
+        except httpx.TransportError:
+            failed = True
+            raise
+        else:
+            succeeded = True
+        finally:
+            backend.outstanding -= 1
+            elapsed = time.monotonic() - start
+            if succeeded:
+                backend.record_success(model, elapsed)
+            for breaker in breakers:
+                if failed:
+                    breaker.record_failure()
+                elif succeeded:
+                    breaker.record_success(elapsed)
+                else:
+                    # Отмена или ошибка не со стороны Ollama - результат не учитывается
+                    breaker.release()
+
+    async def probe(self, backend: OllamaBackend) -> bool:
+        """Проверяет бэкенд через /api/ps и /api/tags и обновляет списки загруженных и установленных моделей"""
+        try:
+            response = await backend.client.get("/api/ps", timeout=self.probe_timeout)
+            response.raise_for_status()
+            models = response.json().get("models") or []
+            backend.loaded_models = {m.get("name") or m.get("model") for m in models}
+            response = await backend.client.get("/api/tags", timeout=self.probe_timeout)
+            response.raise_for_status()
+            backend.installed_models = _model_names(response.json().get("models") or [])
+        except (httpx.HTTPError, ValueError) as e:
+            backend.consecutive_failures += 1
+            if backend.healthy:
+                backend.healthy = False
+                logger.warning(f"Бэкенд Ollama {backend.base_url} недоступен: {e}")
+            return False
+
+        backend.consecutive_failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            logger.info(f"Бэкенд Ollama {backend.base_url} снова доступен")
+        return True
+
+    async def probe_all(self) -> List[bool]:
+        """Проверяет все бэкенды параллельно"""
+        return await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+
+    async def _probe_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки бэкендов Ollama: {e}")
+
+    def available(self) -> bool:
+        """Есть бэкенд, здоровый по проверке и с неразомкнутым выключателем"""
+        return any(b.healthy and self.backend_breaker(b).state != STATE_OPEN for b in self.backends)
+
+    def stats(self) -> List[Dict[str, object]]:
+        """Состояние бэкендов"""
+        return [
+            {**backend.stats(), "circuit": self.backend_breaker(backend).state}
+            for backend in self.backends
+        ]
@@ -0,0 +1,165 @@
+"""
+Автоматический выключатель (circuit breaker) для бэкендов и моделей Ollama
+"""
+
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from fastapi import HTTPException
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_STATE_VALUES = {STATE_CLOSED: 0, STATE_OPEN: 1, STATE_HALF_OPEN: 2}
+
+
+class CircuitOpenError(HTTPException):
+    """Выключатель разомкнут: запрос отклоняется сразу, без обращения к Ollama"""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"Сервис модели временно недоступен ({name}). Повторите позже.",
+            headers={"Retry-After": str(retry_after)}
+        )
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Выключатель с тремя состояниями
+
+    closed - запросы проходят, в скользящем окне считаются ошибки и
+    медленные вызовы; при доле ошибок выше порога (и не меньше min_calls
+    вызовов) переходит в open. open - запросы отклоняются сразу; через
+    open_duration переходит в half_open. half_open - пропускает не больше
+    half_open_calls пробных запросов: успех замыкает цепь, ошибка снова
+    размыкает.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: float = 0.5,
+        min_calls: int = 5,
+        window: float = 60.0,
+        slow_call: float = 120.0,
+        open_duration: float = 30.0,
+        half_open_calls: int = 1
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self._publish()
+
+    @property
+    def state(self) -> str:
+        if self._state == STATE_OPEN and time.monotonic() - self._opened_at >= self.open_duration:
+            self._transition(STATE_HALF_OPEN)
+        return self._state
+
+    def acquire(self) -> bool:
+        """Разрешает запрос; в half_open занимает одно из пробных мест"""
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_HALF_OPEN and self._trials < self.half_open_calls:
+            self._trials += 1
+            return True
+        return False
+
+    def release(self) -> None:
+        """Запрос завершился без результата (отмена, ошибка клиента) - освобождает пробное место"""
+        if self._state == STATE_HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record_success(self, elapsed: float) -> None:
+        if elapsed >= self.slow_call:
+            self.record_failure()
+            return
+        if self._state == STATE_HALF_OPEN:
+            self._transition(STATE_CLOSED)
+            return
+        self._record(True)
+
+    def record_failure(self) -> None:
+        if self._state == STATE_HALF_OPEN:
+            self._transition(STATE_OPEN)
+            return
+        self._record(False)
+        calls = len(self._calls)
+        failures = sum(1 for _, ok in self._calls if not ok)
+        if self._state == STATE_CLOSED and calls >= self.min_calls and failures / calls >= self.failure_threshold:
+            self._transition(STATE_OPEN)
+
+    def retry_after(self) -> int:
+        """Через сколько секунд выключатель пропустит пробный запрос"""
+        remaining = self.open_duration - (time.monotonic() - self._opened_at)
+        return max(1, math.ceil(remaining))
+
+    def _record(self, ok: bool) -> None:
+        now = time.monotonic()
+        self._calls.append((now, ok))
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def _transition(self, state: str) -> None:
+        previous = self._state
+        self._state = state
+        self._trials = 0
+        if state == STATE_OPEN:
+            self._opened_at = time.monotonic()
+        if state == STATE_CLOSED:
+            self._calls.clear()
+        self._publish()
+        log = logger.warning if state == STATE_OPEN else logger.info
+        log(f"Выключатель {self.name}: {previous} -> {state}")
+
+    def _publish(self) -> None:
+        metrics.CIRCUIT_STATE.labels(name=self.name).set(_STATE_VALUES[self._state])
+
+    def stats(self) -> Dict[str, object]:
+        calls = len(self._calls)
+        failures = sum(1 for _, ok in self._calls if not ok)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "failure_rate": round(failures / calls, 3) if calls else 0.0
+        }
+
+
+class CircuitBreakers:
+    """Реестр выключателей по имени (бэкенд или модель) с общими настройками"""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, **self.settings)
+        return breaker
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {name: breaker.stats() for name, breaker in self._breakers.items()}
+
+    def any_open(self) -> bool:
+        return any(breaker.state == STATE_OPEN for breaker in self._breakers.values())
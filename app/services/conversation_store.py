@@ -0,0 +1,151 @@
+"""
+Хранилище диалогов для многоходовых запросов к модели
+"""
+
+import asyncio
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from app.services.tenants import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# Грубая оценка для сообщений пользователя, пока Ollama не посчитала токены
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+@dataclass
+class Turn:
+    """Ход диалога: сообщение пользователя и ответ модели с числом токенов"""
+    message: str
+    reply: str
+    message_tokens: int
+    reply_tokens: int
+    prompt_eval_count: int = 0  # токенов промпта, реально вычисленных Ollama на этом ходе
+    created: float = field(default_factory=time.time)
+
+
+@dataclass
+class Conversation:
+    """
+    Состояние диалога
+
+    История хранится на сервере и отправляется в /api/chat целиком:
+    пока префикс сообщений не меняется, Ollama берет его из KV кэша и
+    вычисляет только новые токены. Поэтому история обрезается не по одному
+    ходу, а сразу до trim_ratio от бюджета - префикс остается стабильным
+    на несколько следующих ходов.
+    """
+    session_id: str
+    model: str
+    system: Optional[str] = None
+    tenant: str = DEFAULT_TENANT  # арендатор, создавший диалог; другим арендаторам он не виден
+    turns: List[Turn] = field(default_factory=list)
+    dropped_turns: int = 0
+    backend: Optional[str] = None  # бэкенд, на котором лежит KV кэш диалога
+    updated: float = field(default_factory=time.monotonic)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    @property
+    def context_tokens(self) -> int:
+        system = estimate_tokens(self.system) if self.system else 0
+        return system + sum(t.message_tokens + t.reply_tokens for t in self.turns)
+
+    def build_messages(self, message: str, token_budget: int, trim_ratio: float = 0.75) -> List[Dict[str, str]]:
+        """
+        Сообщения для /api/chat с новым сообщением пользователя
+
+        Если история вместе с новым сообщением не укладывается в бюджет,
+        старые ходы отбрасываются до trim_ratio от бюджета.
+        """
+        incoming = estimate_tokens(message)
+        if self.context_tokens + incoming > token_budget:
+            target = token_budget * trim_ratio
+            while self.turns and self.context_tokens + incoming > target:
+                self.turns.pop(0)
+                self.dropped_turns += 1
+            logger.info(f"Диалог {self.session_id}: история обрезана, отброшено ходов всего: {self.dropped_turns}")
+
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        for turn in self.turns:
+            messages.append({"role": "user", "content": turn.message})
+            messages.append({"role": "assistant", "content": turn.reply})
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def add_turn(self, message: str, reply: str, result: Dict[str, Any]) -> Turn:
+        """Сохраняет ход с числом токенов из ответа Ollama"""
+        turn = Turn(
+            message=message,
+            reply=reply,
+            message_tokens=estimate_tokens(message),
+            reply_tokens=result.get("eval_count") or estimate_tokens(reply),
+            prompt_eval_count=result.get("prompt_eval_count", 0)
+        )
+        self.turns.append(turn)
+        return turn
+
+
+class ConversationStore:
+    """
+    Диалоги в памяти процесса с вытеснением по TTL и по числу диалогов (LRU)
+    """
+
+    def __init__(self, ttl: float = 1800.0, max_sessions: int = 1000, token_budget: int = 2048):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.expired = 0
+
+    def create(self, model: str, system: Optional[str] = None, tenant: str = DEFAULT_TENANT) -> Conversation:
+        self._purge()
+        while len(self._sessions) >= self.max_sessions:
+            session_id, _ = self._sessions.popitem(last=False)
+            logger.info(f"Диалог {session_id} вытеснен: достигнут лимит {self.max_sessions}")
+        conversation = Conversation(session_id=uuid.uuid4().hex, model=model, system=system, tenant=tenant)
+        self._sessions[conversation.session_id] = conversation
+        return conversation
+
+    def get(self, session_id: str, tenant: Optional[str] = None) -> Optional[Conversation]:
+        """Диалог по идентификатору; продлевает его TTL. Диалог другого арендатора не возвращается"""
+        self._purge()
+        conversation = self._sessions.get(session_id)
+        if conversation is not None and tenant is not None and conversation.tenant != tenant:
+            return None
+        if conversation is not None:
+            conversation.updated = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return conversation
+
+    def delete(self, session_id: str, tenant: Optional[str] = None) -> bool:
+        if self.get(session_id, tenant) is None:
+            return False
+        del self._sessions[session_id]
+        return True
+
+    def _purge(self) -> None:
+        # Диалоги упорядочены по последнему обращению - истекшие в начале
+        now = time.monotonic()
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if now - conversation.updated < self.ttl or conversation.lock.locked():
+                break
+            del self._sessions[session_id]
+            self.expired += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._sessions),
+            "expired": self.expired,
+            "token_budget": self.token_budget
+        }
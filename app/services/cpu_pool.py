@@ -0,0 +1,88 @@
+"""
+Пул для CPU-нагруженных этапов обработки чеков
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+POOL_THREAD = "thread"
+POOL_PROCESS = "process"
+
+
+def _timed(fn: Callable[..., T], *args: Any) -> Tuple[float, float, T]:
+    # Выполняется в потоке или процессе пула; time.time() сопоставимо между процессами
+    started = time.time()
+    result = fn(*args)
+    return started, time.time() - started, result
+
+
+class CpuPool:
+    """
+    Выполняет CPU-нагруженные функции (проверка и декодирование изображений,
+    пережатие, base64, сериализация больших JSON) вне event loop
+
+    Пул потоков подходит для Pillow и base64, которые отпускают GIL на
+    основной работе; пул процессов - если CPU работы много и потоки упираются
+    в GIL. Для процессов функции и аргументы должны сериализоваться pickle.
+    По каждой задаче в метрики пишется время ожидания в очереди пула и время
+    выполнения.
+    """
+
+    def __init__(self, kind: str = POOL_THREAD, workers: int = 4):
+        self.kind = kind
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self.in_flight = 0
+
+    @property
+    def executor(self) -> Executor:
+        """Исполнитель пула; создается лениво, чтобы процессы запускались уже в воркере uvicorn"""
+        if self._executor is None:
+            if self.kind == POOL_PROCESS:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu")
+            logger.info(f"Пул CPU задач: {self.kind}, воркеров: {self.workers}")
+        return self._executor
+
+    async def run(self, task: str, fn: Callable[..., T], *args: Any) -> T:
+        """
+        Выполняет функцию в пуле
+
+        Args:
+            task: Имя задачи для метрик
+            fn: Функция; для пула процессов - определенная на уровне модуля
+            *args: Аргументы функции
+
+        Returns:
+            Результат функции; исключения функции пробрасываются
+        """
+        submitted = time.time()
+        self.in_flight += 1
+        try:
+            started, elapsed, result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _timed, fn, *args
+            )
+        finally:
+            self.in_flight -= 1
+        metrics.CPU_POOL_QUEUE_TIME.labels(task=task).observe(max(0.0, started - submitted))
+        metrics.CPU_POOL_RUN_TIME.labels(task=task).observe(elapsed)
+        return result
+
+    def shutdown(self) -> None:
+        """Останавливает пул (при остановке приложения)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, object]:
+        return {"kind": self.kind, "workers": self.workers, "in_flight": self.in_flight}
@@ -0,0 +1,194 @@
+"""
+Распознавание QR кода фискального чека ФНС
+
+На российских кассовых чеках печатается QR код вида
+t=20240115T1530&s=1250.50&fn=9289000100286581&i=70424&fp=1497925524&n=1
+с точной суммой чека. Если код читается, сумму не нужно извлекать
+моделью: она берется из кода за миллисекунды.
+"""
+
+import hashlib
+import io
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+from urllib.parse import parse_qs
+
+from PIL import Image, ImageOps
+
+from app import metrics
+from app.models.receipt import FiscalData
+from app.services.cpu_pool import CpuPool
+
+try:
+    import zxingcpp
+except ImportError:  # без декодера QR быстрый путь выключается
+    zxingcpp = None
+
+logger = logging.getLogger(__name__)
+
+# Обязательные параметры фискального QR кода
+FISCAL_REQUIRED = ("s", "fn", "i", "fp")
+# Без секунд проверяется первым: иначе "T1530" разбирается как 15:03:00
+TIMESTAMP_FORMATS = ("%Y%m%dT%H%M", "%Y%m%dT%H%M%S")
+
+
+def parse_fiscal_qr(text: str) -> Optional[FiscalData]:
+    """
+    Разбирает содержимое фискального QR кода
+
+    Args:
+        text: Текст QR кода
+
+    Returns:
+        FiscalData или None, если это не фискальный код
+    """
+    params = {key: values[0] for key, values in parse_qs(text.strip(), keep_blank_values=False).items()}
+    if not all(params.get(key) for key in FISCAL_REQUIRED):
+        return None
+    try:
+        total = float(params["s"].replace(",", "."))
+    except ValueError:
+        return None
+    if total <= 0:
+        return None
+
+    timestamp = None
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            timestamp = datetime.strptime(params.get("t", ""), fmt).isoformat()
+            break
+        except ValueError:
+            continue
+    operation = params.get("n")
+
+    return FiscalData(
+        total_amount=round(total, 2),
+        fn=params["fn"],
+        fd=params["i"],
+        fp=params["fp"],
+        timestamp=timestamp,
+        operation=int(operation) if operation and operation.isdigit() else None
+    )
+
+
+def _variants(image: Image.Image, max_edge: int) -> Iterator[Image.Image]:
+    """Варианты изображения для декодера: масштаб и контраст, от дешевых к дорогим"""
+    gray = ImageOps.exif_transpose(image).convert("L")
+    if max(gray.size) > max_edge:
+        gray.thumbnail((max_edge, max_edge), Image.BILINEAR)
+    yield gray
+    contrasted = ImageOps.autocontrast(gray, cutoff=2)
+    yield contrasted
+    # QR код на фото целиком: в уменьшенном виде модули четче
+    small = contrasted.copy()
+    small.thumbnail((max_edge // 2, max_edge // 2), Image.BILINEAR)
+    yield small
+    # Мелкий код на небольшом изображении
+    if max(gray.size) < max_edge // 2:
+        yield contrasted.resize((gray.width * 2, gray.height * 2), Image.BICUBIC)
+
+
+def decode_fiscal_qr(image_bytes: bytes, max_edge: int = 1600) -> Optional[FiscalData]:
+    """
+    Ищет фискальный QR код на изображении (выполняется в пуле CPU задач)
+
+    Проходы по масштабам и контрастам выполняются с двумя бинаризаторами
+    и прекращаются на первом распознанном фискальном коде.
+
+    Args:
+        image_bytes: Байты изображения
+        max_edge: Длинная сторона, до которой уменьшаются большие фото
+
+    Returns:
+        FiscalData или None
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    binarizers = (zxingcpp.Binarizer.LocalAverage, zxingcpp.Binarizer.GlobalHistogram)
+    for variant in _variants(image, max_edge):
+        for binarizer in binarizers:
+            for result in zxingcpp.read_barcodes(
+                variant, formats=zxingcpp.BarcodeFormat.QRCode, binarizer=binarizer
+            ):
+                fiscal = parse_fiscal_qr(result.text)
+                if fiscal is not None:
+                    return fiscal
+    return None
+
+
+class FiscalQRDecoder:
+    """
+    Быстрый путь анализа: сумма чека из фискального QR кода без модели
+
+    Требует пакет zxing-cpp; если он не установлен, декодер выключен
+    и все чеки анализируются моделью. Результат распознавания (в том числе
+    отсутствие кода) запоминается по SHA-256 содержимого изображения:
+    повторная загрузка того же файла не платит за поиск кода.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_edge: int = 1600,
+        cpu_pool: Optional[CpuPool] = None,
+        cache_size: int = 1024
+    ):
+        if enabled and zxingcpp is None:
+            logger.warning("Пакет zxing-cpp не установлен: распознавание фискальных QR кодов выключено")
+        self.enabled = enabled and zxingcpp is not None
+        self.max_edge = max_edge
+        self.cpu_pool = cpu_pool or CpuPool()
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Optional[FiscalData]]" = OrderedDict()
+        self.decoded = 0
+        self.not_found = 0
+        self.cache_hits = 0
+
+    async def decode(self, image_bytes: bytes) -> Optional[FiscalData]:
+        """
+        Распознает фискальный QR код в пуле CPU задач
+
+        Returns:
+            FiscalData или None, если кода нет, он не фискальный или декодер выключен
+        """
+        if not self.enabled:
+            return None
+        key = hashlib.sha256(image_bytes).hexdigest()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return self._cache[key]
+        try:
+            fiscal = await self.cpu_pool.run("qr_decode", decode_fiscal_qr, image_bytes, self.max_edge)
+        except Exception as e:
+            logger.warning(f"Ошибка распознавания QR кода: {e}")
+            metrics.FISCAL_QR.labels(outcome="error").inc()
+            return None
+        self._remember(key, fiscal)
+
+        if fiscal is None:
+            self.not_found += 1
+            metrics.FISCAL_QR.labels(outcome="not_found").inc()
+            return None
+        self.decoded += 1
+        metrics.FISCAL_QR.labels(outcome="decoded").inc()
+        logger.info(f"Фискальный QR код: сумма {fiscal.total_amount}, ФН {fiscal.fn}, ФД {fiscal.fd}")
+        return fiscal
+
+    def _remember(self, key: str, fiscal: Optional[FiscalData]) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = fiscal
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.decoded + self.not_found
+        return {
+            "enabled": self.enabled,
+            "decoded": self.decoded,
+            "not_found": self.not_found,
+            "cache_hits": self.cache_hits,
+            "decode_rate": round(self.decoded / total, 3) if total else 0.0
+        }
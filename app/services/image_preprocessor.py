@@ -0,0 +1,113 @@
+"""
+Предобработка изображений чеков перед отправкой в vision модель
+"""
+
+import io
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from app.services.cpu_pool import CpuPool
+from app.services.near_duplicates import dhash
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreprocessedImage:
+    """Результат предобработки изображения"""
+    data: bytes
+    original_size: int
+    width: int
+    height: int
+    phash: Optional[int] = None  # dHash изображения для поиска почти дубликатов
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - len(self.data)
+
+
+class ImagePreprocessor:
+    """
+    Уменьшает изображение до разрешения, достаточного для Moondream:
+    поворот по EXIF, уменьшение по длинной стороне, оттенки серого
+    с автоконтрастом и пережатие в компактный JPEG/WebP
+
+    Если задан hash_size, в том же проходе по декодированному изображению
+    считается его dHash.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_edge: int = 1024,
+        grayscale: bool = True,
+        output_format: str = "JPEG",
+        quality: int = 85,
+        hash_size: int = 0,
+        cpu_pool: Optional[CpuPool] = None
+    ):
+        self.enabled = enabled
+        self.max_edge = max_edge
+        self.grayscale = grayscale
+        self.output_format = output_format.upper()
+        self.quality = quality
+        self.hash_size = hash_size
+        self.cpu_pool = cpu_pool or CpuPool()
+
+    def __getstate__(self):
+        # Для пула процессов передаются только настройки, без самого пула
+        state = self.__dict__.copy()
+        state.pop("cpu_pool", None)
+        return state
+
+    def process(self, image_bytes: bytes) -> PreprocessedImage:
+        """
+        Синхронная предобработка (выполняется в пуле CPU задач)
+
+        Args:
+            image_bytes: Исходные байты изображения
+
+        Returns:
+            PreprocessedImage: Пережатое изображение или исходное, если оно меньше
+        """
+        image = Image.open(io.BytesIO(image_bytes))
+        original = PreprocessedImage(image_bytes, len(image_bytes), image.width, image.height)
+        if not self.enabled:
+            if self.hash_size:
+                original.phash = dhash(ImageOps.exif_transpose(image), self.hash_size)
+            return original
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+
+        if self.grayscale:
+            image = ImageOps.autocontrast(image.convert("L"), cutoff=1)
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.output_format, quality=self.quality, optimize=True)
+        data = buffer.getvalue()
+        phash = dhash(image, self.hash_size) if self.hash_size else None
+
+        if len(data) >= len(image_bytes):
+            original.phash = phash
+            return original
+        return PreprocessedImage(data, len(image_bytes), image.width, image.height, phash)
+
+    async def process_async(self, image_bytes: bytes) -> PreprocessedImage:
+        """Предобработка в пуле CPU задач, не блокирующая event loop"""
+        try:
+            result = await self.cpu_pool.run("preprocess", self.process, image_bytes)
+        except Exception as e:
+            logger.warning(f"Ошибка предобработки изображения, используется исходное: {e}")
+            return PreprocessedImage(image_bytes, len(image_bytes), 0, 0)
+
+        logger.info(
+            f"Предобработка изображения: {result.original_size} -> {len(result.data)} байт "
+            f"(сэкономлено {result.bytes_saved}), {result.width}x{result.height}"
+        )
+        return result
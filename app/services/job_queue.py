@@ -0,0 +1,626 @@
+"""
+Асинхронная очередь задач анализа чеков
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi import HTTPException
+
+from app.models.receipt import ReceiptAnalysisResponse
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.ollama_service import OllamaService
+from app.services.shared_state import connect_redis, connect_sqlite
+from app.services.tenants import DEFAULT_TENANT, TenantRegistry
+
+logger = logging.getLogger(__name__)
+
+# Статусы задач
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+
+# Задача, взятая в работу: (id, байты изображения, webhook или None, арендатор или None)
+ClaimedJob = Tuple[str, bytes, Optional[str], Optional[str]]
+# Состояние задачи: (статус, результат JSON или None, арендатор или None)
+JobState = Tuple[str, Optional[str], Optional[str]]
+
+
+class WebhookRejected(HTTPException):
+    """Webhook ведет на недопустимый адрес"""
+
+    def __init__(self, detail: str):
+        super().__init__(status_code=400, detail=detail)
+
+
+async def check_webhook_url(url: str, allowed_hosts: Sequence[str] = ()) -> None:
+    """
+    Проверяет, что webhook не ведет во внутреннюю сеть сервиса
+
+    Схема должна быть http или https. Если задан список разрешенных хостов,
+    хост должен в него входить; иначе хост разрешается через DNS и все его
+    адреса должны быть публичными (не loopback, частные, link-local и т.п.).
+
+    Args:
+        url: URL webhook
+        allowed_hosts: Разрешенные хосты; пусто - любые публичные адреса
+
+    Raises:
+        WebhookRejected: URL недопустим
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        raise WebhookRejected("Некорректный URL webhook")
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise WebhookRejected("URL webhook должен начинаться с http:// или https://")
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise WebhookRejected(f"Хост webhook {host} не входит в JOB_WEBHOOK_ALLOWED_HOSTS")
+        return
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise WebhookRejected(f"Не удалось разрешить хост webhook {host}")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if not address.is_global:
+            raise WebhookRejected(f"Webhook не может вести на внутренний адрес {address}")
+
+
+class MemoryJobStore:
+    """Хранилище задач в памяти процесса (теряется при перезапуске)"""
+
+    def __init__(self):
+        self._jobs: Dict[str, dict] = {}
+        self._queue: "deque[str]" = deque()
+        self._lock = threading.Lock()
+
+    def add(self, job_id: str, image_bytes: bytes, webhook_url: Optional[str], tenant: Optional[str] = None) -> None:
+        with self._lock:
+            self._jobs[job_id] = {
+                "status": JOB_QUEUED,
+                "image": image_bytes,
+                "webhook_url": webhook_url,
+                "tenant": tenant,
+                "result": None,
+                "created_at": time.time(),
+                "finished_at": None
+            }
+            self._queue.append(job_id)
+
+    def claim(self) -> Optional[ClaimedJob]:
+        with self._lock:
+            while self._queue:
+                job_id = self._queue.popleft()
+                job = self._jobs.get(job_id)
+                if job is not None and job["status"] == JOB_QUEUED:
+                    job["status"] = JOB_RUNNING
+                    return job_id, job["image"], job["webhook_url"], job["tenant"]
+            return None
+
+    def complete(self, job_id: str, result_json: str) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=JOB_COMPLETED, result=result_json, image=None, finished_at=time.time())
+
+    def get(self, job_id: str) -> Optional[JobState]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return (job["status"], job["result"], job["tenant"]) if job is not None else None
+
+    def touch(self, job_id: str) -> None:
+        pass
+
+    def requeue_running(self, older_than: Optional[float] = None) -> int:
+        return 0
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_COMPLETED: 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return counts
+
+    def purge_finished(self, older_than: float) -> int:
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] is not None and job["finished_at"] < older_than
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+            return len(expired)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobStore:
+    """
+    Персистентное хранилище задач в SQLite: очередь переживает перезапуск
+
+    Файл можно делить между процессами сервиса: задача захватывается
+    в транзакции BEGIN IMMEDIATE и достается только одному воркеру.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = connect_sqlite(db_path)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, image BLOB, webhook_url TEXT, "
+            "result TEXT, created_at REAL NOT NULL, finished_at REAL, claimed_at REAL, tenant TEXT)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "claimed_at" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN claimed_at REAL")
+        if "tenant" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._db.commit()
+
+    def add(self, job_id: str, image_bytes: bytes, webhook_url: Optional[str], tenant: Optional[str] = None) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, image, webhook_url, created_at, tenant) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, image_bytes, webhook_url, time.time(), tenant)
+            )
+            self._db.commit()
+
+    def claim(self) -> Optional[ClaimedJob]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, image, webhook_url, tenant FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (JOB_QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = ?, claimed_at = ? WHERE id = ?", (JOB_RUNNING, time.time(), row[0])
+                    )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            return (row[0], bytes(row[1]), row[2], row[3]) if row is not None else None
+
+    def complete(self, job_id: str, result_json: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, image = NULL, finished_at = ? WHERE id = ?",
+                (JOB_COMPLETED, result_json, time.time(), job_id)
+            )
+            self._db.commit()
+
+    def get(self, job_id: str) -> Optional[JobState]:
+        with self._lock:
+            row = self._db.execute("SELECT status, result, tenant FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return (row[0], row[1], row[2]) if row is not None else None
+
+    def touch(self, job_id: str) -> None:
+        """Продлевает захват выполняемой задачи"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET claimed_at = ? WHERE id = ? AND status = ?", (time.time(), job_id, JOB_RUNNING)
+            )
+            self._db.commit()
+
+    def requeue_running(self, older_than: Optional[float] = None) -> int:
+        """
+        Возвращает в очередь задачи, прерванные остановкой процесса
+
+        Args:
+            older_than: Только задачи, взятые в работу раньше этого времени;
+                None - все (хранилище принадлежит одному процессу)
+        """
+        with self._lock:
+            if older_than is None:
+                cursor = self._db.execute("UPDATE jobs SET status = ? WHERE status = ?", (JOB_QUEUED, JOB_RUNNING))
+            else:
+                cursor = self._db.execute(
+                    "UPDATE jobs SET status = ? WHERE status = ? AND (claimed_at IS NULL OR claimed_at < ?)",
+                    (JOB_QUEUED, JOB_RUNNING, older_than)
+                )
+            self._db.commit()
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_COMPLETED: 0}
+            for status, count in self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = count
+            return counts
+
+    def purge_finished(self, older_than: float) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,)
+            )
+            self._db.commit()
+            return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# Атомарный захват: снять идентификатор с очереди и отметить задачу выполняемой
+_CLAIM_JOB_SCRIPT = """
+local job_id = redis.call('LPOP', KEYS[1])
+if not job_id then
+    return nil
+end
+redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+redis.call('HSET', ARGV[2] .. job_id, 'status', 'running')
+return job_id
+"""
+
+
+class RedisJobStore:
+    """
+    Хранилище задач в Redis для процессов на нескольких хостах
+
+    Задача - hash с полями, очередь - список идентификаторов. Захват
+    атомарно (Lua скрипт) переносит идентификатор в sorted set выполняемых
+    с временем захвата - по нему возвращаются зависшие задачи.
+    """
+
+    def __init__(self, url: str, prefix: str = "receipts:jobs:"):
+        self.url = url
+        self.prefix = prefix
+        self._redis = connect_redis(url)
+        self._queue = f"{prefix}queue"
+        self._running = f"{prefix}running"
+        self._finished = f"{prefix}finished"
+        self._claim = self._redis.register_script(_CLAIM_JOB_SCRIPT)
+
+    def _key(self, job_id: str) -> str:
+        return f"{self.prefix}{job_id}"
+
+    def add(self, job_id: str, image_bytes: bytes, webhook_url: Optional[str], tenant: Optional[str] = None) -> None:
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key(job_id), mapping={
+            "status": JOB_QUEUED,
+            "image": image_bytes,
+            "webhook_url": webhook_url or "",
+            "tenant": tenant or "",
+            "created_at": time.time()
+        })
+        pipe.rpush(self._queue, job_id)
+        pipe.execute()
+
+    def claim(self) -> Optional[ClaimedJob]:
+        while True:
+            raw_id = self._claim(keys=[self._queue, self._running], args=[time.time(), self.prefix])
+            if raw_id is None:
+                return None
+            job_id = raw_id.decode("utf-8")
+            image, webhook_url, tenant = self._redis.hmget(self._key(job_id), "image", "webhook_url", "tenant")
+            if image is None:
+                # Задача удалена, пока стояла в очереди
+                self._redis.zrem(self._running, job_id)
+                continue
+            return job_id, image, webhook_url.decode("utf-8") or None, tenant.decode("utf-8") if tenant else None
+
+    def complete(self, job_id: str, result_json: str) -> None:
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key(job_id), mapping={"status": JOB_COMPLETED, "result": result_json, "finished_at": now})
+        pipe.hdel(self._key(job_id), "image")
+        pipe.zrem(self._running, job_id)
+        pipe.zadd(self._finished, {job_id: now})
+        pipe.execute()
+
+    def get(self, job_id: str) -> Optional[JobState]:
+        status, result, tenant = self._redis.hmget(self._key(job_id), "status", "result", "tenant")
+        if status is None:
+            return None
+        return (
+            status.decode("utf-8"),
+            result.decode("utf-8") if result is not None else None,
+            tenant.decode("utf-8") if tenant else None
+        )
+
+    def touch(self, job_id: str) -> None:
+        self._redis.zadd(self._running, {job_id: time.time()}, xx=True)
+
+    def requeue_running(self, older_than: Optional[float] = None) -> int:
+        limit = "+inf" if older_than is None else older_than
+        requeued = 0
+        for raw_id in self._redis.zrangebyscore(self._running, "-inf", limit):
+            job_id = raw_id.decode("utf-8")
+            # zrem решает гонку между процессами: задачу возвращает тот, кто ее удалил
+            if not self._redis.zrem(self._running, job_id):
+                continue
+            pipe = self._redis.pipeline()
+            pipe.hset(self._key(job_id), "status", JOB_QUEUED)
+            pipe.rpush(self._queue, job_id)
+            pipe.execute()
+            requeued += 1
+        return requeued
+
+    def counts(self) -> Dict[str, int]:
+        pipe = self._redis.pipeline()
+        pipe.llen(self._queue)
+        pipe.zcard(self._running)
+        pipe.zcard(self._finished)
+        queued, running, completed = pipe.execute()
+        return {JOB_QUEUED: queued, JOB_RUNNING: running, JOB_COMPLETED: completed}
+
+    def purge_finished(self, older_than: float) -> int:
+        expired = self._redis.zrangebyscore(self._finished, "-inf", older_than)
+        if not expired:
+            return 0
+        pipe = self._redis.pipeline()
+        for raw_id in expired:
+            pipe.delete(self._key(raw_id.decode("utf-8")))
+        pipe.zrem(self._finished, *expired)
+        pipe.execute()
+        return len(expired)
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+class JobQueue:
+    """
+    Очередь задач анализа чеков с пулом воркеров в процессе
+
+    Пропускная способность определяется числом воркеров, а не тем,
+    сколько клиенты готовы держать HTTP соединение открытым.
+
+    Если хранилище общее для нескольких процессов (stale_after задан),
+    при старте возвращаются только задачи, зависшие дольше stale_after:
+    остальные выполняют воркеры других процессов. Задачу может завершить
+    другой процесс, поэтому long-poll перепроверяет хранилище каждые
+    poll_interval секунд. Выполняемая задача продлевает свой захват,
+    пока ждет слот к модели или пробное окно выключателя.
+
+    Задачи берутся в работу по порядку постановки, а к модели ставятся
+    в фоновую очередь своего арендатора: между арендаторами слоты
+    делятся по весам.
+    """
+
+    def __init__(
+        self,
+        ollama_service: OllamaService,
+        store=None,
+        workers: int = 1,
+        result_ttl: float = 86400.0,
+        stale_after: Optional[float] = None,
+        poll_interval: float = 1.0,
+        tenants: Optional[TenantRegistry] = None,
+        webhook_allowed_hosts: Sequence[str] = ()
+    ):
+        self.ollama_service = ollama_service
+        self.store = store or MemoryJobStore()
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.tenants = tenants or TenantRegistry([], {})
+        self.webhook_allowed_hosts = [host.lower() for host in webhook_allowed_hosts]
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._waiters: Dict[str, asyncio.Event] = {}
+        self._waiting: Dict[str, int] = {}  # число long-poll запросов по задаче
+        self._webhook_client: Optional[httpx.AsyncClient] = None
+        self._last_purge = 0.0
+
+    async def start(self) -> None:
+        """Запускает воркеры (вызывается при старте приложения)"""
+        requeued = await asyncio.to_thread(self.store.requeue_running, self._stale_before())
+        if requeued:
+            logger.info(f"Возвращено в очередь прерванных задач: {requeued}")
+        self._webhook_client = httpx.AsyncClient(timeout=10.0)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._wakeup.set()
+        logger.info(f"Запущено воркеров очереди задач: {self.workers}")
+
+    async def stop(self) -> None:
+        """Останавливает воркеры; незавершенные задачи останутся в хранилище"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+            self._webhook_client = None
+        self.store.close()
+
+    async def submit(self, image_bytes: bytes, webhook_url: Optional[str] = None, tenant: Optional[str] = None) -> str:
+        """
+        Ставит задачу анализа чека в очередь
+
+        Args:
+            image_bytes: Байты изображения чека
+            webhook_url: URL для POST уведомления с результатом
+            tenant: Имя арендатора, от имени которого выполняется задача
+
+        Returns:
+            str: Идентификатор задачи
+        """
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.add, job_id, image_bytes, webhook_url, tenant)
+        self._wakeup.set()
+        logger.info(f"Задача {job_id} поставлена в очередь")
+        return job_id
+
+    async def get(
+        self, job_id: str, wait: float = 0.0, tenant: Optional[str] = None
+    ) -> Optional[Tuple[str, Optional[ReceiptAnalysisResponse]]]:
+        """
+        Возвращает статус и результат задачи
+
+        Args:
+            job_id: Идентификатор задачи
+            wait: Сколько секунд ждать завершения (long-poll)
+            tenant: Арендатор запроса; задача другого арендатора считается не найденной
+
+        Returns:
+            Кортеж (статус, результат или None) или None, если задача не найдена
+        """
+        job = await asyncio.to_thread(self.store.get, job_id)
+        # Задачи, поставленные без арендатора, принадлежат default
+        if job is not None and tenant is not None and (job[2] or DEFAULT_TENANT) != tenant:
+            return None
+        if job is not None and job[0] != JOB_COMPLETED and wait > 0:
+            job = await self._wait(job_id, wait)
+        if job is None:
+            return None
+        status, result_json, _ = job
+        result = ReceiptAnalysisResponse.model_validate_json(result_json) if result_json else None
+        return status, result
+
+    async def _wait(self, job_id: str, wait: float) -> Optional[JobState]:
+        """Ждет завершения задачи не дольше wait; None, если задача удалена во время ожидания"""
+        event = self._waiters.setdefault(job_id, asyncio.Event())
+        self._waiting[job_id] = self._waiting.get(job_id, 0) + 1
+        deadline = time.monotonic() + wait
+        try:
+            # Повторная проверка: задача могла завершиться до подписки на событие
+            job = await asyncio.to_thread(self.store.get, job_id)
+            while job is not None and job[0] != JOB_COMPLETED and time.monotonic() < deadline:
+                timeout = deadline - time.monotonic()
+                if self.stale_after is not None:
+                    timeout = min(timeout, self.poll_interval)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                job = await asyncio.to_thread(self.store.get, job_id)
+            return job
+        finally:
+            # Событие удаляется, когда его больше никто не ждет: задачу мог
+            # завершить другой процесс, а ожидание могло истечь
+            self._waiting[job_id] -= 1
+            if not self._waiting[job_id]:
+                del self._waiting[job_id]
+                self._waiters.pop(job_id, None)
+
+    async def check_webhook(self, webhook_url: str) -> None:
+        """
+        Проверяет адрес webhook по JOB_WEBHOOK_ALLOWED_HOSTS или на публичность
+
+        Raises:
+            WebhookRejected: URL недопустим
+        """
+        await check_webhook_url(webhook_url, self.webhook_allowed_hosts)
+
+    def stats(self) -> Dict[str, int]:
+        """Число задач по статусам"""
+        return self.store.counts()
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim)
+                if job is None:
+                    self._wakeup.clear()
+                    await self._purge_expired()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=5.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                job_id, image_bytes, webhook_url, tenant = job
+                logger.info(f"Воркер {number} взял задачу {job_id}")
+                heartbeat = asyncio.create_task(self._heartbeat(job_id)) if self.stale_after is not None else None
+                try:
+                    result = await self._run(image_bytes, tenant)
+                finally:
+                    if heartbeat is not None:
+                        heartbeat.cancel()
+                await asyncio.to_thread(self.store.complete, job_id, result.model_dump_json())
+
+                event = self._waiters.pop(job_id, None)
+                if event is not None:
+                    event.set()
+                if webhook_url:
+                    await self._notify(job_id, webhook_url, result)
+            except Exception as e:
+                logger.error(f"Ошибка воркера очереди задач {number}: {e}")
+                await asyncio.sleep(1.0)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        # Долгое ожидание слота или выключателя не должно выглядеть как упавший процесс
+        while True:
+            await asyncio.sleep(self.stale_after / 3)
+            try:
+                await asyncio.to_thread(self.store.touch, job_id)
+            except Exception as e:
+                logger.warning(f"Не удалось продлить захват задачи {job_id}: {e}")
+
+    async def _run(self, image_bytes: bytes, tenant: Optional[str] = None) -> ReceiptAnalysisResponse:
+        while True:
+            try:
+                receipt_data, cached, duplicate = await self.ollama_service.analyze_receipt_cached(
+                    image_bytes, bulk=True, tenant=self.tenants.get(tenant)
+                )
+            except CircuitOpenError as e:
+                # Фоновая задача не проваливается из-за сбоя Ollama, а ждет пробного окна выключателя
+                logger.warning(f"Ollama недоступна ({e.name}), задача ждет {e.retry_after}с")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка выполнения задачи анализа чека: {e}")
+                receipt_data, cached, duplicate = None, False, None
+            break
+
+        if receipt_data is None:
+            return ReceiptAnalysisResponse(
+                success=False,
+                data=None,
+                error="Не удалось распознать данные чека. Попробуйте загрузить более четкое изображение.",
+                duplicate=duplicate
+            )
+        return ReceiptAnalysisResponse(success=True, data=receipt_data, error=None, cached=cached, duplicate=duplicate)
+
+    async def _notify(self, job_id: str, webhook_url: str, result: ReceiptAnalysisResponse) -> None:
+        try:
+            # Повторная проверка: DNS хоста мог измениться после постановки задачи
+            await self.check_webhook(webhook_url)
+        except WebhookRejected as e:
+            logger.warning(f"Webhook для задачи {job_id} не отправлен: {e.detail}")
+            return
+        try:
+            response = await self._webhook_client.post(
+                webhook_url,
+                json={"job_id": job_id, "status": JOB_COMPLETED, "result": result.model_dump()}
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось отправить webhook для задачи {job_id}: {e}")
+
+    async def _purge_expired(self) -> None:
+        now = time.time()
+        if now - self._last_purge < 60.0:
+            return
+        self._last_purge = now
+        purged = await asyncio.to_thread(self.store.purge_finished, now - self.result_ttl)
+        if purged:
+            logger.info(f"Удалено устаревших задач: {purged}")
+        if self.stale_after is not None:
+            # Задачи процесса, упавшего во время выполнения
+            requeued = await asyncio.to_thread(self.store.requeue_running, self._stale_before())
+            if requeued:
+                logger.info(f"Возвращено в очередь зависших задач: {requeued}")
+
+    def _stale_before(self) -> Optional[float]:
+        return time.time() - self.stale_after if self.stale_after is not None else None
@@ -0,0 +1,120 @@
+"""
+Контроль задержки event loop
+
+Все запросы сервиса обслуживает один event loop: синхронный вызов в
+обработчике (разбор изображения Pillow, кодирование, форматирование
+огромной строки лога) задерживает все остальные запросы, включая
+/health. Монитор замеряет, насколько позже запланированного просыпается
+его задача, а сторожевой поток при долгой блокировке записывает в лог
+стек кода, который занял loop.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, Optional
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Замер задержки планирования event loop и поиск блокирующих вызовов
+
+    Задача в loop засыпает на interval и отмечает время пробуждения;
+    задержка сверх interval - время, которое loop был занят другим
+    кодом. Сторожевой поток проверяет отметку и, если loop не
+    просыпается дольше block_threshold, снимает стек его потока: это
+    стек вызова, который блокирует loop прямо сейчас.
+    """
+
+    def __init__(self, interval: float = 0.1, block_threshold: float = 0.25, stack_limit: int = 30):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.stack_limit = stack_limit
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread: Optional[int] = None
+        self._beat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.last_block: Optional[Dict[str, Any]] = None
+
+    async def start(self) -> None:
+        """Запускает замеры в текущем event loop и сторожевой поток"""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(
+            f"Контроль event loop: замер каждые {self.interval}с, "
+            f"стек блокирующего вызова после {self.block_threshold}с"
+        )
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._watchdog.join(timeout=1.0)
+        self._watchdog = None
+
+    async def _measure(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - start - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            metrics.EVENT_LOOP_LAG.observe(lag)
+            if lag > self.block_threshold:
+                logger.warning(f"Event loop был заблокирован на {lag:.3f}с")
+
+    def _watch(self) -> None:
+        """Сторожевой поток: стек loop при блокировке дольше block_threshold"""
+        reported = None
+        check = min(self.interval, self.block_threshold) / 2
+        while not self._stopped.wait(check):
+            beat = self._beat
+            blocked_for = time.monotonic() - beat - self.interval
+            # Одна запись на блокировку: до следующего пробуждения отметка не меняется
+            if blocked_for <= self.block_threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=self.stack_limit))
+            del frame
+            self.blocked += 1
+            self.last_block = {"detected_after": round(blocked_for, 3), "at": time.time(), "stack": stack}
+            metrics.EVENT_LOOP_BLOCKED.inc()
+            logger.warning(f"Event loop не отвечает {blocked_for:.3f}с, стек блокирующего вызова:\n{stack}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._task is not None,
+            "last_lag": round(self.last_lag, 4),
+            "max_lag": round(self.max_lag, 4),
+            "blocked": self.blocked,
+            "block_threshold": self.block_threshold,
+            "last_block_stack": self.last_block["stack"].splitlines()[-2:] if self.last_block else None
+        }
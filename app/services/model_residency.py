@@ -0,0 +1,225 @@
+"""
+Управление загрузкой моделей в Ollama: прогрев, keep-alive и планирование смены моделей
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from app.services.backend_pool import BackendPool
+
+logger = logging.getLogger(__name__)
+
+
+def parse_hours(value: str) -> Optional[Tuple[int, int]]:
+    """Разбирает интервал часов вида "8-20"; пустая строка - круглосуточно"""
+    if not value:
+        return None
+    start, end = value.split("-")
+    return int(start), int(end)
+
+
+class ModelResidencyManager:
+    """
+    Держит нужные модели загруженными и сокращает их выгрузку
+
+    - при старте загружает модели из списка preload на всех бэкендах;
+    - подставляет keep_alive в каждый запрос: долгий для основных моделей,
+      короткий для остальных, чтобы они быстрее освобождали память;
+    - в рабочие часы периодически пингует основные модели;
+    - группирует запросы по модели: пока выполняются запросы к загруженной
+      модели, запросы к другим ждут, и смена модели происходит один раз
+      на группу, а не на каждый запрос. Чтобы не было голодания, после
+      swap_max_wait новые запросы к текущей модели тоже встают в очередь.
+    """
+
+    def __init__(
+        self,
+        pool: BackendPool,
+        preload_models: List[str],
+        keep_alive: str = "30m",
+        other_keep_alive: str = "1m",
+        warm_interval: float = 60.0,
+        warm_hours: Optional[Tuple[int, int]] = None,
+        max_active_models: int = 1,
+        swap_max_wait: float = 10.0
+    ):
+        self.pool = pool
+        self.preload_models = preload_models
+        self.keep_alive = keep_alive
+        self.other_keep_alive = other_keep_alive
+        self.warm_interval = warm_interval
+        self.warm_hours = warm_hours
+        self.max_active_models = max_active_models
+        self.swap_max_wait = swap_max_wait
+        # Модели, которым сейчас разрешены запросы, и число запросов в работе
+        self._active: Dict[str, int] = {}
+        # Ожидающие группы: модель -> (время первого ожидающего, событие допуска)
+        self._waiting: "OrderedDict[str, Tuple[float, asyncio.Event]]" = OrderedDict()
+        self._waiting_counts: Dict[str, int] = {}
+        self._closed: Set[str] = set()
+        self._tasks: List[asyncio.Task] = []
+        self.swaps = 0
+
+    async def start(self) -> None:
+        """Запускает прогрев моделей и фоновый keep-warm (при старте приложения)"""
+        self._tasks = [asyncio.create_task(self.preload())]
+        if self.warm_interval > 0:
+            self._tasks.append(asyncio.create_task(self._warm_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def keep_alive_for(self, model: str) -> str:
+        """Значение keep_alive для запроса к модели"""
+        return self.keep_alive if model in self.preload_models else self.other_keep_alive
+
+    async def preload(self) -> None:
+        """Загружает основные модели на все доступные бэкенды"""
+        for model in self.preload_models:
+            await asyncio.gather(
+                *(self._load(backend, model) for backend in self.pool.backends if backend.healthy)
+            )
+
+    async def _load(self, backend, model: str) -> None:
+        # Запрос без prompt только загружает модель и продлевает keep_alive
+        try:
+            async with self.use(model):
+                response = await backend.client.post(
+                    "/api/generate",
+                    json={"model": model, "keep_alive": self.keep_alive_for(model)}
+                )
+                response.raise_for_status()
+            backend.loaded_models.add(model)
+            load_duration = response.json().get("load_duration", 0) / 1e9
+            logger.info(f"Модель {model} загружена на {backend.base_url} (load_duration {load_duration:.2f}с)")
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось загрузить модель {model} на {backend.base_url}: {e}")
+
+    async def _warm_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.warm_interval)
+            if not self._in_warm_hours():
+                continue
+            try:
+                await self.preload()
+            except Exception as e:
+                logger.error(f"Ошибка keep-warm моделей: {e}")
+
+    def _in_warm_hours(self) -> bool:
+        if self.warm_hours is None:
+            return True
+        start, end = self.warm_hours
+        return start <= datetime.now().hour < end
+
+    @asynccontextmanager
+    async def use(self, model: str) -> AsyncIterator[None]:
+        """Допускает запрос к модели с учетом группировки по моделям"""
+        await self._enter(model)
+        try:
+            yield
+        finally:
+            self._leave(model)
+
+    async def _enter(self, model: str) -> None:
+        while True:
+            if model in self._active and model not in self._closed:
+                self._active[model] += 1
+                return
+            if model not in self._active:
+                if len(self._active) >= self.max_active_models:
+                    self._evict_idle()
+                if len(self._active) < self.max_active_models:
+                    self._activate(model)
+                    self._active[model] += 1
+                    return
+
+            # Ждем своей группы
+            if model not in self._waiting:
+                self._waiting[model] = (time.monotonic(), asyncio.Event())
+            self._waiting_counts[model] = self._waiting_counts.get(model, 0) + 1
+            event = self._waiting[model][1]
+            self._close_starving()
+            try:
+                await asyncio.wait_for(event.wait(), timeout=self.swap_max_wait)
+            except asyncio.TimeoutError:
+                self._close_starving()
+            except BaseException:
+                if event.is_set():
+                    # Слот был зарезервирован при допуске группы - освобождаем
+                    self._leave(model)
+                raise
+            finally:
+                self._waiting_counts[model] -= 1
+                if not self._waiting_counts[model]:
+                    del self._waiting_counts[model]
+                    if model in self._waiting and self._waiting[model][1] is event:
+                        del self._waiting[model]
+            if event.is_set():
+                return
+
+    def _leave(self, model: str) -> None:
+        self._active[model] -= 1
+        if self._active[model] > 0:
+            return
+        if not self._waiting:
+            # Никто не ждет - модель остается активной для следующих запросов
+            self._closed.discard(model)
+            return
+        del self._active[model]
+        self._closed.discard(model)
+        self._wake_next()
+
+    def _activate(self, model: str) -> None:
+        # Слоты резервируются сразу за всей ожидающей группой
+        self._active[model] = 0
+        if model in self._waiting:
+            _, event = self._waiting.pop(model)
+            self._active[model] = self._waiting_counts.get(model, 0)
+            event.set()
+
+    def _evict_idle(self) -> None:
+        # Активная модель без запросов уступает место запрошенной
+        for model in [m for m, count in self._active.items() if count == 0]:
+            del self._active[model]
+            self._closed.discard(model)
+            self.swaps += 1
+            logger.info(f"Смена модели: {model} больше не используется")
+            return
+
+    def _wake_next(self) -> None:
+        while self._waiting and len(self._active) < self.max_active_models:
+            model, _ = next(iter(self._waiting.items()))
+            self.swaps += 1
+            logger.info(f"Смена модели: допускается группа запросов к {model}")
+            self._activate(model)
+
+    def _close_starving(self) -> None:
+        # Если группа ждет слишком долго, текущие модели перестают принимать новые запросы
+        if not self._waiting:
+            return
+        oldest = next(iter(self._waiting.values()))[0]
+        if time.monotonic() - oldest >= self.swap_max_wait:
+            self._closed.update(self._active)
+            for model in [m for m, count in self._active.items() if count == 0]:
+                del self._active[model]
+                self._closed.discard(model)
+            self._wake_next()
+
+    def stats(self) -> Dict[str, object]:
+        """Активные модели и ожидающие группы"""
+        return {
+            "active_models": dict(self._active),
+            "waiting": dict(self._waiting_counts),
+            "swaps": self.swaps,
+            "preload_models": self.preload_models
+        }
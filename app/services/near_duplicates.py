@@ -0,0 +1,215 @@
+"""
+Поиск почти одинаковых изображений чеков по перцептивному хэшу
+
+Точный кэш адресуется по байтам и не узнает тот же бумажный чек,
+сфотографированный повторно или пережатый мессенджером. dHash
+сравнивает яркость соседних пикселей уменьшенного изображения и
+почти не меняется от пережатия, масштаба и небольшого шума, поэтому
+близкие изображения отличаются в нескольких битах хэша.
+"""
+
+import io
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from app import metrics
+from app.models.receipt import DuplicateMatch, ReceiptData
+
+logger = logging.getLogger(__name__)
+
+
+def dhash(image: Image.Image, hash_size: int = 16) -> int:
+    """
+    Разностный хэш (dHash) изображения: hash_size * hash_size бит
+
+    Изображение уменьшается до (hash_size + 1) x hash_size в оттенках
+    серого, каждый бит - светлее ли пиксель своего правого соседа.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def image_dhash(image_bytes: bytes, hash_size: int = 16) -> int:
+    """dHash по байтам изображения (выполняется в пуле CPU задач)"""
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG декодируется сразу в уменьшенном виде - для хэша полное разрешение не нужно
+    image.draft("L", (hash_size * 8, hash_size * 8))
+    return dhash(image, hash_size)
+
+
+def hamming(a: int, b: int) -> int:
+    """Расстояние Хэмминга между хэшами"""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    BK-дерево для поиска хэшей в пределах расстояния Хэмминга
+
+    Потомки узла сгруппированы по расстоянию до него; по неравенству
+    треугольника при поиске с радиусом r обходятся только потомки на
+    расстоянии d - r .. d + r, а не все записи.
+    """
+
+    def __init__(self):
+        # Узел: [хэш, идентификаторы записей с этим хэшем, {расстояние: потомок}]
+        self._root: Optional[list] = None
+        self.nodes = 0
+
+    def add(self, value: int, item: str) -> None:
+        if self._root is None:
+            self._root = [value, [item], {}]
+            self.nodes = 1
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                self.nodes += 1
+                return
+            node = child
+
+    def remove(self, value: int, item: str) -> None:
+        """Удаляет запись; пустой узел остается в дереве до перестроения"""
+        node = self._root
+        while node is not None:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                return
+            node = node[2].get(distance)
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        """Все записи на расстоянии не больше max_distance: [(расстояние, идентификатор)]"""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+@dataclass
+class IndexedReceipt:
+    """Результат анализа, проиндексированный по перцептивному хэшу"""
+    phash: int
+    data: ReceiptData
+    created: float
+
+
+class NearDuplicateIndex:
+    """
+    Индекс недавно проанализированных чеков по dHash
+
+    Хранит не больше max_entries записей не дольше ttl; самые давние
+    вытесняются. Совпадением считается запись со сходством не ниже
+    threshold (1 - расстояние Хэмминга / число бит хэша).
+
+    Хэш описывает раскладку чека, а не цифры, поэтому с reuse=False
+    совпадение только отмечается, а чек все равно анализируется моделью.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        hash_size: int = 16,
+        max_entries: int = 10000,
+        ttl: float = 86400.0,
+        reuse: bool = False
+    ):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.bits = hash_size * hash_size
+        self.max_distance = int(self.bits * (1 - threshold))
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.reuse = reuse
+        self._entries: "OrderedDict[str, IndexedReceipt]" = OrderedDict()
+        self._tree = BKTree()
+        self.matches = 0
+        self.lookups = 0
+
+    def find(self, phash: int) -> Optional[Tuple[DuplicateMatch, ReceiptData]]:
+        """
+        Ближайший проиндексированный чек в пределах порога
+
+        Returns:
+            Кортеж (описание совпадения, данные чека) или None
+        """
+        self.lookups += 1
+        self._purge()
+        candidates = self._tree.search(phash, self.max_distance)
+        if not candidates:
+            return None
+        distance, receipt_id = min(candidates)
+        entry = self._entries[receipt_id]
+        self.matches += 1
+        match = DuplicateMatch(
+            duplicate_of=receipt_id,
+            similarity=round(1 - distance / self.bits, 4),
+            distance=distance
+        )
+        metrics.NEAR_DUPLICATES.labels(outcome="reused" if self.reuse else "flagged").inc()
+        logger.info(f"Найден почти дубликат чека {receipt_id}: сходство {match.similarity}")
+        return match, entry.data
+
+    def add(self, receipt_id: str, phash: int, data: ReceiptData) -> None:
+        """Добавляет результат анализа в индекс"""
+        if receipt_id in self._entries:
+            return
+        self._entries[receipt_id] = IndexedReceipt(phash, data, time.monotonic())
+        self._tree.add(phash, receipt_id)
+        while len(self._entries) > self.max_entries:
+            self._evict()
+
+    def _purge(self) -> None:
+        # Записи упорядочены по времени добавления - истекшие в начале
+        now = time.monotonic()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if now - entry.created <= self.ttl:
+                break
+            self._evict()
+
+    def _evict(self) -> None:
+        receipt_id, entry = self._entries.popitem(last=False)
+        self._tree.remove(entry.phash, receipt_id)
+        # Пустые узлы замедляют поиск - перестраиваем дерево, когда их больше, чем записей
+        if self._tree.nodes > 2 * len(self._entries) + 64:
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        self._tree = BKTree()
+        for receipt_id, entry in self._entries.items():
+            self._tree.add(entry.phash, receipt_id)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "threshold": self.threshold,
+            "max_distance": self.max_distance
+        }
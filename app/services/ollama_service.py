@@ -1,11 +1,30 @@
 import json
-import base64
+import asyncio
 import httpx
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, AsyncIterator, List
 import logging
 from pathlib import Path
 
-from app.models.receipt import ReceiptData
+from app import config, metrics
+from app.metrics import observe_stage
+from app.models.receipt import DuplicateMatch, FiscalData, ReceiptData
+from app.services.admission import AdmissionController
+from app.services.backend_pool import BackendPool
+from app.services.circuit_breaker import CircuitBreakers, CircuitOpenError, STATE_OPEN
+from app.services.conversation_store import Conversation, Turn
+from app.services.cpu_pool import CpuPool
+from app.services.model_residency import ModelResidencyManager, parse_hours
+from app.services.near_duplicates import NearDuplicateIndex, image_dhash
+from app.services.receipt_cache import ReceiptCache
+from app.services.receipt_parser import ReceiptParser, parse_store_name
+from app.services.request_body import ImageRequestBody
+from app.services.semantic_cache import SemanticCache
+from app.services.retry_policy import (
+    Attempt, RetryBudget, RetryExhausted, RetryPolicy, RetryableResponseError,
+    REASON_EMPTY_RESPONSE, REASON_VALIDATION
+)
+from app.services.single_flight import SingleFlight
+from app.services.tenants import DEFAULT_TENANT, Tenant
 
 logger = logging.getLogger(__name__)
 
@@ -13,91 +32,468 @@ logger = logging.getLogger(__name__)
 class OllamaService:
     """Сервис для работы с Ollama API"""
     
-    def __init__(self, base_url: str = "http://ollama:11434"):
-        self.base_url = base_url
+    def __init__(
+        self,
+        base_urls: List[str] = config.OLLAMA_BASE_URLS,
+        cpu_pool: Optional[CpuPool] = None,
+        shared_state=None
+    ):
         self.model = "moondream:1.8b"  # Легкая vision модель для анализа изображений
-        self.max_retries = 3
+        self.max_retries = config.RETRY_MAX_ATTEMPTS
+        self.prompt_version = "3"  # Менять при изменении промптов, чтобы не отдавать устаревший кэш
+        # Бюджет повторов общий для всех операций, чтобы повторы не умножали нагрузку при сбое
+        self.retry_budget = RetryBudget(
+            ratio=config.RETRY_BUDGET_RATIO,
+            refill_per_second=config.RETRY_BUDGET_REFILL,
+            max_balance=config.RETRY_BUDGET_MAX
+        )
+        self.vision_retry = RetryPolicy(
+            max_attempts=self.max_retries,
+            base_delay=config.RETRY_BASE_DELAY,
+            max_delay=config.RETRY_MAX_DELAY,
+            deadline=config.OLLAMA_VISION_DEADLINE,
+            budget=self.retry_budget
+        )
+        self.text_retry = RetryPolicy(
+            max_attempts=self.max_retries,
+            base_delay=config.RETRY_BASE_DELAY,
+            max_delay=config.RETRY_MAX_DELAY,
+            deadline=config.OLLAMA_TEXT_DEADLINE,
+            budget=self.retry_budget
+        )
+        self.cache = ReceiptCache(
+            max_entries=config.RECEIPT_CACHE_SIZE,
+            ttl=config.RECEIPT_CACHE_TTL,
+            db_path=config.RECEIPT_CACHE_PATH,
+            shared=shared_state
+        )
+        self.near_duplicates = NearDuplicateIndex(
+            threshold=config.NEAR_DUPLICATE_THRESHOLD,
+            hash_size=config.NEAR_DUPLICATE_HASH_SIZE,
+            max_entries=config.NEAR_DUPLICATE_MAX_ENTRIES,
+            ttl=config.NEAR_DUPLICATE_TTL,
+            reuse=config.NEAR_DUPLICATE_REUSE
+        ) if config.NEAR_DUPLICATE_ENABLED else None
+        self.embed_model = config.SEMANTIC_CACHE_MODEL
+        self.semantic_cache = None
+        if config.SEMANTIC_CACHE_ENABLED:
+            try:
+                self.semantic_cache = SemanticCache(
+                    threshold=config.SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=config.SEMANTIC_CACHE_MAX_ENTRIES,
+                    ttl=config.SEMANTIC_CACHE_TTL,
+                    temperature_step=config.SEMANTIC_CACHE_TEMPERATURE_STEP,
+                    path=config.SEMANTIC_CACHE_PATH or None
+                )
+            except RuntimeError as e:
+                logger.warning(f"Семантический кэш выключен: {e}")
+        self.single_flight = SingleFlight()
+        self.cpu_pool = cpu_pool or CpuPool()
+        self.parser = ReceiptParser()
+        # Структурированный вывод: Ollama ограничивает генерацию схемой ReceiptData
+        self.receipt_format = ReceiptData.model_json_schema() if config.OLLAMA_STRUCTURED_OUTPUT else "json"
+        self.batch_limiter = asyncio.Semaphore(config.OLLAMA_TOTAL_PARALLEL)
+        self.admission = AdmissionController(
+            max_in_flight=config.ADMISSION_MAX_IN_FLIGHT,
+            max_queue=config.ADMISSION_MAX_QUEUE,
+            queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+            shared=shared_state,
+            lease_ttl=config.STATE_LEASE_TTL
+        )
+        self.pool = BackendPool(
+            base_urls,
+            limits=httpx.Limits(
+                max_connections=config.OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=config.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.OLLAMA_KEEPALIVE_EXPIRY
+            ),
+            timeout=self._timeout(config.OLLAMA_TEXT_TIMEOUT),
+            routing=config.OLLAMA_ROUTING,
+            probe_interval=config.OLLAMA_PROBE_INTERVAL,
+            probe_timeout=config.OLLAMA_HEALTH_TIMEOUT,
+            breakers=CircuitBreakers(
+                failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+                min_calls=config.CIRCUIT_MIN_CALLS,
+                window=config.CIRCUIT_WINDOW,
+                slow_call=config.CIRCUIT_SLOW_CALL,
+                open_duration=config.CIRCUIT_OPEN_DURATION,
+                half_open_calls=config.CIRCUIT_HALF_OPEN_CALLS
+            ),
+            models=[self.model, self.embed_model, *config.MODEL_PRELOAD, *config.CIRCUIT_MODELS]
+        )
+        self.residency = ModelResidencyManager(
+            self.pool,
+            preload_models=config.MODEL_PRELOAD,
+            keep_alive=config.MODEL_KEEP_ALIVE,
+            other_keep_alive=config.OTHER_MODEL_KEEP_ALIVE,
+            warm_interval=config.MODEL_WARM_INTERVAL,
+            warm_hours=parse_hours(config.MODEL_WARM_HOURS),
+            max_active_models=config.OLLAMA_MAX_LOADED_MODELS * len(self.pool.backends),
+            swap_max_wait=config.MODEL_SWAP_MAX_WAIT
+        )
+
+    def _timeout(self, read: float) -> httpx.Timeout:
+        """Таймауты по фазам запроса: подключение, пул, чтение/запись"""
+        return httpx.Timeout(
+            read,
+            connect=config.OLLAMA_CONNECT_TIMEOUT,
+            pool=config.OLLAMA_POOL_TIMEOUT
+        )
+
+    @staticmethod
+    def _flight_scope(bulk: bool, tenant: Optional[Tenant]) -> Tuple[bool, str]:
+        """
+        Часть ключа single-flight: очередь допуска, в которой выполняется общая работа
+
+        Допуск проходит задача первого вызова, поэтому объединяются только
+        вызовы одного класса и арендатора: иначе отказ интерактивного
+        запроса (429) получили бы фоновые, а интерактивный ждал бы
+        в фоновой очереди без лимита или в очереди чужого арендатора.
+        """
+        return bulk, tenant.name if tenant is not None else DEFAULT_TENANT
+
+    async def startup(self) -> None:
+        """Запускает пул бэкендов Ollama, их проверку и прогрев моделей (вызывается при старте приложения)"""
+        await self.pool.start()
+        await self.residency.start()
+
+    async def shutdown(self) -> None:
+        """Закрывает соединения с Ollama (вызывается при остановке приложения)"""
+        await self.residency.stop()
+        await self.pool.stop()
+        logger.info("Пул соединений к Ollama закрыт")
+        self.cache.close()
+        if self.semantic_cache is not None:
+            try:
+                self.semantic_cache.save()
+            except OSError as e:
+                logger.error(f"Не удалось сохранить семантический кэш: {e}")
+
+    async def analyze_receipt_cached(
+        self, image_bytes: bytes, bulk: bool = False, phash: Optional[int] = None, tenant: Optional[Tenant] = None
+    ) -> Tuple[Optional[ReceiptData], bool, Optional[DuplicateMatch]]:
+        """
+        Анализирует чек с использованием кэша результатов
+        
+        Сначала ищется точное совпадение по байтам, затем почти дубликат
+        по перцептивному хэшу: тот же чек, сфотографированный повторно
+        или пережатый. Найденное совпадение возвращается как признак
+        повторной отправки чека.
+        
+        Args:
+            image_bytes: Байты изображения чека
+            bulk: Фоновый вызов (пакет, очередь задач) - не отклоняется контролем допуска
+            phash: dHash изображения из предобработки; без него считается здесь
+            tenant: Арендатор, в чью очередь к модели ставится запрос
+            
+        Returns:
+            Кортеж (ReceiptData или None, признак ответа из кэша, совпадение или None)
+        """
+        key = ReceiptCache.make_key(image_bytes, self.model, self.prompt_version)
+        digest = key.rsplit(":", 1)[1]
+        receipt_data = await self.cache.get(key)
+        if receipt_data is not None:
+            logger.info(f"Результат анализа чека найден в кэше: {receipt_data}")
+            return receipt_data, True, DuplicateMatch(duplicate_of=digest, similarity=1.0, distance=0)
+        
+        duplicate = None
+        if self.near_duplicates is not None:
+            if phash is None:
+                phash = await self._phash(image_bytes)
+            found = self.near_duplicates.find(phash) if phash is not None else None
+            if found is not None:
+                duplicate, receipt_data = found
+                if self.near_duplicates.reuse:
+                    return receipt_data, True, duplicate
+        
+        async def analyze_and_store() -> Optional[ReceiptData]:
+            result = await self.analyze_receipt(image_bytes, bulk=bulk, tenant=tenant)
+            if result is not None:
+                await self.cache.set(key, result)
+                if phash is not None:
+                    self.near_duplicates.add(digest, phash, result)
+            return result
+        
+        # Одновременные загрузки одного и того же изображения ждут один запрос к модели
+        receipt_data = await self.single_flight.do(
+            ("receipt", key, *self._flight_scope(bulk, tenant)), analyze_and_store
+        )
+        return receipt_data, False, duplicate
+
+    async def analyze_fiscal_receipt(
+        self, image_bytes: bytes, fiscal: FiscalData, bulk: bool = False, tenant: Optional[Tenant] = None
+    ) -> Tuple[Optional[ReceiptData], bool]:
+        """
+        Чек с распознанным фискальным QR кодом: у модели запрашивается только название магазина
+        
+        Сумма и валюта берутся из QR кода; короткий ответ с одним названием
+        генерируется в несколько раз быстрее полного JSON.
+        
+        Args:
+            image_bytes: Байты изображения чека
+            fiscal: Реквизиты фискального QR кода
+            bulk: Фоновый вызов - ждать допуска без лимита очереди
+            tenant: Арендатор запроса
+            
+        Returns:
+            Кортеж (ReceiptData или None, если модель не назвала магазин; признак ответа из кэша)
+        """
+        key = ReceiptCache.make_key(image_bytes, self.model, f"{self.prompt_version}-store")
+        receipt_data = await self.cache.get(key)
+        if receipt_data is not None:
+            return receipt_data.model_copy(update={"total_amount": fiscal.total_amount, "currency": "RUB"}), True
+        
+        async def extract_and_store() -> Optional[ReceiptData]:
+            store_name = await self.extract_store_name(image_bytes, bulk=bulk, tenant=tenant)
+            if store_name is None:
+                return None
+            result = ReceiptData(store_name=store_name, total_amount=fiscal.total_amount, currency="RUB")
+            await self.cache.set(key, result)
+            return result
+        
+        receipt_data = await self.single_flight.do(
+            ("store_name", key, *self._flight_scope(bulk, tenant)), extract_and_store
+        )
+        return receipt_data, False
+
+    async def extract_store_name(
+        self, image_bytes: bytes, bulk: bool = False, tenant: Optional[Tenant] = None
+    ) -> Optional[str]:
+        """
+        Запрашивает у vision модели только название магазина
+        
+        Returns:
+            Название магазина или None при ошибке
+            
+        Raises:
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
+        """
+        self.pool.check(self.model)
+        async with self.residency.use(self.model), self.admission.slot(bulk=bulk, tenant=tenant):
+            return await self._extract_store_name(image_bytes)
+
+    async def _extract_store_name(self, image_bytes: bytes) -> Optional[str]:
+        """Выполняет запрос названия магазина с повторными попытками"""
+        payload = {
+            "model": self.model,
+            "prompt": self._get_store_name_prompt(),
+            "images": [image_bytes],
+            "stream": False,
+            "keep_alive": self.residency.keep_alive_for(self.model),
+            "options": {"temperature": 0, "num_predict": 32}
+        }
+        # Тело собирается один раз и переотправляется при повторных попытках
+        body = ImageRequestBody(payload)
+        
+        async def attempt_extract(attempt: Attempt) -> str:
+            with observe_stage("ollama_roundtrip"):
+                result = await self._generate(
+                    payload, "extract_store_name", min(config.OLLAMA_VISION_TIMEOUT, attempt.remaining()), body
+                )
+            response_text = result.get("response", "").strip()
+            if not response_text:
+                raise RetryableResponseError(REASON_EMPTY_RESPONSE, "Пустой ответ от модели")
+            store_name = parse_store_name(response_text)
+            if store_name is None:
+                raise RetryableResponseError(
+                    REASON_VALIDATION, f"Ответ не похож на название магазина: {response_text[:200]!r}"
+                )
+            return store_name
+        
+        try:
+            store_name = await self.vision_retry.run("extract_store_name", attempt_extract)
+        except RetryExhausted as e:
+            logger.error(f"Не удалось получить название магазина ({e.reason}): {e.last_error}")
+            return None
+        
+        logger.info(f"Название магазина: {store_name}")
+        return store_name
+
+    async def _phash(self, image_bytes: bytes) -> Optional[int]:
+        try:
+            return await self.cpu_pool.run(
+                "phash", image_dhash, image_bytes, self.near_duplicates.hash_size
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить перцептивный хэш изображения: {e}")
+            return None
         
-    async def analyze_receipt(self, image_bytes: bytes) -> Optional[ReceiptData]:
+    async def analyze_receipts(
+        self, images: List[bytes], phashes: Optional[List[Optional[int]]] = None, tenant: Optional[Tenant] = None
+    ) -> AsyncIterator[Tuple[int, Optional[ReceiptData], bool, Optional[DuplicateMatch]]]:
+        """
+        Пакетный анализ чеков с ограничением параллелизма
+        
+        Все изображения ставятся в обработку сразу, но к Ollama одновременно
+        уходит не больше OLLAMA_NUM_PARALLEL запросов на бэкенд. Результаты отдаются
+        в исходном порядке по мере готовности.
+        
+        Args:
+            images: Байты изображений чеков
+            phashes: dHash изображений из предобработки
+            tenant: Арендатор пакета; чеки ставятся в его фоновую очередь
+            
+        Yields:
+            Кортежи (индекс, ReceiptData или None, признак ответа из кэша, совпадение или None)
+        """
+        async def analyze_one(
+            image_bytes: bytes, phash: Optional[int]
+        ) -> Tuple[Optional[ReceiptData], bool, Optional[DuplicateMatch]]:
+            async with self.batch_limiter:
+                try:
+                    return await self.analyze_receipt_cached(image_bytes, bulk=True, phash=phash, tenant=tenant)
+                except Exception as e:
+                    logger.error(f"Ошибка анализа чека в пакете: {e}")
+                    return None, False, None
+        
+        phashes = phashes or [None] * len(images)
+        tasks = [asyncio.ensure_future(analyze_one(image, phash)) for image, phash in zip(images, phashes)]
+        try:
+            for index, task in enumerate(tasks):
+                receipt_data, cached, duplicate = await task
+                yield index, receipt_data, cached, duplicate
+        finally:
+            # Клиент отключился или итерация прервана - не тратим GPU на остаток пакета:
+            # single-flight отменяет анализ, если его не ждет другой запрос, и он уходит из очереди допуска
+            for task in tasks:
+                task.cancel()
+        
+    async def analyze_receipt(
+        self, image_bytes: bytes, bulk: bool = False, tenant: Optional[Tenant] = None
+    ) -> Optional[ReceiptData]:
         """
         Анализирует чек с помощью Ollama
         
         Args:
             image_bytes: Байты изображения чека
+            bulk: Фоновый вызов - ждать допуска без лимита очереди
+            tenant: Арендатор, в чью очередь к модели ставится запрос
             
         Returns:
             ReceiptData или None при ошибке
+            
+        Raises:
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
         """
-        # Кодируем изображение в base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        self.pool.check(self.model)
+        async with self.residency.use(self.model), self.admission.slot(bulk=bulk, tenant=tenant):
+            return await self._analyze_receipt(image_bytes)
+    
+    async def _analyze_receipt(self, image_bytes: bytes) -> Optional[ReceiptData]:
+        """Выполняет анализ чека в Ollama с повторными попытками"""
+        # После неудачного разбора ответа переходим к более строгому промпту
+        prompts = [self._get_vision_prompt(), self._get_strict_vision_prompt()]
         
-        # Специальный промпт для vision модели Moondream
-        vision_prompt = """Проанализируй это изображение чека и извлеки следующую информацию:
-1. Название магазина или организации
-2. Общую сумму покупки (итог к оплате)
-3. Валюту (обычно RUB для российских чеков)
-
-Ответь СТРОГО в формате JSON:
-{
-    "store_name": "название магазина",
-    "total_amount": числовое_значение,
-    "currency": "RUB"
-}
+        # Формируем запросы к Ollama для vision модели: по телу на промпт,
+        # повторные попытки с тем же промптом переотправляют готовое тело
+        payloads = [
+            {
+                "model": self.model,
+                "prompt": prompt,
+                "images": [image_bytes],
+                "stream": False,
+                "format": self.receipt_format,
+                "keep_alive": self.residency.keep_alive_for(self.model)
+            }
+            for prompt in prompts
+        ]
+        bodies = [ImageRequestBody(payload) for payload in payloads]
+        
+        async def attempt_analysis(attempt: Attempt) -> ReceiptData:
+            logger.info(f"Попытка анализа чека {attempt.number + 1}/{self.max_retries}")
+            
+            index = min(attempt.escalation, len(prompts) - 1)
+            with observe_stage("ollama_roundtrip"):
+                result = await self._generate(
+                    payloads[index], "analyze_receipt",
+                    min(config.OLLAMA_VISION_TIMEOUT, attempt.remaining()), bodies[index]
+                )
+            response_text = result.get("response", "")
+            
+            logger.info(f"Ответ от Ollama: {response_text}")
+            
+            # Строгий разбор, при неудаче - исправление ответа; повтор только если не помогло и это
+            return self.parser.parse(response_text)
+        
+        try:
+            receipt_data = await self.vision_retry.run("analyze_receipt", attempt_analysis)
+        except RetryExhausted as e:
+            logger.error(f"Не удалось проанализировать чек ({e.reason}): {e.last_error}")
+            return None
+        
+        logger.info(f"Успешно распознаны данные: {receipt_data}")
+        return receipt_data
 
-Если информация не найдена, используй null для соответствующих полей."""
+    async def query_text_cached(
+        self, message: str, model: str = None, temperature: float = 0.7, tenant: Optional[Tenant] = None
+    ) -> Tuple[Optional[str], bool]:
+        """
+        Текстовый запрос с семантическим кэшем ответов
         
-        for attempt in range(self.max_retries):
-            try:
-                logger.info(f"Попытка анализа чека {attempt + 1}/{self.max_retries}")
-                
-                # Формируем запрос к Ollama для vision модели
-                payload = {
-                    "model": self.model,
-                    "prompt": vision_prompt,
-                    "images": [image_base64],
-                    "stream": False,
-                    "format": "json"
-                }
-                
-                async with httpx.AsyncClient(timeout=300.0) as client:
-                    response = await client.post(
-                        f"{self.base_url}/api/generate",
-                        json=payload
-                    )
-                    response.raise_for_status()
-                    
-                    result = response.json()
-                    response_text = result.get("response", "")
-                    
-                    logger.info(f"Ответ от Ollama: {response_text}")
-                    
-                    # Парсим JSON ответ
-                    try:
-                        parsed_data = json.loads(response_text)
-                        receipt_data = ReceiptData(**parsed_data)
-                        logger.info(f"Успешно распознаны данные: {receipt_data}")
-                        return receipt_data
-                    except (json.JSONDecodeError, ValueError) as e:
-                        logger.warning(f"Ошибка парсинга JSON (попытка {attempt + 1}): {e}")
-                        if attempt == self.max_retries - 1:
-                            # Последняя попытка - пробуем с более строгим промптом
-                            vision_prompt = self._get_strict_vision_prompt()
-                        continue
-                        
-            except httpx.HTTPError as e:
-                logger.error(f"HTTP ошибка при запросе к Ollama: {e}")
-                if attempt == self.max_retries - 1:
-                    break
-                    
-            except Exception as e:
-                logger.error(f"Неожиданная ошибка: {e}")
-                if attempt == self.max_retries - 1:
-                    break
-                    
-        logger.error("Не удалось проанализировать чек после всех попыток")
-        return None
-
-    async def query_text(self, message: str, model: str = None, temperature: float = 0.7) -> Optional[str]:
+        Сообщение переводится в эмбеддинг, и если для той же модели и
+        диапазона температуры уже есть ответ на достаточно похожий вопрос,
+        он возвращается без генерации. Без кэша или эмбеддинга запрос
+        выполняется как обычно.
+        
+        Args:
+            message: Текстовое сообщение для модели
+            model: Название модели (по умолчанию использует self.model)
+            temperature: Температура генерации
+            tenant: Арендатор запроса
+            
+        Returns:
+            Кортеж (ответ модели или None при ошибке, признак ответа из кэша)
+            
+        Raises:
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
+        """
+        if model is None:
+            model = self.model
+        if self.semantic_cache is None:
+            return await self.query_text(message, model, temperature, tenant), False
+        
+        vector = await self.embed(message)
+        if vector is None:
+            metrics.SEMANTIC_CACHE.labels(outcome="embed_error").inc()
+            return await self.query_text(message, model, temperature, tenant), False
+        
+        hit = await self.semantic_cache.lookup(vector, model, temperature)
+        if hit is not None:
+            return hit.answer, True
+        
+        response_text = await self.query_text(message, model, temperature, tenant)
+        if response_text is not None:
+            self.semantic_cache.add(vector, model, temperature, message, response_text)
+        return response_text, False
+    
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """
+        Эмбеддинг текста через Ollama /api/embed
+        
+        Returns:
+            Вектор эмбеддинга или None при ошибке
+        """
+        payload = {
+            "model": self.embed_model,
+            "input": text,
+            "keep_alive": self.residency.keep_alive_for(self.embed_model)
+        }
+        try:
+            self.pool.check(self.embed_model)
+            async with self.residency.use(self.embed_model):
+                result, _ = await self._post("/api/embed", payload, "embed", config.OLLAMA_EMBED_TIMEOUT)
+        except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
+            logger.warning(f"Не удалось получить эмбеддинг от модели {self.embed_model}: {e}")
+            return None
+        embeddings = result.get("embeddings") or []
+        return embeddings[0] if embeddings else None
+
+    async def query_text(
+        self, message: str, model: str = None, temperature: float = 0.7, tenant: Optional[Tenant] = None
+    ) -> Optional[str]:
         """
         Отправляет текстовый запрос к модели Ollama
         
@@ -105,57 +501,293 @@ class OllamaService:
             message: Текстовое сообщение для модели
             model: Название модели (по умолчанию использует self.model)
             temperature: Температура генерации (0.0 - детерминистично, 2.0 - креативно)
+            tenant: Арендатор, в чью очередь к модели ставится запрос
             
         Returns:
             Ответ модели или None при ошибке
+            
+        Raises:
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
         """
         if model is None:
             model = self.model
+        self.pool.check(model)
+        
+        async def run() -> Optional[str]:
+            async with self.residency.use(model), self.admission.slot(tenant=tenant):
+                return await self._query_text(message, model, temperature)
+        
+        if temperature == 0:
+            # Детерминированные одинаковые запросы объединяются в один
+            return await self.single_flight.do(("query", model, message, *self._flight_scope(False, tenant)), run)
+        return await run()
+
+    async def _query_text(self, message: str, model: str, temperature: float) -> Optional[str]:
+        """Выполняет текстовый запрос к Ollama с повторными попытками"""
+        async def attempt_query(attempt: Attempt) -> str:
+            logger.info(f"Отправка текстового запроса к модели {model} (попытка {attempt.number + 1}/{self.max_retries})")
             
-        for attempt in range(self.max_retries):
-            try:
-                logger.info(f"Отправка текстового запроса к модели {model} (попытка {attempt + 1}/{self.max_retries})")
-                
-                # Формируем запрос к Ollama для текстовой модели
-                payload = {
-                    "model": model,
-                    "prompt": message,
-                    "stream": False,
-                    "options": {
-                        "temperature": temperature
-                    }
+            # Формируем запрос к Ollama для текстовой модели
+            payload = {
+                "model": model,
+                "prompt": message,
+                "stream": False,
+                "keep_alive": self.residency.keep_alive_for(model),
+                "options": {
+                    "temperature": temperature
                 }
-                
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    response = await client.post(
-                        f"{self.base_url}/api/generate",
-                        json=payload
+            }
+            
+            result = await self._generate(
+                payload, "query_text", min(config.OLLAMA_TEXT_TIMEOUT, attempt.remaining())
+            )
+            response_text = result.get("response", "")
+            if not response_text:
+                raise RetryableResponseError(REASON_EMPTY_RESPONSE, "Пустой ответ от модели")
+            return response_text
+        
+        try:
+            response_text = await self.text_retry.run("query_text", attempt_query)
+        except RetryExhausted as e:
+            logger.error(f"Не удалось получить ответ от модели {model} ({e.reason}): {e.last_error}")
+            return None
+        
+        logger.info(f"Получен ответ от модели {model}: {response_text[:100]}...")
+        return response_text
+    
+    async def chat(
+        self,
+        conversation: Conversation,
+        message: str,
+        temperature: float = 0.7,
+        token_budget: int = 2048,
+        tenant: Optional[Tenant] = None
+    ) -> Optional[Turn]:
+        """
+        Очередной ход диалога через /api/chat
+        
+        История диалога хранится на сервере; запрос направляется на тот же
+        бэкенд, что и прошлый ход, чтобы Ollama переиспользовала KV кэш
+        префикса и вычисляла только новые токены.
+        
+        Args:
+            conversation: Диалог
+            message: Сообщение пользователя
+            temperature: Температура генерации
+            token_budget: Бюджет токенов истории
+            tenant: Арендатор запроса
+            
+        Returns:
+            Turn с ответом модели и числом токенов или None при ошибке
+            
+        Raises:
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
+        """
+        model = conversation.model
+        self.pool.check(model)
+        
+        # Ходы одного диалога выполняются строго по очереди
+        async with conversation.lock:
+            messages = conversation.build_messages(message, token_budget)
+            async with self.residency.use(model), self.admission.slot(tenant=tenant):
+                reply = await self._chat(messages, model, temperature, conversation.backend)
+            if reply is None:
+                return None
+            result, backend = reply
+            conversation.backend = backend
+            turn = conversation.add_turn(message, result["message"]["content"], result)
+        
+        logger.info(
+            f"Диалог {conversation.session_id}: ход {len(conversation.turns)}, "
+            f"вычислено токенов промпта {turn.prompt_eval_count}, контекст {conversation.context_tokens}"
+        )
+        return turn
+
+    async def _chat(
+        self, messages: List[Dict[str, str]], model: str, temperature: float, prefer: Optional[str]
+    ) -> Optional[Tuple[Dict[str, Any], str]]:
+        """Выполняет запрос к /api/chat с повторными попытками"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": False,
+            "keep_alive": self.residency.keep_alive_for(model),
+            "options": {
+                "temperature": temperature
+            }
+        }
+        
+        async def attempt_chat(attempt: Attempt) -> Tuple[Dict[str, Any], str]:
+            result, backend = await self._post(
+                "/api/chat", payload, "chat", min(config.OLLAMA_TEXT_TIMEOUT, attempt.remaining()), prefer
+            )
+            if not (result.get("message") or {}).get("content"):
+                raise RetryableResponseError(REASON_EMPTY_RESPONSE, "Пустой ответ от модели")
+            return result, backend
+        
+        try:
+            return await self.text_retry.run("chat", attempt_chat)
+        except RetryExhausted as e:
+            logger.error(f"Не удалось получить ответ в диалоге от модели {model} ({e.reason}): {e.last_error}")
+            return None
+    
+    async def stream_text(
+        self, message: str, model: str = None, temperature: float = 0.7, tenant: Optional[Tenant] = None
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый текстовый запрос: отдает токены по мере генерации
+        
+        Читает NDJSON поток Ollama построчно. Если потребитель прекращает
+        итерацию (например, клиент отключился), соединение с Ollama
+        закрывается и генерация на GPU останавливается.
+        
+        Args:
+            message: Текстовое сообщение для модели
+            model: Название модели (по умолчанию использует self.model)
+            temperature: Температура генерации
+            tenant: Арендатор запроса
+            
+        Yields:
+            Фрагменты ответа модели
+            
+        Raises:
+            httpx.HTTPError: При ошибке соединения с Ollama
+            AdmissionRejected: Очередь запросов к модели переполнена
+            CircuitOpenError: Ollama недоступна, выключатель разомкнут
+        """
+        if model is None:
+            model = self.model
+        self.pool.check(model)
+        
+        payload = {
+            "model": model,
+            "prompt": message,
+            "stream": True,
+            "keep_alive": self.residency.keep_alive_for(model),
+            "options": {
+                "temperature": temperature
+            }
+        }
+        
+        logger.info(f"Потоковый текстовый запрос к модели {model}")
+        async with self.residency.use(model), self.admission.slot(tenant=tenant):
+            in_flight = metrics.OLLAMA_IN_FLIGHT.labels(operation="stream_text")
+            in_flight.inc()
+            try:
+                async with self.pool.request(model) as backend, backend.client.stream(
+                    "POST",
+                    "/api/generate",
+                    json=payload,
+                    timeout=self._timeout(config.OLLAMA_TEXT_TIMEOUT)
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise httpx.HTTPError(chunk["error"])
+                        token = chunk.get("response", "")
+                        if token:
+                            yield token
+                        if chunk.get("done"):
+                            # Финальный фрагмент содержит статистику генерации
+                            metrics.record_generation_stats(model, chunk)
+                            break
+            finally:
+                in_flight.dec()
+    
+    async def _generate(
+        self, payload: Dict[str, Any], operation: str, read_timeout: float, body: Optional[ImageRequestBody] = None
+    ) -> Dict[str, Any]:
+        """
+        Один запрос к /api/generate с замером времени и статистики Ollama
+        
+        Raises:
+            httpx.HTTPError: При ошибке соединения или HTTP статусе ошибки
+            CircuitOpenError: Выключатель модели или всех бэкендов разомкнут
+        """
+        result, _ = await self._post("/api/generate", payload, operation, read_timeout, body=body)
+        return result
+    
+    async def _post(
+        self,
+        path: str,
+        payload: Dict[str, Any],
+        operation: str,
+        read_timeout: float,
+        prefer: Optional[str] = None,
+        body: Optional[ImageRequestBody] = None
+    ) -> Tuple[Dict[str, Any], str]:
+        """
+        Один запрос к API генерации Ollama через пул бэкендов
+        
+        Args:
+            body: Готовое тело для payload с изображениями; переиспользуется
+                между повторными попытками вместо сборки заново
+        
+        Returns:
+            Кортеж (ответ Ollama, адрес обслужившего бэкенда)
+        
+        Raises:
+            httpx.HTTPError: При ошибке соединения или HTTP статусе ошибки
+            CircuitOpenError: Выключатель модели или всех бэкендов разомкнут
+        """
+        in_flight = metrics.OLLAMA_IN_FLIGHT.labels(operation=operation)
+        in_flight.inc()
+        try:
+            with metrics.OLLAMA_LATENCY.labels(operation=operation).time():
+                async with self.pool.request(payload["model"], prefer) as backend:
+                    if body is not None:
+                        content, headers = body, body.headers
+                    else:
+                        content, headers = self._encode_payload(payload)
+                    response = await backend.client.post(
+                        path, content=content, headers=headers, timeout=self._timeout(read_timeout)
                     )
                     response.raise_for_status()
-                    
                     result = response.json()
-                    response_text = result.get("response", "")
-                    
-                    if response_text:
-                        logger.info(f"Получен ответ от модели {model}: {response_text[:100]}...")
-                        return response_text
-                    else:
-                        logger.warning(f"Пустой ответ от модели (попытка {attempt + 1})")
-                        continue
-                        
-            except httpx.HTTPError as e:
-                logger.error(f"HTTP ошибка при запросе к Ollama: {e}")
-                if attempt == self.max_retries - 1:
-                    break
-                    
-            except Exception as e:
-                logger.error(f"Неожиданная ошибка при текстовом запросе: {e}")
-                if attempt == self.max_retries - 1:
-                    break
-                    
-        logger.error(f"Не удалось получить ответ от модели {model} после всех попыток")
-        return None
+        finally:
+            in_flight.dec()
+        
+        metrics.record_generation_stats(payload["model"], result)
+        return result, backend.base_url
     
+    def _encode_payload(self, payload: Dict[str, Any]) -> Tuple[Any, Dict[str, str]]:
+        """
+        Тело запроса и заголовки
+
+        Изображения (байты) не собираются в одну base64 строку: тело
+        отправляется потоком с кодированием кусками во время отправки.
+        """
+        if payload.get("images"):
+            body = ImageRequestBody(payload)
+            return body, body.headers
+        return json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"}
+    
+    def _get_vision_prompt(self) -> str:
+        """Возвращает основной промпт для vision модели Moondream"""
+        return """Проанализируй это изображение чека и извлеки следующую информацию:
+1. Название магазина или организации
+2. Общую сумму покупки (итог к оплате)
+3. Валюту (обычно RUB для российских чеков)
+
+Ответь СТРОГО в формате JSON:
+{
+    "store_name": "название магазина",
+    "total_amount": числовое_значение,
+    "currency": "RUB"
+}
+
+Если информация не найдена, используй null для соответствующих полей."""
+
+    def _get_store_name_prompt(self) -> str:
+        """Возвращает промпт, запрашивающий только название магазина"""
+        return """Как называется магазин или организация, выдавшая этот чек? Название обычно напечатано вверху чека.
+Ответь только названием, без пояснений."""
+
     def _get_strict_vision_prompt(self) -> str:
         """Возвращает более строгий промпт для vision модели"""
         return """Внимательно изучи изображение чека. Найди:
@@ -171,10 +803,9 @@ class OllamaService:
 {"store_name": null, "total_amount": null, "currency": "RUB"}"""
 
     async def health_check(self) -> bool:
-        """Проверка доступности Ollama"""
-        try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                return response.status_code == 200
-        except Exception:
-            return False 
\ No newline at end of file
+        """
+        Доступность Ollama по фоновым проверкам и выключателям, без запроса к Ollama
+
+        Доступен хотя бы один бэкенд, и выключатель основной модели не разомкнут.
+        """
+        return self.pool.available() and self.pool.model_breaker(self.model).state != STATE_OPEN 
\ No newline at end of file
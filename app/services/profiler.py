@@ -0,0 +1,110 @@
+"""
+Статистический профилировщик работающего процесса
+
+Поток с заданной частотой снимает стеки всех потоков процесса через
+sys._current_frames() и считает одинаковые стеки. Код сервиса не
+инструментируется, поэтому вне замера накладных расходов нет, а во
+время замера это одно обращение к стекам раз в interval.
+
+Результат - collapsed stacks ("кадр;кадр;кадр число") - открывается
+в flamegraph.pl, speedscope и других просмотрщиках flame graph.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Dict, Optional
+
+# Каталоги, от которых обрезаются пути файлов в кадрах
+_PATH_PREFIXES = sorted({os.path.join(path, "") for path in sys.path if path}, key=len, reverse=True)
+# Функции ожидания: поток, у которого такой верхний кадр, не занимает CPU
+_IDLE_FUNCTIONS = {"select", "poll", "wait", "_worker", "sleep", "accept", "get", "_wait_for_tstate_lock"}
+
+
+class ProfilerBusy(Exception):
+    """Профилирование уже выполняется"""
+    pass
+
+
+def _short_path(filename: str) -> str:
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            return filename[len(prefix):]
+    return filename
+
+
+def _is_idle(frame: FrameType) -> bool:
+    return frame.f_code.co_name in _IDLE_FUNCTIONS
+
+
+def collapse_stack(frame: Optional[FrameType], thread_name: str) -> str:
+    """Стек потока в строку collapsed формата: от корня к текущему кадру"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+class SamplingProfiler:
+    """
+    Профилировщик по запросу с ограничением длительности
+
+    Одновременно выполняется один замер; длительность ограничена
+    max_duration, а частота - min_interval.
+    """
+
+    def __init__(self, max_duration: float = 60.0, min_interval: float = 0.001):
+        self.max_duration = max_duration
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self.runs = 0
+
+    def profile(self, duration: float, interval: float = 0.01, idle: bool = False) -> Dict[str, int]:
+        """
+        Снимает стеки потоков в течение duration (блокирует вызывающий поток)
+
+        Args:
+            duration: Длительность замера, сек (не больше max_duration)
+            interval: Период снятия стеков, сек
+            idle: Учитывать потоки, ожидающие в select/wait/sleep
+
+        Returns:
+            Словарь collapsed стек -> число попаданий
+
+        Raises:
+            ProfilerBusy: Другой замер еще не завершен
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("Профилирование уже выполняется")
+        try:
+            self.runs += 1
+            duration = min(duration, self.max_duration)
+            interval = max(interval, self.min_interval)
+            own = threading.get_ident()
+            counts: Counter = Counter()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own or (not idle and _is_idle(frame)):
+                        continue
+                    counts[collapse_stack(frame, names.get(ident, f"thread-{ident}"))] += 1
+                time.sleep(interval)
+            return dict(counts)
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def format_collapsed(counts: Dict[str, int]) -> str:
+        """Строки "стек число", самые частые первыми"""
+        lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def stats(self) -> Dict[str, float]:
+        return {"running": self._lock.locked(), "runs": self.runs, "max_duration": self.max_duration}
@@ -0,0 +1,111 @@
+"""
+Кэш результатов анализа чеков, адресуемый по содержимому изображения
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from app.models.receipt import ReceiptData
+from app.services.shared_state import SQLiteSharedState
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptCache:
+    """
+    Двухуровневый кэш: LRU в памяти процесса с TTL и опциональный
+    общий уровень (SQLite файл или Redis), который переживает перезапуски
+    и разделяется между процессами сервиса
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 86400.0,
+        db_path: Optional[str] = None,
+        shared=None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, ReceiptData]]" = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Собственный SQLite файл закрывается вместе с кэшем, общий - его владельцем
+        self._owns_shared = shared is None and bool(db_path)
+        self.shared = SQLiteSharedState(db_path) if self._owns_shared else shared
+
+    @staticmethod
+    def make_key(image_bytes: bytes, model: str, prompt_version: str) -> str:
+        """Ключ кэша: хэш изображения + модель + версия промпта"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return f"{model}:{prompt_version}:{digest}"
+
+    async def get(self, key: str) -> Optional[ReceiptData]:
+        """Возвращает результат из кэша или None"""
+        now = time.monotonic()
+        entry = self._memory.get(key)
+        if entry is not None:
+            created_at, data = entry
+            if now - created_at <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+            del self._memory[key]
+
+        if self.shared is not None:
+            data = await asyncio.to_thread(self._shared_get, key)
+            if data is not None:
+                self._remember(key, data, now)
+                self.hits += 1
+                self.shared_hits += 1
+                return data
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, data: ReceiptData) -> None:
+        """Сохраняет результат в кэш"""
+        self._remember(key, data, time.monotonic())
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.set, f"receipt:{key}", data.model_dump_json(), self.ttl)
+
+    def _remember(self, key: str, data: ReceiptData, created_at: float) -> None:
+        self._memory[key] = (created_at, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _shared_get(self, key: str) -> Optional[ReceiptData]:
+        value = self.shared.get(f"receipt:{key}")
+        if value is None:
+            return None
+        try:
+            return ReceiptData.model_validate_json(value)
+        except ValueError as e:
+            logger.warning(f"Поврежденная запись в общем кэше {key}: {e}")
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов"""
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._memory)
+        }
+
+    def close(self) -> None:
+        """Закрывает собственное дисковое хранилище"""
+        if self._owns_shared:
+            self.shared.close()
+            self.shared = None
+            self._owns_shared = False
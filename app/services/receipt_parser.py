@@ -0,0 +1,295 @@
+"""
+Разбор ответа vision модели в ReceiptData с исправлением типичных дефектов
+"""
+
+import json
+import logging
+import re
+import time
+from typing import Any, Dict, Optional
+
+from pydantic import ValidationError
+
+from app import metrics
+from app.models.receipt import ReceiptData
+from app.services.retry_policy import REASON_JSON_PARSE, REASON_VALIDATION, RetryableResponseError
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_STRICT = "strict"
+OUTCOME_REPAIRED = "repaired"
+OUTCOME_FAILED = "failed"
+
+# Этапы разбора в метрике receipt_analysis_stage_duration_seconds
+STAGE_JSON_PARSE = "json_parse"
+STAGE_VALIDATION = "pydantic_validation"
+
+# Синонимы валют -> код ISO 4217
+CURRENCY_ALIASES = {
+    "rub": "RUB", "rur": "RUB", "руб": "RUB", "рубль": "RUB", "рублей": "RUB", "рубля": "RUB",
+    "р": "RUB", "₽": "RUB",
+    "usd": "USD", "$": "USD", "доллар": "USD", "долларов": "USD",
+    "eur": "EUR", "€": "EUR", "евро": "EUR",
+    "kzt": "KZT", "тенге": "KZT", "₸": "KZT",
+    "byn": "BYN", "byr": "BYN",
+}
+
+# Синонимы ключей, которые модель иногда использует вместо полей схемы
+KEY_ALIASES = {
+    "store": "store_name", "shop": "store_name", "name": "store_name", "магазин": "store_name",
+    "total": "total_amount", "amount": "total_amount", "sum": "total_amount", "итого": "total_amount",
+    "сумма": "total_amount",
+}
+
+# Ответ длиннее - уже не название, а пояснение или пересказ чека
+MAX_STORE_NAME_LENGTH = 100
+
+_NAME_QUOTES = {('"', '"'), ("'", "'"), ("«", "»")}
+
+# Разделители разрядов - пробелы внутри строки (обычный, неразрывный, узкий неразрывный), не перевод строки
+_NUMBER = re.compile(r"\d[\d \u00a0\u202f'.,]*")
+_DIGIT_GROUP_SEPARATORS = re.compile(r"[ \u00a0\u202f']")
+# Слово из букв или отдельный символ валюты
+_CURRENCY_TOKEN = re.compile(r"[^\W\d_]+|[^\w\s]")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_PYTHON_LITERALS = re.compile(r"\b(None|True|False)\b")
+
+
+def parse_amount(value: Any) -> Optional[float]:
+    """
+    Приводит сумму к числу: "1 250,50", "1.250,50", "1,250.50", "1250.50 руб."
+
+    Returns:
+        Число или None, если в значении нет цифр
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER.search(str(value))
+    if match is None:
+        return None
+    number = _DIGIT_GROUP_SEPARATORS.sub("", match.group()).rstrip(".,")
+
+    if "," in number and "." in number:
+        # Десятичный разделитель - последний из встретившихся
+        thousands = "." if number.rfind(",") > number.rfind(".") else ","
+        number = number.replace(thousands, "").replace(",", ".")
+    elif "," in number or "." in number:
+        separator = "," if "," in number else "."
+        head, _, tail = number.rpartition(separator)
+        # "1250,5" и "1250.50" - копейки; "1,250" и "1.250" - разделитель тысяч:
+        # ровно три цифры после единственного разделителя - группа разрядов (кроме "0,500")
+        thousands = len(tail) == 3 and not head.startswith("0")
+        decimal = not thousands and (number.count(separator) == 1 or len(tail) <= 2)
+        number = head.replace(separator, "") + ("." + tail if decimal else tail)
+
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+
+def normalize_currency(value: Any) -> Optional[str]:
+    """Приводит обозначение валюты к коду: "руб." -> "RUB", "$" -> "USD" """
+    if not isinstance(value, str):
+        return None
+    # Синонимы сравниваются с целыми словами и символами: "руб." и "₽" - рубли, "grub" - нет
+    for token in _CURRENCY_TOKEN.findall(value.lower()):
+        if token in CURRENCY_ALIASES:
+            return CURRENCY_ALIASES[token]
+    return value.strip().upper() if re.fullmatch(r"[a-zA-Z]{3}", value.strip()) else None
+
+
+def parse_store_name(text: str) -> Optional[str]:
+    """
+    Название магазина из ответа на промпт "ответь только названием"
+
+    Если модель все же ответила JSON, название берется из его поля store_name.
+    Иначе - первая строка ответа без кавычек и точки в конце.
+
+    Returns:
+        Название или None, если ответ на название не похож
+    """
+    text = text.strip()
+    if "{" in text:
+        try:
+            fields = _normalize_fields(_extract_object(text))
+        except (json.JSONDecodeError, ValueError):
+            return None
+        name = fields.get("store_name")
+        text = name.strip() if isinstance(name, str) else ""
+    lines = text.splitlines()
+    name = lines[0].strip().rstrip(".").strip() if lines else ""
+    # Кавычки снимаются, только если обрамляют все название: ООО "Ромашка" остается как есть
+    while len(name) > 1 and (name[0], name[-1]) in _NAME_QUOTES:
+        name = name[1:-1].strip()
+    if not any(char.isalnum() for char in name) or len(name) > MAX_STORE_NAME_LENGTH:
+        return None
+    if "{" in name or "store_name" in name:
+        return None
+    return name
+
+
+def _extract_object(text: str) -> Dict[str, Any]:
+    """Вырезает первый JSON объект из текста и исправляет синтаксические дефекты"""
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("в ответе нет JSON объекта")
+    depth = 0
+    end = -1
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                end = i
+                break
+    # Обрезанный ответ: закрываем объект
+    fragment = text[start:end + 1] if end >= 0 else text[start:].rstrip().rstrip(",") + "}"
+
+    fragment = _TRAILING_COMMA.sub(r"\1", fragment)
+    fragment = _PYTHON_LITERALS.sub(lambda m: {"None": "null", "True": "true", "False": "false"}[m.group()], fragment)
+    try:
+        data = json.loads(fragment)
+    except json.JSONDecodeError:
+        # Одинарные кавычки вместо двойных
+        data = json.loads(fragment.replace("'", '"'))
+    if not isinstance(data, dict):
+        raise ValueError("JSON ответ не является объектом")
+    return data
+
+
+def _normalize_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Приводит ключи к полям схемы, суммы и валюты - к нормальному виду"""
+    fields: Dict[str, Any] = {}
+    for key, value in data.items():
+        name = key.strip().lower() if isinstance(key, str) else key
+        name = KEY_ALIASES.get(name, name)
+        if name not in fields or fields[name] is None:
+            fields[name] = value
+
+    raw_amount = fields.get("total_amount")
+    fields["total_amount"] = parse_amount(raw_amount)
+
+    currency = normalize_currency(fields.get("currency"))
+    if currency is None and isinstance(raw_amount, str):
+        # Валюта часто приходит вместе с суммой: "1 250,50 руб."
+        currency = normalize_currency(_NUMBER.sub(" ", raw_amount))
+    if currency is None:
+        # null или нераспознанная валюта - значение по умолчанию из схемы
+        fields.pop("currency", None)
+    else:
+        fields["currency"] = currency
+
+    if fields.get("store_name") is None:
+        # Название не прочитано, но сумма пригодна - повтор ради него не нужен,
+        # как и в ответе по фискальному QR коду без названия
+        fields["store_name"] = ""
+    elif isinstance(fields["store_name"], str):
+        fields["store_name"] = fields["store_name"].strip().strip('"«»').strip()
+    return fields
+
+
+class ReceiptParser:
+    """
+    Разбирает ответ модели в ReceiptData
+
+    Сначала строгий разбор (json.loads + валидация). Если он не удался,
+    ответ исправляется без повторного запроса к модели: из текста
+    вырезается JSON объект, убираются висячие запятые и одинарные кавычки,
+    суммы в русском формате и синонимы валют приводятся к схеме. Только
+    если и это не помогло, вызывающий код делает повтор. Исходы считаются
+    в метрике receipt_parse_total: каждый repaired - сэкономленный проход GPU.
+    Время разбора JSON (строгого и с исправлением) и валидации ReceiptData
+    записывается как этапы json_parse и pydantic_validation.
+    """
+
+    def __init__(self):
+        self.outcomes = {OUTCOME_STRICT: 0, OUTCOME_REPAIRED: 0, OUTCOME_FAILED: 0}
+
+    def parse(self, text: str) -> ReceiptData:
+        """
+        Разбирает ответ модели
+
+        Args:
+            text: Текст ответа модели
+
+        Returns:
+            ReceiptData: Данные чека
+
+        Raises:
+            RetryableResponseError: Ответ не удалось ни разобрать, ни исправить
+        """
+        timings = {STAGE_JSON_PARSE: 0.0, STAGE_VALIDATION: 0.0}
+        try:
+            return self._parse(text, timings)
+        finally:
+            for stage, elapsed in timings.items():
+                if elapsed:
+                    metrics.ANALYSIS_STAGE_LATENCY.labels(stage=stage).observe(elapsed)
+
+    def _parse(self, text: str, timings: Dict[str, float]) -> ReceiptData:
+        start = time.perf_counter()
+        try:
+            raw = json.loads(text)
+        except json.JSONDecodeError:
+            raw = None
+        timings[STAGE_JSON_PARSE] += time.perf_counter() - start
+
+        if isinstance(raw, dict):
+            start = time.perf_counter()
+            try:
+                data = ReceiptData(**raw)
+            except (TypeError, ValidationError):
+                data = None
+            timings[STAGE_VALIDATION] += time.perf_counter() - start
+            if data is not None:
+                self._count(OUTCOME_STRICT)
+                return data
+
+        start = time.perf_counter()
+        try:
+            fields = raw if isinstance(raw, dict) else _extract_object(text)
+        except (json.JSONDecodeError, ValueError) as e:
+            self._count(OUTCOME_FAILED)
+            raise RetryableResponseError(REASON_JSON_PARSE, f"Ошибка парсинга JSON: {e}")
+        finally:
+            timings[STAGE_JSON_PARSE] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            data = ReceiptData(**_normalize_fields(fields))
+        except (TypeError, ValidationError) as e:
+            self._count(OUTCOME_FAILED)
+            raise RetryableResponseError(REASON_VALIDATION, f"Ошибка валидации данных: {e}")
+        finally:
+            timings[STAGE_VALIDATION] += time.perf_counter() - start
+
+        self._count(OUTCOME_REPAIRED)
+        logger.info(f"Ответ модели исправлен без повторного запроса: {text[:200]!r}")
+        return data
+
+    def _count(self, outcome: str) -> None:
+        self.outcomes[outcome] += 1
+        metrics.RECEIPT_PARSE.labels(outcome=outcome).inc()
+
+    def stats(self) -> Dict[str, object]:
+        """Исходы разбора и доля исправленных ответов среди нестрогих"""
+        not_strict = self.outcomes[OUTCOME_REPAIRED] + self.outcomes[OUTCOME_FAILED]
+        return {
+            **self.outcomes,
+            "repair_rate": round(self.outcomes[OUTCOME_REPAIRED] / not_strict, 3) if not_strict else 0.0
+        }
@@ -0,0 +1,66 @@
+"""
+Потоковое тело запроса к Ollama с изображениями
+
+Ollama принимает изображения строками base64 внутри JSON. Если собрать
+строку base64, а затем JSON целиком, на каждый запрос в памяти
+одновременно лежат байты загрузки, их base64 (+33%) и тело запроса
+с той же base64 строкой. Здесь JSON без изображений сериализуется
+один раз, а base64 кодируется кусками из memoryview исходных байтов
+прямо во время отправки, поэтому сверх загрузки держится только
+один кусок.
+"""
+
+import base64
+import json
+from typing import Any, AsyncIterator, Dict, List
+
+# Кратно 3, чтобы base64 кусков склеивался без промежуточного выравнивания
+CHUNK_SIZE = 3 * 16 * 1024
+
+
+def base64_length(size: int) -> int:
+    """Длина base64 строки для size байтов (с выравниванием '=')"""
+    return 4 * ((size + 2) // 3)
+
+
+class ImageRequestBody:
+    """
+    Тело JSON запроса, в котором поле images кодируется в base64 на лету
+
+    Объект можно отправлять повторно: каждая итерация начинает поток
+    заново, поэтому повторная попытка не требует нового кодирования
+    payload. Длина тела известна заранее и передается в Content-Length.
+    """
+
+    def __init__(self, payload: Dict[str, Any], chunk_size: int = CHUNK_SIZE):
+        """
+        Args:
+            payload: Тело запроса; images - список байтов изображений
+            chunk_size: Размер куска исходных байтов (кратен 3)
+        """
+        fields = {key: value for key, value in payload.items() if key != "images"}
+        head = json.dumps(fields)[:-1]
+        self._head = f'{head}{", " if fields else ""}"images": ["'.encode("ascii")
+        self._separator = b'", "'
+        self._tail = b'"]}'
+        self.images: List[memoryview] = [memoryview(image).cast("B") for image in payload["images"]]
+        self.chunk_size = chunk_size - chunk_size % 3 or 3
+        self.content_length = (
+            len(self._head)
+            + len(self._tail)
+            + len(self._separator) * max(len(self.images) - 1, 0)
+            + sum(base64_length(len(image)) for image in self.images)
+        )
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Content-Type": "application/json", "Content-Length": str(self.content_length)}
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self._head
+        for number, image in enumerate(self.images):
+            if number:
+                yield self._separator
+            for start in range(0, len(image), self.chunk_size):
+                yield base64.b64encode(image[start:start + self.chunk_size])
+        yield self._tail
@@ -0,0 +1,198 @@
+"""
+Политика повторных попыток запросов к Ollama
+"""
+
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import httpx
+
+from app import metrics
+from app.services.circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Причины неудачных попыток
+REASON_HTTP_ERROR = "http_error"
+REASON_TIMEOUT = "timeout"
+REASON_JSON_PARSE = "json_parse"
+REASON_VALIDATION = "validation"
+REASON_EMPTY_RESPONSE = "empty_response"
+
+# Ошибки содержимого ответа: повтор без паузы, но с усилением промпта
+CONTENT_REASONS = {REASON_JSON_PARSE, REASON_VALIDATION, REASON_EMPTY_RESPONSE}
+
+
+class RetryableResponseError(Exception):
+    """Ответ модели получен, но не пригоден (не JSON, не прошел валидацию, пустой)"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class RetryExhausted(Exception):
+    """Все попытки исчерпаны или повтор запрещен"""
+
+    def __init__(self, reason: str, last_error: Optional[BaseException]):
+        super().__init__(f"{reason}: {last_error}")
+        self.reason = reason
+        self.last_error = last_error
+
+
+def classify(error: BaseException) -> Tuple[str, bool]:
+    """
+    Классифицирует ошибку попытки
+
+    Returns:
+        Кортеж (причина, можно ли повторять)
+    """
+    if isinstance(error, RetryableResponseError):
+        return error.reason, True
+    if isinstance(error, httpx.TimeoutException):
+        return REASON_TIMEOUT, True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        # 4xx (неверный запрос, модель не найдена) не исправится повтором
+        return f"http_{status}", status >= 500 or status == 429
+    if isinstance(error, httpx.TransportError):
+        return REASON_HTTP_ERROR, True
+    if isinstance(error, httpx.HTTPError):
+        return REASON_HTTP_ERROR, True
+    return "unexpected", False
+
+
+class RetryBudget:
+    """
+    Общий на процесс бюджет повторов
+
+    Каждый запрос пополняет бюджет на ratio, каждый повтор тратит единицу,
+    плюс небольшое пополнение во времени. При массовом сбое повторы быстро
+    исчерпывают бюджет и перестают умножать нагрузку на Ollama.
+    """
+
+    def __init__(self, ratio: float = 0.2, refill_per_second: float = 0.1, max_balance: float = 10.0):
+        self.ratio = ratio
+        self.refill_per_second = refill_per_second
+        self.max_balance = max_balance
+        self._balance = max_balance
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def deposit(self) -> None:
+        """Учитывает новый запрос"""
+        self._refill()
+        self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Пытается потратить единицу бюджета на повтор"""
+        self._refill()
+        if self._balance >= 1.0:
+            self._balance -= 1.0
+            return True
+        return False
+
+    @property
+    def balance(self) -> float:
+        self._refill()
+        return self._balance
+
+
+@dataclass
+class Attempt:
+    """Состояние текущей попытки, передаваемое в операцию"""
+    number: int
+    deadline: float
+    escalation: int = 0
+    last_reason: Optional[str] = None
+
+    def remaining(self) -> float:
+        """Сколько секунд осталось до дедлайна запроса"""
+        return max(0.0, self.deadline - time.monotonic())
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Повторы с экспоненциальной паузой и джиттером, классификацией ошибок,
+    дедлайном на весь запрос и общим бюджетом повторов
+
+    Ошибки содержимого ответа повторяются без паузы: GPU не перегружен,
+    модель просто ответила плохо. Для них растет attempt.escalation,
+    по которому операция выбирает более строгий промпт.
+    """
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    deadline: float = 360.0
+    budget: RetryBudget = field(default_factory=RetryBudget)
+
+    def backoff(self, number: int) -> float:
+        """Пауза перед повтором: full jitter от экспоненты"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** number))
+
+    async def run(self, operation: str, fn: Callable[[Attempt], Awaitable[T]]) -> T:
+        """
+        Выполняет операцию с повторами
+
+        Args:
+            operation: Имя операции для логов и метрик
+            fn: Одна попытка; получает Attempt, бросает исключение при неудаче
+
+        Returns:
+            Результат первой успешной попытки
+
+        Raises:
+            RetryExhausted: Попытки исчерпаны, ошибка не повторяемая, истек дедлайн или бюджет
+            CircuitOpenError: Выключатель модели или бэкендов разомкнут
+        """
+        self.budget.deposit()
+        attempt = Attempt(number=0, deadline=time.monotonic() + self.deadline)
+
+        while True:
+            try:
+                return await fn(attempt)
+            except CircuitOpenError:
+                # Выключатель разомкнулся - повторы бессмысленны, отвечаем 503 сразу
+                raise
+            except Exception as e:
+                reason, retryable = classify(e)
+                logger.warning(f"{operation}: попытка {attempt.number + 1}/{self.max_attempts} не удалась ({reason}): {e}")
+
+                denied = None
+                if not retryable:
+                    denied = "terminal"
+                elif attempt.number + 1 >= self.max_attempts:
+                    denied = "attempts"
+                else:
+                    delay = 0.0 if reason in CONTENT_REASONS else self.backoff(attempt.number)
+                    if attempt.remaining() <= delay:
+                        denied = "deadline"
+                    elif not self.budget.withdraw():
+                        denied = "budget"
+
+                if denied is not None:
+                    metrics.OLLAMA_RETRIES_DENIED.labels(operation=operation, reason=denied).inc()
+                    raise RetryExhausted(denied, e) from e
+
+                metrics.OLLAMA_RETRIES.labels(operation=operation, reason=reason).inc()
+                if delay:
+                    await asyncio.sleep(delay)
+                attempt.number += 1
+                attempt.last_reason = reason
+                if reason in CONTENT_REASONS:
+                    attempt.escalation += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Состояние бюджета повторов"""
+        return {"budget_balance": round(self.budget.balance, 2)}
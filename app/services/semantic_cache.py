@@ -0,0 +1,302 @@
+"""
+Семантический кэш ответов на текстовые запросы
+
+Запросы к /query часто оказываются перефразировками одних и тех же
+вопросов. Точный кэш по тексту их не узнает, поэтому сообщение
+переводится в эмбеддинг (Ollama /api/embed), а ответ ищется среди
+сохраненных по косинусному сходству эмбеддингов вопросов.
+Ответы разделяются по модели и диапазону температуры.
+
+Индекс - матрица NumPy нормированных векторов в памяти процесса:
+поиск - одно матричное умножение, одновременные поиски объединяются
+в одно умножение на матрицу запросов.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app import metrics
+
+try:
+    import numpy as np
+except ImportError:  # без NumPy семантический кэш выключается
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Начальная емкость матрицы; растет удвоением до max_entries
+INITIAL_CAPACITY = 256
+
+
+@dataclass
+class SemanticEntry:
+    """Сохраненный ответ на вопрос"""
+    group: str
+    message: str
+    answer: str
+
+
+@dataclass
+class SemanticHit:
+    """Найденный ответ на похожий вопрос"""
+    answer: str
+    message: str
+    similarity: float
+
+
+class SemanticCache:
+    """
+    Кэш ответов по косинусному сходству эмбеддингов вопросов
+
+    Хранит не больше max_entries ответов не дольше ttl; при переполнении
+    сначала удаляются истекшие, затем давно не использованные (LRU).
+    Индекс сохраняется в файл .npz при остановке и загружается при старте.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        max_entries: int = 5000,
+        ttl: float = 86400.0,
+        temperature_step: float = 0.25,
+        path: Optional[str] = None
+    ):
+        if np is None:
+            raise RuntimeError("Для семантического кэша установите пакет numpy")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.temperature_step = temperature_step
+        self.path = path
+        self.dim: Optional[int] = None
+        self._vectors = None
+        self._created = np.zeros(0)
+        self._last_used = np.zeros(0)
+        # Номер группы (модель + диапазон температуры) по слотам; -1 - свободный слот
+        self._slot_groups = np.zeros(0, dtype=np.int32)
+        self._group_ids: Dict[str, int] = {}
+        self._entries: List[Optional[SemanticEntry]] = []
+        self._free: List[int] = []
+        self._size = 0
+        self._pending: List[Tuple["np.ndarray", int, asyncio.Future]] = []
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def group_key(self, model: str, temperature: float) -> str:
+        """Группа ответов: модель и диапазон температуры шириной temperature_step"""
+        bucket = round(temperature / self.temperature_step) if self.temperature_step > 0 else temperature
+        return f"{model}|{bucket}"
+
+    def _group_id(self, group: str) -> int:
+        return self._group_ids.setdefault(group, len(self._group_ids))
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> Optional["np.ndarray"]:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(array))
+        if array.ndim != 1 or norm == 0.0:
+            return None
+        return array / norm
+
+    def _ensure_dim(self, dim: int) -> None:
+        """Размерность индекса задается первым вектором; смена модели эмбеддингов сбрасывает индекс"""
+        if self.dim == dim:
+            return
+        if self.dim is not None:
+            logger.warning(f"Размерность эмбеддингов изменилась {self.dim} -> {dim}: семантический кэш очищен")
+        self.dim = dim
+        self._allocate(min(INITIAL_CAPACITY, self.max_entries))
+
+    def _allocate(self, capacity: int) -> None:
+        self._vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        self._created = np.zeros(capacity)
+        self._last_used = np.zeros(capacity)
+        self._slot_groups = np.full(capacity, -1, dtype=np.int32)
+        self._entries = [None] * capacity
+        self._free = []
+        self._size = 0
+
+    def _grow(self) -> None:
+        capacity = min(len(self._entries) * 2, self.max_entries)
+        extra = capacity - len(self._entries)
+        self._vectors = np.vstack([self._vectors, np.zeros((extra, self.dim), dtype=np.float32)])
+        self._created = np.concatenate([self._created, np.zeros(extra)])
+        self._last_used = np.concatenate([self._last_used, np.zeros(extra)])
+        self._slot_groups = np.concatenate([self._slot_groups, np.full(extra, -1, dtype=np.int32)])
+        self._entries.extend([None] * extra)
+
+    def search(self, queries: "np.ndarray", group_ids: Sequence[int]) -> List[Optional[Tuple[int, float]]]:
+        """
+        Ближайшие записи своей группы для пачки нормированных запросов
+
+        Args:
+            queries: Матрица запросов (число запросов x размерность)
+            group_ids: Группа каждого запроса
+
+        Returns:
+            Для каждого запроса (слот, сходство) лучшей записи не ниже порога или None
+        """
+        if self._size == 0 or queries.shape[1] != self.dim:
+            return [None] * len(queries)
+        scores = queries @ self._vectors[:self._size].T
+        # Записи чужой группы, свободные и истекшие слоты не участвуют
+        alive = self._created[:self._size] > time.time() - self.ttl
+        allowed = (self._slot_groups[:self._size][None, :] == np.asarray(group_ids)[:, None]) & alive[None, :]
+        scores = np.where(allowed, scores, -np.inf)
+        best = scores.argmax(axis=1)
+        results = []
+        for row, slot in enumerate(best):
+            score = float(scores[row, slot])
+            results.append((int(slot), score) if score >= self.threshold else None)
+        return results
+
+    async def lookup(self, vector: Sequence[float], model: str, temperature: float) -> Optional[SemanticHit]:
+        """
+        Ответ на похожий вопрос той же модели и диапазона температуры
+
+        Поиски, пришедшие в одной итерации event loop, выполняются
+        одним умножением матриц.
+        """
+        query = self._normalize(vector)
+        self.lookups += 1
+        if query is None or self.dim is None or len(query) != self.dim:
+            metrics.SEMANTIC_CACHE.labels(outcome="miss").inc()
+            return None
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, self._group_id(self.group_key(model, temperature)), future))
+        if len(self._pending) == 1:
+            loop.call_soon(self._flush)
+        found = await future
+
+        # Пока задача ждала результата поиска, слот мог быть освобожден или
+        # занят другим ответом: найденная запись сверяется по идентичности
+        if found is None or self._entries[found[0]] is not found[2]:
+            metrics.SEMANTIC_CACHE.labels(outcome="miss").inc()
+            return None
+        slot, similarity, entry = found
+        self._last_used[slot] = time.time()
+        self.hits += 1
+        metrics.SEMANTIC_CACHE.labels(outcome="hit").inc()
+        logger.info(f"Ответ из семантического кэша: сходство {similarity:.3f} с вопросом {entry.message[:100]!r}")
+        return SemanticHit(answer=entry.answer, message=entry.message, similarity=round(similarity, 4))
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, []
+        results = self.search(np.stack([query for query, _, _ in pending]), [group for _, group, _ in pending])
+        for (_, _, future), result in zip(pending, results):
+            if not future.done():
+                # Вместе со слотом запоминается сама запись: слот может быть переиспользован
+                future.set_result(result + (self._entries[result[0]],) if result is not None else None)
+
+    def add(self, vector: Sequence[float], model: str, temperature: float, message: str, answer: str) -> None:
+        """Сохраняет ответ на вопрос"""
+        query = self._normalize(vector)
+        if query is None:
+            return
+        self._ensure_dim(len(query))
+        self._store(query, self.group_key(model, temperature), message, answer, time.time(), time.time())
+
+    def _store(
+        self, vector: "np.ndarray", group: str, message: str, answer: str, created: float, last_used: float
+    ) -> None:
+        slot = self._take_slot()
+        self._vectors[slot] = vector
+        self._created[slot] = created
+        self._last_used[slot] = last_used
+        self._slot_groups[slot] = self._group_id(group)
+        self._entries[slot] = SemanticEntry(group, message, answer)
+
+    def _take_slot(self) -> int:
+        if not self._free and self._size == len(self._entries):
+            if len(self._entries) < self.max_entries:
+                self._grow()
+            else:
+                self._evict()
+        if self._free:
+            return self._free.pop()
+        self._size += 1
+        return self._size - 1
+
+    def _evict(self) -> None:
+        """Освобождает истекшие записи, а если их нет - давно не использованную"""
+        used = self._slot_groups[:self._size] >= 0
+        expired = np.flatnonzero(used & (self._created[:self._size] <= time.time() - self.ttl))
+        if len(expired) == 0:
+            expired = [int(np.where(used, self._last_used[:self._size], np.inf).argmin())]
+        for slot in expired:
+            self._release(int(slot))
+        self.evictions += len(expired)
+
+    def _release(self, slot: int) -> None:
+        self._slot_groups[slot] = -1
+        self._entries[slot] = None
+        self._free.append(slot)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """Сохраняет действующие записи в .npz (атомарно через временный файл)"""
+        path = path or self.path
+        if not path or self.dim is None:
+            return
+        slots = [
+            slot for slot in range(self._size)
+            if self._entries[slot] is not None and self._created[slot] > time.time() - self.ttl
+        ]
+        meta = [
+            {"group": self._entries[slot].group, "message": self._entries[slot].message, "answer": self._entries[slot].answer}
+            for slot in slots
+        ]
+        # Свой временный файл у каждого процесса: воркеры останавливаются одновременно
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vectors=self._vectors[slots],
+                created=self._created[slots],
+                last_used=self._last_used[slots],
+                meta=np.array(json.dumps(meta, ensure_ascii=False))
+            )
+        os.replace(tmp_path, path)
+        logger.info(f"Семантический кэш сохранен: {len(slots)} ответов в {path}")
+
+    def load(self, path: str) -> None:
+        """Загружает записи из .npz; истекшие пропускаются"""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                vectors, created, last_used = data["vectors"], data["created"], data["last_used"]
+                meta = json.loads(str(data["meta"]))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Не удалось загрузить семантический кэш из {path}: {e}")
+            return
+        if len(vectors) == 0:
+            return
+        self._ensure_dim(vectors.shape[1])
+        # Сначала давно использованные: при переполнении вытесняются они
+        now = time.time()
+        for row in np.argsort(last_used):
+            if created[row] > now - self.ttl:
+                item = meta[row]
+                self._store(vectors[row], item["group"], item["message"], item["answer"], created[row], last_used[row])
+        logger.info(f"Семантический кэш загружен из {path}: {self.stats()['entries']} ответов")
+
+    def stats(self) -> Dict[str, float]:
+        entries = int((self._slot_groups[:self._size] >= 0).sum()) if self._size else 0
+        return {
+            "entries": entries,
+            "capacity": len(self._entries),
+            "dim": self.dim,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            "evictions": self.evictions,
+            "threshold": self.threshold
+        }
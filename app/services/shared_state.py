@@ -0,0 +1,212 @@
+"""
+Общее состояние для нескольких процессов сервиса
+
+При запуске с несколькими воркерами (gunicorn/uvicorn --workers) каждый
+процесс держит свои синглтоны. Чтобы кэш результатов и глобальный лимит
+одновременных запросов к Ollama действовали на все процессы сразу,
+они хранятся во внешнем бэкенде: SQLite файле на общем диске хоста
+или Redis для нескольких хостов.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Бэкенды общего состояния
+STATE_LOCAL = "local"  # память процесса: состояние не разделяется
+STATE_SQLITE = "sqlite"
+STATE_REDIS = "redis"
+
+
+def connect_sqlite(path: str, timeout: float = 10.0) -> sqlite3.Connection:
+    """
+    Соединение с SQLite, которое безопасно делить между процессами
+
+    WAL позволяет читать параллельно с записью, а timeout заставляет ждать
+    блокировку другого процесса вместо немедленной ошибки "database is locked".
+    """
+    db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+def connect_redis(url: str):
+    """
+    Синхронный клиент Redis (вызовы выполняются через asyncio.to_thread)
+
+    Raises:
+        RuntimeError: Если пакет redis не установлен
+    """
+    try:
+        import redis
+    except ImportError as e:
+        raise RuntimeError("Для STATE_BACKEND=redis установите пакет redis") from e
+    return redis.Redis.from_url(url)
+
+
+class SQLiteSharedState:
+    """
+    Общее состояние в SQLite файле: ключи с TTL и аренды слотов
+
+    Подходит для нескольких процессов на одном хосте. Захват слота
+    выполняется в транзакции BEGIN IMMEDIATE, поэтому проверка лимита
+    и запись аренды атомарны между процессами.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = connect_sqlite(path)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS shared_kv ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS shared_leases ("
+            "name TEXT NOT NULL, token TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS shared_leases_name ON shared_leases (name, expires_at)")
+        self._db.commit()
+        logger.info(f"Общее состояние в SQLite: {path}")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM shared_kv WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            return row[0] if row is not None else None
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl)
+            )
+            self._db.execute("DELETE FROM shared_kv WHERE expires_at <= ?", (now,))
+            self._db.commit()
+
+    def acquire_lease(self, name: str, limit: int, ttl: float) -> Optional[str]:
+        """
+        Занимает один из limit слотов name на ttl секунд
+
+        Аренды упавших процессов освобождаются по истечении ttl.
+
+        Returns:
+            Токен аренды или None, если все слоты заняты
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM shared_leases WHERE name = ? AND expires_at <= ?", (name, now))
+                (taken,) = self._db.execute(
+                    "SELECT COUNT(*) FROM shared_leases WHERE name = ?", (name,)
+                ).fetchone()
+                token = None
+                if taken < limit:
+                    token = uuid.uuid4().hex
+                    self._db.execute(
+                        "INSERT INTO shared_leases (name, token, expires_at) VALUES (?, ?, ?)",
+                        (name, token, now + ttl)
+                    )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            return token
+
+    def release_lease(self, name: str, token: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM shared_leases WHERE name = ? AND token = ?", (name, token))
+            self._db.commit()
+
+    def leases(self, name: str) -> int:
+        """Число действующих аренд слотов name во всех процессах"""
+        with self._lock:
+            (taken,) = self._db.execute(
+                "SELECT COUNT(*) FROM shared_leases WHERE name = ? AND expires_at > ?", (name, time.time())
+            ).fetchone()
+            return taken
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# Атомарный захват слота: удалить истекшие аренды, проверить лимит, добавить аренду
+_ACQUIRE_LEASE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+
+class RedisSharedState:
+    """
+    Общее состояние в Redis: ключи с TTL и аренды слотов в sorted set
+
+    Подходит для нескольких хостов. Время аренды берется по часам
+    процесса, поэтому часы хостов должны быть синхронизированы.
+    """
+
+    def __init__(self, url: str, prefix: str = "receipts:"):
+        self.url = url
+        self.prefix = prefix
+        self._redis = connect_redis(url)
+        self._acquire = self._redis.register_script(_ACQUIRE_LEASE_SCRIPT)
+        logger.info(f"Общее состояние в Redis: {url}")
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._redis.get(f"{self.prefix}kv:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self._redis.set(f"{self.prefix}kv:{key}", value, px=int(ttl * 1000))
+
+    def acquire_lease(self, name: str, limit: int, ttl: float) -> Optional[str]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        acquired = self._acquire(
+            keys=[f"{self.prefix}leases:{name}"],
+            args=[now, limit, now + ttl, token, int(ttl) + 1]
+        )
+        return token if acquired else None
+
+    def release_lease(self, name: str, token: str) -> None:
+        self._redis.zrem(f"{self.prefix}leases:{name}", token)
+
+    def leases(self, name: str) -> int:
+        return self._redis.zcount(f"{self.prefix}leases:{name}", time.time(), "+inf")
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+def create_shared_state(backend: str, sqlite_path: str, redis_url: str):
+    """
+    Создает бэкенд общего состояния по имени
+
+    Returns:
+        SQLiteSharedState, RedisSharedState или None для local
+
+    Raises:
+        ValueError: Неизвестный бэкенд
+    """
+    if backend == STATE_LOCAL:
+        return None
+    if backend == STATE_SQLITE:
+        return SQLiteSharedState(sqlite_path)
+    if backend == STATE_REDIS:
+        return RedisSharedState(redis_url)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {backend}")
@@ -0,0 +1,85 @@
+"""
+Объединение одинаковых одновременных запросов (single-flight)
+"""
+
+import asyncio
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+def _key_digest(key: Hashable) -> str:
+    """Короткий хэш ключа для лога: ключ /query содержит текст сообщения пользователя"""
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:12]
+
+
+class SingleFlight:
+    """
+    Пока выполняется вызов с некоторым ключом, повторные вызовы с тем же
+    ключом не запускают работу заново, а ждут и получают тот же результат
+
+    Работа отменяется, когда уходит последний ожидающий: иначе после
+    отключения клиента она продолжала бы ждать допуска и занимать модель.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет fn() один раз на ключ среди одновременных вызовов
+
+        Args:
+            key: Ключ идентичности запроса
+            fn: Фабрика корутины, выполняющей работу
+
+        Returns:
+            Результат fn()
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.coalesced += 1
+            logger.debug(f"Запрос объединен с уже выполняющимся: {_key_digest(key)}")
+
+        # shield: отмена одного ожидающего клиента не отменяет общую работу,
+        # пока ее результата ждет кто-то еще
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                logger.debug(f"Ожидающих не осталось, запрос отменен: {_key_digest(key)}")
+                # Новые вызовы с этим ключом начинают работу заново, а не получают отмену
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Помечаем исключение обработанным, даже если все ожидающие ушли
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики объединенных запросов"""
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight)
+        }
@@ -0,0 +1,197 @@
+"""
+Арендаторы сервиса: API ключи, веса в очереди к GPU и лимиты запросов
+
+Клиент передает ключ в заголовке X-API-Key. Ключ определяет арендатора,
+а арендатор - его долю в очереди к Ollama (weight), класс приоритета
+и лимит частоты запросов (token bucket). Запросы без ключа относятся
+к арендатору default, если ключ не обязателен.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import time
+from dataclasses import dataclass, fields
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: интерактивные запросы обслуживаются раньше фоновых
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+DEFAULT_TENANT = "default"
+
+
+@dataclass
+class Tenant:
+    """Арендатор и его параметры планирования"""
+    name: str
+    weight: float = 1.0  # доля в очереди к Ollama относительно других арендаторов
+    rate: float = 0.0  # запросов в секунду, 0 - без ограничения
+    burst: int = 0  # запас запросов сверх rate; 0 - равен ceil(rate)
+    priority: str = PRIORITY_INTERACTIVE  # bulk - все запросы арендатора считаются фоновыми
+    max_queue: Optional[int] = None  # длина очереди арендатора; None - общий ADMISSION_MAX_QUEUE
+
+
+class RateLimitExceeded(HTTPException):
+    """Превышен лимит запросов арендатора; клиенту сообщается Retry-After"""
+
+    def __init__(self, tenant: str, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=f"Превышен лимит запросов для {tenant}. Повторите позже.",
+            headers={"Retry-After": str(retry_after)}
+        )
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Забирает токен
+
+        Returns:
+            0, если токен взят, иначе через сколько секунд он появится
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def _hash_key(api_key: str) -> str:
+    # Ключи хранятся и ищутся по хэшу: сравнение не зависит от совпадающего префикса
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class TenantRegistry:
+    """
+    Арендаторы по API ключам и их лимиты частоты запросов
+
+    Лимиты считаются в памяти процесса: при нескольких воркерах
+    каждый процесс пропускает до rate запросов в секунду.
+    """
+
+    def __init__(self, tenants: List[Tenant], api_keys: Dict[str, str], require_key: bool = False):
+        """
+        Args:
+            tenants: Арендаторы; если среди них нет default, он создается с весом 1
+            api_keys: API ключ -> имя арендатора
+            require_key: Отклонять запросы без ключа
+        """
+        self.tenants: Dict[str, Tenant] = {tenant.name: tenant for tenant in tenants}
+        self.tenants.setdefault(DEFAULT_TENANT, Tenant(DEFAULT_TENANT))
+        for tenant in self.tenants.values():
+            if tenant.rate > 0 and tenant.burst <= 0:
+                tenant.burst = max(1, math.ceil(tenant.rate))
+        unknown = set(api_keys.values()) - set(self.tenants)
+        if unknown:
+            raise ValueError(f"API ключи ссылаются на неизвестных арендаторов: {', '.join(sorted(unknown))}")
+        self._keys = {_hash_key(key): name for key, name in api_keys.items()}
+        self.require_key = require_key
+        self._buckets = {
+            tenant.name: TokenBucket(tenant.rate, tenant.burst)
+            for tenant in self.tenants.values() if tenant.rate > 0
+        }
+        self.rate_limited: Dict[str, int] = {}
+
+    @classmethod
+    def from_file(cls, path: str, require_key: bool = False) -> "TenantRegistry":
+        """
+        Загружает арендаторов из JSON файла
+
+        Формат: {"tenants": [{"name": "mobile", "api_keys": ["..."], "weight": 4,
+        "rate": 5, "burst": 10, "priority": "interactive", "max_queue": 8}, ...]}
+
+        Raises:
+            ValueError: Некорректное описание арендаторов
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        tenants, api_keys = [], {}
+        allowed = {f.name for f in fields(Tenant)} | {"api_keys"}
+        for number, item in enumerate(data.get("tenants", [])):
+            if not isinstance(item, dict) or not item.get("name"):
+                raise ValueError(f"{path}: арендатор #{number} должен быть объектом с полем name")
+            unknown = set(item) - allowed
+            if unknown:
+                raise ValueError(
+                    f"{path}: неизвестные поля арендатора {item['name']}: {', '.join(sorted(unknown))}"
+                )
+            item = dict(item)
+            keys = item.pop("api_keys", [])
+            tenant = Tenant(**item)
+            if tenant.weight <= 0:
+                raise ValueError(f"Вес арендатора {tenant.name} должен быть больше 0")
+            if tenant.priority not in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+                raise ValueError(f"Неизвестный приоритет арендатора {tenant.name}: {tenant.priority}")
+            tenants.append(tenant)
+            api_keys.update({key: tenant.name for key in keys})
+        registry = cls(tenants, api_keys, require_key=require_key)
+        logger.info(f"Арендаторы из {path}: {', '.join(registry.tenants)}")
+        return registry
+
+    def authenticate(self, api_key: Optional[str]) -> Tenant:
+        """
+        Арендатор по API ключу
+
+        Raises:
+            HTTPException: 401 при неизвестном ключе или отсутствии обязательного ключа
+        """
+        if not api_key:
+            if self.require_key:
+                raise HTTPException(status_code=401, detail="Требуется API ключ (заголовок X-API-Key)")
+            return self.tenants[DEFAULT_TENANT]
+        name = self._keys.get(_hash_key(api_key))
+        if name is None:
+            raise HTTPException(status_code=401, detail="Неизвестный API ключ")
+        return self.tenants[name]
+
+    def get(self, name: Optional[str]) -> Tenant:
+        """Арендатор по имени; неизвестное имя (например, из старой задачи) - default"""
+        return self.tenants.get(name or DEFAULT_TENANT) or self.tenants[DEFAULT_TENANT]
+
+    def check_rate(self, tenant: Tenant) -> None:
+        """
+        Списывает запрос с лимита арендатора
+
+        Raises:
+            RateLimitExceeded: Лимит исчерпан
+        """
+        bucket = self._buckets.get(tenant.name)
+        if bucket is None:
+            return
+        wait = bucket.take()
+        if wait > 0:
+            self.rate_limited[tenant.name] = self.rate_limited.get(tenant.name, 0) + 1
+            metrics.TENANT_RATE_LIMITED.labels(tenant=tenant.name).inc()
+            raise RateLimitExceeded(tenant.name, max(1, math.ceil(wait)))
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "weight": tenant.weight,
+                "priority": tenant.priority,
+                "rate": tenant.rate,
+                "burst": tenant.burst,
+                "rate_limited": self.rate_limited.get(name, 0)
+            }
+            for name, tenant in self.tenants.items()
+        }
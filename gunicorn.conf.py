@@ -0,0 +1,41 @@
+"""
+Конфигурация gunicorn для продакшен запуска с несколькими процессами
+
+    gunicorn main:app -c gunicorn.conf.py
+
+Каждый воркер - отдельный процесс uvicorn со своими соединениями к Ollama.
+Чтобы кэш, очередь задач и лимит запросов к Ollama были общими для всех
+воркеров, задайте STATE_BACKEND=sqlite (один хост) или redis.
+"""
+
+import os
+import shutil
+
+from app import config
+
+bind = f"{config.WEB_HOST}:{config.WEB_PORT}"
+workers = config.WEB_WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+# Приложение импортируется в каждом воркере: синглтоны с asyncio объектами
+# и HTTP клиентами нельзя создавать до fork
+preload_app = False
+# Время на завершение запросов к модели при остановке и перезапуске воркера
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    """Очищает файлы метрик прошлого запуска (prometheus multiprocess)"""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Удаляет файлы метрик завершившегося воркера (prometheus multiprocess)"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -5,11 +5,16 @@ Receipt Analyzer API
 """
 
 import logging
-from fastapi import FastAPI, HTTPException
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 import uvicorn
 
-from app.routers import health, receipt, chat
+from app import config, metrics
+from app.middleware import BodySizeLimitMiddleware
+from app.dependencies import ollama_service, job_queue, cpu_pool, shared_state, loop_monitor
+from app.routers import health, receipt, chat, jobs, sessions, admin
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,19 +23,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка общих ресурсов приложения"""
+    if config.LOOP_MONITOR_ENABLED:
+        await loop_monitor.start()
+    await ollama_service.startup()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await ollama_service.shutdown()
+    cpu_pool.shutdown()
+    if shared_state is not None:
+        shared_state.close()
+    await loop_monitor.stop()
+
+
 # Создание FastAPI приложения
 app = FastAPI(
     title="Receipt Analyzer API",
     description="Микросервис для анализа чеков с помощью Ollama + Gemma",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
+)
+
+# Лимит размера тела запроса проверяется до разбора multipart
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    default_limit=config.UPLOAD_MAX_BODY_SIZE,
+    path_limits={"/analyze-receipts/batch": config.BATCH_MAX_BODY_SIZE}
 )
 
 # Подключение роутеров
 app.include_router(health.router)
 app.include_router(receipt.router)
 app.include_router(chat.router)
+app.include_router(jobs.router)
+app.include_router(sessions.router)
+app.include_router(admin.router)
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Счетчики и гистограммы латентности HTTP запросов по маршрутам"""
+    metrics.HTTP_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        # Шаблон маршрута вместо пути, чтобы id задач не раздували число меток
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.HTTP_LATENCY.labels(method=request.method, route=path).observe(time.perf_counter() - start)
+        metrics.HTTP_REQUESTS.labels(method=request.method, route=path, status=status).inc()
 
 
 # Глобальные обработчики исключений
@@ -39,7 +90,8 @@ async def http_exception_handler(request, exc):
     """Обработчик HTTP исключений"""
     return JSONResponse(
         status_code=exc.status_code,
-        content={"detail": exc.detail}
+        content={"detail": exc.detail},
+        headers=getattr(exc, "headers", None)
     )
 
 
@@ -54,10 +106,12 @@ async def global_exception_handler(request, exc):
 
 
 if __name__ == "__main__":
+    # Для продакшена: gunicorn main:app -c gunicorn.conf.py
     uvicorn.run(
         "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
+        host=config.WEB_HOST,
+        port=config.WEB_PORT,
+        reload=config.WEB_RELOAD,
+        workers=1 if config.WEB_RELOAD else config.WEB_WORKERS,
         log_level="info"
     ) 
\ No newline at end of file
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест Receipt Analyzer API
+
+Нагружает /analyze-receipt и /query с фиксированной параллельностью
+(закрытая модель) или с фиксированной интенсивностью поступления запросов
+(открытая модель, пуассоновский поток), считает пропускную способность
+и p50/p95/p99 задержки и сохраняет результат в JSON для сравнения между
+релизами.
+
+С --spawn сам запускает mock Ollama (scripts/mock_ollama.py) и сервис,
+направленный на него: так измеряются накладные расходы самого сервиса
+без GPU, включая пиковую память процесса сервиса (Linux).
+
+Примеры:
+    python scripts/benchmark.py --spawn --endpoint analyze --concurrency 8 --duration 30
+    python scripts/benchmark.py --endpoint query --rate 20 --requests 500 --output bench.json
+    python scripts/benchmark.py --spawn --baseline bench-1.0.json --max-regression 10
+    python scripts/benchmark.py --spawn --endpoint analyze --unique-images --image-size 3000x4000 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+
+QUERY_MESSAGES = [
+    "Привет! Как дела?",
+    "Объясни, что такое кассовый чек",
+    "Какие данные обязательно есть в чеке?",
+    "Сколько стоит хлеб?",
+]
+
+
+@dataclass
+class Sample:
+    """Результат одного запроса"""
+    endpoint: str
+    status: int
+    latency: float
+    success: bool
+
+
+def make_image(unique: bool, size=(600, 900)) -> bytes:
+    """Изображение чека: одно и то же (попадает в кэш) или уникальное шумное"""
+    if unique:
+        image = Image.effect_noise(size, random.uniform(20, 80)).convert("RGB")
+    else:
+        image = Image.new("RGB", size, (245, 245, 240))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class Benchmark:
+    """Генератор нагрузки и сбор замеров"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.samples: List[Sample] = []
+        self.image_size = tuple(int(side) for side in args.image_size.split("x"))
+        self.static_image = Path(args.image).read_bytes() if args.image else make_image(False, self.image_size)
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str) -> None:
+        start = time.perf_counter()
+        try:
+            if endpoint == "analyze":
+                image = make_image(True, self.image_size) if self.args.unique_images else self.static_image
+                response = await client.post("/analyze-receipt", files={"image": ("receipt.jpg", image, "image/jpeg")})
+            else:
+                response = await client.post("/query", json={
+                    "message": random.choice(QUERY_MESSAGES),
+                    "temperature": self.args.temperature
+                })
+            status = response.status_code
+            success = status == 200 and response.json().get("success", False)
+        except httpx.HTTPError:
+            status, success = 0, False
+        self.samples.append(Sample(endpoint, status, time.perf_counter() - start, success))
+
+    def pick_endpoint(self, number: int) -> str:
+        return self.args.endpoint[number % len(self.args.endpoint)]
+
+    def _done(self, started: float, sent: int) -> bool:
+        if self.args.requests and sent >= self.args.requests:
+            return True
+        return time.perf_counter() - started >= self.args.duration
+
+    async def run_closed(self, client: httpx.AsyncClient) -> None:
+        """Фиксированная параллельность: каждый воркер шлет следующий запрос сразу после ответа"""
+        started = time.perf_counter()
+        sent = 0
+
+        async def worker() -> None:
+            nonlocal sent
+            while not self._done(started, sent):
+                number = sent
+                sent += 1
+                await self.request(client, self.pick_endpoint(number))
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def run_open(self, client: httpx.AsyncClient) -> None:
+        """Фиксированная интенсивность: запросы поступают пуассоновским потоком независимо от ответов"""
+        started = time.perf_counter()
+        sent = 0
+        tasks = set()
+        while not self._done(started, sent):
+            if len(tasks) < self.args.max_in_flight:
+                task = asyncio.create_task(self.request(client, self.pick_endpoint(sent)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            sent += 1
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        await asyncio.gather(*tasks)
+
+    async def run(self) -> Dict[str, object]:
+        limits = httpx.Limits(max_connections=max(self.args.concurrency, self.args.max_in_flight))
+        async with httpx.AsyncClient(base_url=self.args.url, timeout=self.args.timeout, limits=limits) as client:
+            if self.args.warmup:
+                print(f"🔥 Прогрев: {self.args.warmup} запросов")
+                await asyncio.gather(*(self.request(client, self.pick_endpoint(i)) for i in range(self.args.warmup)))
+                self.samples.clear()
+
+            mode = f"rate={self.args.rate}/с" if self.args.rate else f"concurrency={self.args.concurrency}"
+            print(f"🚀 Нагрузка на {self.args.url}: {', '.join(self.args.endpoint)}, {mode}")
+            started = time.perf_counter()
+            if self.args.rate:
+                await self.run_open(client)
+            else:
+                await self.run_closed(client)
+            elapsed = time.perf_counter() - started
+
+            try:
+                health = (await client.get("/health")).json()
+            except (httpx.HTTPError, ValueError):
+                health = None
+
+        return {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "elapsed": round(elapsed, 3),
+                "args": {k: v for k, v in vars(self.args).items() if k not in ("baseline",)},
+            },
+            "results": {
+                endpoint: summarize([s for s in self.samples if s.endpoint == endpoint], elapsed)
+                for endpoint in sorted(set(self.args.endpoint))
+            },
+            "health": health,
+        }
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[Sample], elapsed: float) -> Dict[str, object]:
+    latencies = sorted(s.latency for s in samples)
+    return {
+        "requests": len(samples),
+        "succeeded": sum(1 for s in samples if s.success),
+        "statuses": dict(Counter(str(s.status) for s in samples)),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency": {
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(latencies[-1], 4) if latencies else 0.0,
+        },
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: Dict[str, object]) -> None:
+    print("\n📊 Результаты")
+    for endpoint, result in report["results"].items():
+        latency = result["latency"]
+        print(
+            f"  {endpoint:8} запросов: {result['requests']:6}  успешно: {result['succeeded']:6}  "
+            f"rps: {result['throughput_rps']:8}  p50: {latency['p50']:.3f}с  p95: {latency['p95']:.3f}с  "
+            f"p99: {latency['p99']:.3f}с  статусы: {result['statuses']}"
+        )
+    peak = report.get("memory", {}).get("service_peak_rss_mb")
+    if peak is not None:
+        print(f"  пиковая память сервиса: {peak} МБ")
+
+
+def compare(report: Dict[str, object], baseline_path: str, max_regression: float) -> bool:
+    """
+    Сравнивает результат с сохраненным базовым
+
+    Returns:
+        True, если ни одна метрика не ухудшилась больше чем на max_regression процентов
+    """
+    baseline = json.loads(Path(baseline_path).read_text())
+    print(f"\n🔁 Сравнение с {baseline_path} (коммит {baseline['meta'].get('git_commit')})")
+    ok = True
+    for endpoint, result in report["results"].items():
+        base = baseline["results"].get(endpoint)
+        if base is None:
+            continue
+        checks = [(f"latency.{q}", base["latency"][q], result["latency"][q], True) for q in ("p50", "p95", "p99")]
+        checks.append(("throughput_rps", base["throughput_rps"], result["throughput_rps"], False))
+        for name, old, new, lower_is_better in checks:
+            if not old:
+                continue
+            change = (new - old) / old * 100
+            regression = change if lower_is_better else -change
+            marker = "❌" if regression > max_regression else "✅"
+            ok = ok and regression <= max_regression
+            print(f"  {marker} {endpoint}.{name}: {old} -> {new} ({change:+.1f}%)")
+
+    old = baseline.get("memory", {}).get("service_peak_rss_mb")
+    new = report.get("memory", {}).get("service_peak_rss_mb")
+    if old and new is not None:
+        change = (new - old) / old * 100
+        marker = "❌" if change > max_regression else "✅"
+        ok = ok and change <= max_regression
+        print(f"  {marker} memory.service_peak_rss_mb: {old} -> {new} ({change:+.1f}%)")
+    return ok
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Пиковый RSS процесса (VmHWM из /proc, только Linux)"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout}с")
+
+
+def spawn(args: argparse.Namespace) -> List[subprocess.Popen]:
+    """Запускает mock Ollama и сервис, направленный на него"""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen(
+        [sys.executable, str(ROOT / "scripts" / "mock_ollama.py"), "--port", str(args.mock_port), *shlex.split(args.mock_args)]
+    )
+    wait_ready(f"{mock_url}/api/tags")
+
+    port = httpx.URL(args.url).port or 8000
+    env = {
+        **os.environ,
+        "OLLAMA_BASE_URLS": mock_url,
+        "MODEL_WARM_INTERVAL": "0",
+        "RECEIPT_CACHE_PATH": "",
+        "JOB_QUEUE_PATH": "",
+    }
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env
+    )
+    wait_ready(f"{args.url}/health")
+    return [service, mock]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Receipt Analyzer API")
+    parser.add_argument("--url", default="http://localhost:8000", help="Адрес сервиса")
+    parser.add_argument("--endpoint", choices=["analyze", "query"], nargs="+", default=["analyze", "query"],
+                        help="Нагружаемые ручки; запросы чередуются")
+    parser.add_argument("--concurrency", type=int, default=4, help="Число параллельных клиентов (закрытая модель)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Запросов в секунду (открытая модель); 0 - закрытая")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Лимит незавершенных запросов в открытой модели")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность, сек")
+    parser.add_argument("--requests", type=int, default=0, help="Число запросов (вместо длительности)")
+    parser.add_argument("--warmup", type=int, default=0, help="Число запросов прогрева, не попадающих в результат")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Таймаут одного запроса, сек")
+    parser.add_argument("--temperature", type=float, default=0.7, help="Температура для /query")
+    parser.add_argument("--image", help="Файл изображения чека; по умолчанию генерируется")
+    parser.add_argument("--image-size", default="600x900", help="Размер генерируемого изображения, ШxВ")
+    parser.add_argument("--unique-images", action="store_true", help="Уникальное изображение на каждый запрос (мимо кэша)")
+    parser.add_argument("--output", help="Файл для сохранения результата в JSON")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="Допустимое ухудшение метрик, %%")
+    parser.add_argument("--spawn", action="store_true", help="Запустить mock Ollama и сервис локально")
+    parser.add_argument("--mock-port", type=int, default=11500, help="Порт mock Ollama")
+    parser.add_argument("--mock-args", default="", help="Аргументы mock Ollama, например \"--latency 0.2 --error-rate 0.05\"")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    processes = spawn(args) if args.spawn else []
+    try:
+        report = asyncio.run(Benchmark(args).run())
+        if processes:
+            # Пик памяти сервиса за прогон: сравнивается с базовым вместе с задержками
+            report["memory"] = {"service_peak_rss_mb": peak_rss_mb(processes[0].pid)}
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+    print_report(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"\n💾 Результат сохранен в {args.output}")
+    if args.baseline and not compare(report, args.baseline, args.max_regression):
+        print("\n❌ Обнаружена регрессия")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Mock сервер Ollama для нагрузочного тестирования без GPU
+
+Реализует /api/generate (обычный и потоковый ответ), /api/tags и /api/ps
+с настраиваемым распределением задержки, долей ошибок и долей
+некорректного JSON в ответах vision модели.
+
+Пример:
+    python scripts/mock_ollama.py --port 11500 --latency 0.8 --distribution lognormal --error-rate 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import AsyncIterator, Dict, Any
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockSettings:
+    """Параметры поведения mock сервера"""
+    latency: float = 0.5  # средняя задержка генерации, сек
+    distribution: str = "lognormal"  # fixed, uniform, exponential, lognormal
+    sigma: float = 0.5  # разброс для lognormal
+    load_latency: float = 0.0  # задержка "загрузки" модели при первом запросе
+    error_rate: float = 0.0  # доля ответов 500
+    malformed_rate: float = 0.0  # доля почти корректного JSON ("1 250,50", хвостовой текст)
+    garbage_rate: float = 0.0  # доля ответов, которые нельзя разобрать
+    tokens: int = 20  # число фрагментов в потоковом ответе
+    models: str = "moondream:1.8b"
+
+
+STORES = ["Магнит", "Пятерочка", "Перекресток", "Лента", "ВкусВилл"]
+
+
+def sample_latency(settings: MockSettings) -> float:
+    """Задержка одного запроса по выбранному распределению"""
+    mean = settings.latency
+    if settings.distribution == "fixed":
+        return mean
+    if settings.distribution == "uniform":
+        return random.uniform(0, 2 * mean)
+    if settings.distribution == "exponential":
+        return random.expovariate(1 / mean) if mean > 0 else 0.0
+    # lognormal с заданным средним
+    mu = -settings.sigma ** 2 / 2
+    return mean * random.lognormvariate(mu, settings.sigma)
+
+
+def receipt_response(settings: MockSettings) -> str:
+    """Ответ vision модели: корректный, почти корректный или мусор"""
+    store = random.choice(STORES)
+    amount = round(random.uniform(50, 5000), 2)
+    roll = random.random()
+    if roll < settings.garbage_rate:
+        return "На изображении чек, но сумму разобрать не удалось."
+    if roll < settings.garbage_rate + settings.malformed_rate:
+        amount_text = f"{int(amount):,}".replace(",", " ") + f",{int(amount * 100) % 100:02d}"
+        return f'Вот данные: {{"store_name": "{store}", "total_amount": "{amount_text} руб.", "currency": null,}} Готово.'
+    return json.dumps({"store_name": store, "total_amount": amount, "currency": "RUB"}, ensure_ascii=False)
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI(title="Mock Ollama")
+    loaded: Dict[str, float] = {}
+    counters = {"generate": 0, "errors": 0, "in_flight": 0}
+
+    def stats(model: str, started: float, eval_count: int) -> Dict[str, Any]:
+        duration = time.monotonic() - started
+        return {
+            "model": model,
+            "done": True,
+            "total_duration": int(duration * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": 50,
+            "prompt_eval_duration": int(duration * 0.2 * 1e9),
+            "eval_count": eval_count,
+            "eval_duration": int(duration * 0.8 * 1e9),
+        }
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        started = time.monotonic()
+        counters["generate"] += 1
+
+        if model not in loaded and settings.load_latency:
+            await asyncio.sleep(settings.load_latency)
+        loaded[model] = time.time()
+
+        # Запрос без prompt только загружает модель
+        if not body.get("prompt"):
+            return {"model": model, "response": "", "done": True, "load_duration": int(settings.load_latency * 1e9)}
+
+        if random.random() < settings.error_rate:
+            counters["errors"] += 1
+            await asyncio.sleep(sample_latency(settings) / 4)
+            return JSONResponse(status_code=500, content={"error": "mock: model runner crashed"})
+
+        text = receipt_response(settings) if body.get("images") else "Ответ модели " * 5
+        latency = sample_latency(settings)
+
+        if body.get("stream", True):
+            async def chunks() -> AsyncIterator[bytes]:
+                counters["in_flight"] += 1
+                try:
+                    words = text.split(" ")
+                    per_chunk = max(1, len(words) // settings.tokens)
+                    parts = [" ".join(words[i:i + per_chunk]) + " " for i in range(0, len(words), per_chunk)]
+                    for part in parts:
+                        await asyncio.sleep(latency / len(parts))
+                        yield (json.dumps({"model": model, "response": part, "done": False}, ensure_ascii=False) + "\n").encode()
+                    yield (json.dumps({**stats(model, started, len(parts)), "response": ""}) + "\n").encode()
+                finally:
+                    counters["in_flight"] -= 1
+            return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+        counters["in_flight"] += 1
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            counters["in_flight"] -= 1
+        return {**stats(model, started, len(text.split())), "response": text}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": name, "model": name} for name in settings.models.split(",")]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": name, "model": name} for name in loaded]}
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return {"settings": asdict(settings), **counters}
+
+    return app
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Mock сервер Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    defaults = MockSettings()
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="Средняя задержка генерации, сек")
+    parser.add_argument("--distribution", choices=["fixed", "uniform", "exponential", "lognormal"], default=defaults.distribution)
+    parser.add_argument("--sigma", type=float, default=defaults.sigma, help="Разброс lognormal распределения")
+    parser.add_argument("--load-latency", type=float, default=defaults.load_latency, help="Задержка первой загрузки модели, сек")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Доля ответов 500")
+    parser.add_argument("--malformed-rate", type=float, default=defaults.malformed_rate, help="Доля почти корректного JSON")
+    parser.add_argument("--garbage-rate", type=float, default=defaults.garbage_rate, help="Доля неразбираемых ответов")
+    parser.add_argument("--tokens", type=int, default=defaults.tokens, help="Число фрагментов потокового ответа")
+    parser.add_argument("--models", default=defaults.models, help="Модели для /api/tags через запятую")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    settings = MockSettings(
+        latency=args.latency,
+        distribution=args.distribution,
+        sigma=args.sigma,
+        load_latency=args.load_latency,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        garbage_rate=args.garbage_rate,
+        tokens=args.tokens,
+        models=args.models
+    )
+    print(f"🧪 Mock Ollama на http://{args.host}:{args.port}: {asdict(settings)}")
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()